@@ -0,0 +1,127 @@
+# account_pool.py
+
+import asyncio
+import logging
+import time
+from collections import deque
+
+# Accounts kept ready, and the level at which a refill starts.
+POOL_SIZE = 20
+LOW_WATERMARK = 5
+
+# Pooled accounts older than this are discarded instead of being handed out.
+MAX_AGE = 6 * 60 * 60
+
+# Accounts created in parallel during a refill.
+REFILL_CONCURRENCY = 3
+
+# Key under which the pool is persisted in the account store.
+POOL_META_KEY = "account_pool"
+
+logger = logging.getLogger(__name__)
+
+
+class AccountPool:
+    """Warm pool of pre-created mail accounts, so handing one out is a constant-time pop.
+
+    The pool refills in the background whenever it drops to `low_watermark`,
+    discards entries older than `max_age`, and is saved in the account store
+    so pre-created accounts survive restarts.
+    """
+
+    def __init__(self, create_account, delete_account, encode, decode, store=None,
+                 size=POOL_SIZE, low_watermark=LOW_WATERMARK, max_age=MAX_AGE):
+        # async create_account() -> account; async delete_account(account) -> bool
+        self.create_account = create_account
+        self.delete_account = delete_account
+        self.encode = encode
+        self.decode = decode
+        self.store = store
+        self.size = size
+        self.low_watermark = low_watermark
+        self.max_age = max_age
+        # (created_at, account), oldest first.
+        self._entries = deque()
+        self._refill_task = None
+        self.handed_out = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def load(self):
+        """Restores the pool saved by a previous run."""
+        if self.store is None:
+            return
+        for entry in self.store.get_meta(POOL_META_KEY) or []:
+            self._entries.append((entry['created_at'], self.decode(entry['account'])))
+        logger.info(f"Restored {len(self._entries)} pre-created accounts.")
+
+    def _save(self):
+        if self.store is not None:
+            self.store.set_meta(POOL_META_KEY, [
+                {'created_at': created_at, 'account': self.encode(account)}
+                for created_at, account in self._entries
+            ])
+
+    def pop(self):
+        """Returns a ready account, or None if the pool is empty."""
+        self._drop_expired()
+        if not self._entries:
+            self.misses += 1
+            self.refill()
+            return None
+        _, account = self._entries.popleft()
+        self.handed_out += 1
+        self._save()
+        if len(self._entries) <= self.low_watermark:
+            self.refill()
+        return account
+
+    def _drop_expired(self):
+        cutoff = time.time() - self.max_age
+        expired = []
+        while self._entries and self._entries[0][0] < cutoff:
+            expired.append(self._entries.popleft()[1])
+        if expired:
+            self._save()
+            for account in expired:
+                asyncio.create_task(self.delete_account(account))
+
+    def refill(self):
+        """Starts a background refill up to `size`, unless one is already running."""
+        if self._refill_task is None or self._refill_task.done():
+            self._refill_task = asyncio.create_task(self._refill())
+
+    async def _refill(self):
+        async def create_one():
+            try:
+                account = await self.create_account()
+            except Exception as e:
+                logger.warning(f"Couldn't pre-create an account: {e}")
+                return False
+            self._entries.append((time.time(), account))
+            return True
+
+        while len(self._entries) < self.size:
+            batch = min(REFILL_CONCURRENCY, self.size - len(self._entries))
+            created = await asyncio.gather(*(create_one() for _ in range(batch)))
+            self._save()
+            if not any(created):
+                # Upstream is failing; let the next maintenance run try again.
+                break
+
+    async def maintain(self, context=None):
+        """Periodic job: drops stale entries and tops the pool up."""
+        self._drop_expired()
+        if len(self._entries) < self.size:
+            self.refill()
+
+    async def stop(self):
+        if self._refill_task is not None and not self._refill_task.done():
+            self._refill_task.cancel()
+            try:
+                await self._refill_task
+            except asyncio.CancelledError:
+                pass
+        self._save()
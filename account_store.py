@@ -0,0 +1,573 @@
+# account_store.py
+
+import asyncio
+import heapq
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+from collections.abc import MutableMapping
+
+# Seconds to wait after the first queued change before writing a batch to disk.
+FLUSH_INTERVAL = 0.5
+
+# Longest wait between retries of a batch that failed to write; the wait doubles from FLUSH_INTERVAL.
+FLUSH_RETRY_MAX_DELAY = 30.0
+
+# Bytes of the database file to memory-map, so lookups by user ID read pages
+# straight from the OS page cache instead of copying them through read().
+MMAP_SIZE = 256 * 1024 * 1024
+
+# Number of user IDs fetched per query when iterating the store.
+ID_PAGE_SIZE = 1000
+
+# Milliseconds a write waits for another process's transaction to finish.
+BUSY_TIMEOUT_MS = 5000
+
+# compact() only rewrites the database file when at least this share of it is free pages.
+COMPACT_FREE_RATIO = 0.25
+
+logger = logging.getLogger(__name__)
+
+
+class AccountStore:
+    """Persistent mapping of Telegram user ID -> account record (a JSON-serializable dict).
+
+    `upsert` and `delete` are O(1) and only queue the change; queued changes are
+    written to disk in batches, off the event loop, by `flush`.
+    """
+
+    def load_all(self):
+        """Returns every stored record as {user_id: record}."""
+        raise NotImplementedError
+
+    def get(self, user_id):
+        """Returns the record for one user, or None."""
+        raise NotImplementedError
+
+    def count(self):
+        raise NotImplementedError
+
+    def user_ids_after(self, after=None, limit=ID_PAGE_SIZE):
+        """Returns up to `limit` user IDs greater than `after`, in ascending order."""
+        raise NotImplementedError
+
+    def iter_user_ids(self):
+        """Yields every user ID in ascending order, one page at a time."""
+        after = None
+        while True:
+            page = self.user_ids_after(after)
+            if not page:
+                return
+            yield from page
+            after = page[-1]
+
+    def upsert(self, user_id, record):
+        raise NotImplementedError
+
+    def delete(self, user_id):
+        raise NotImplementedError
+
+    def get_meta(self, key):
+        """Returns a bot-wide value (e.g. a job checkpoint) stored next to the accounts, or None."""
+        raise NotImplementedError
+
+    def set_meta(self, key, value):
+        """Queues a bot-wide value for writing; None removes it."""
+        raise NotImplementedError
+
+    # Every stored account has an activity entry: when its user was last active,
+    # and when the account was last found alive upstream. Creating an account counts as activity.
+
+    def touch(self, user_id, at=None):
+        """Records that the user was active (now, by default). Users without an account are ignored."""
+        raise NotImplementedError
+
+    def mark_checked(self, user_id, at=None):
+        """Records that the user's account was found alive upstream."""
+        raise NotImplementedError
+
+    def least_recently_active(self, before, limit):
+        """Returns up to `limit` (user_id, last_active) for accounts neither active nor checked since `before`.
+
+        Oldest first, by the later of the two times. Queued changes are only seen once flushed.
+        """
+        raise NotImplementedError
+
+    def recently_active(self, since, limit):
+        """Returns up to `limit` (user_id, last_active) for accounts whose user was active since `since`.
+
+        Most recently active first. Queued changes are only seen once flushed.
+        """
+        raise NotImplementedError
+
+    async def compact(self):
+        """Gives the space freed by deleted accounts back to the file system. Returns True if it did."""
+        return False
+
+    async def flush(self):
+        """Writes all queued changes to disk."""
+
+    async def close(self):
+        """Flushes queued changes and releases the underlying resources."""
+        await self.flush()
+
+
+class MemoryAccountStore(AccountStore):
+    """Non-persistent store, for bots that keep accounts only for the process lifetime."""
+
+    def __init__(self):
+        self._records = {}
+        self._meta = {}
+        # user_id -> [last_active, last_checked]
+        self._activity = {}
+
+    def load_all(self):
+        return dict(self._records)
+
+    def get(self, user_id):
+        return self._records.get(user_id)
+
+    def count(self):
+        return len(self._records)
+
+    def user_ids_after(self, after=None, limit=ID_PAGE_SIZE):
+        ids = sorted(user_id for user_id in self._records if after is None or user_id > after)
+        return ids[:limit]
+
+    def upsert(self, user_id, record):
+        self._records[user_id] = record
+        self._activity.setdefault(user_id, [time.time(), 0.0])
+
+    def delete(self, user_id):
+        self._records.pop(user_id, None)
+        self._activity.pop(user_id, None)
+
+    def get_meta(self, key):
+        return self._meta.get(key)
+
+    def set_meta(self, key, value):
+        if value is None:
+            self._meta.pop(key, None)
+        else:
+            self._meta[key] = value
+
+    def touch(self, user_id, at=None):
+        activity = self._activity.get(user_id)
+        if activity is not None:
+            activity[0] = max(activity[0], at or time.time())
+
+    def mark_checked(self, user_id, at=None):
+        activity = self._activity.get(user_id)
+        if activity is not None:
+            activity[1] = max(activity[1], at or time.time())
+
+    def least_recently_active(self, before, limit):
+        due = heapq.nsmallest(limit, (
+            (max(last_active, last_checked), user_id, last_active)
+            for user_id, (last_active, last_checked) in self._activity.items()
+            if max(last_active, last_checked) < before
+        ))
+        return [(user_id, last_active) for _, user_id, last_active in due]
+
+    def recently_active(self, since, limit):
+        active = heapq.nlargest(limit, (
+            (last_active, user_id) for user_id, (last_active, _) in self._activity.items() if last_active >= since
+        ))
+        return [(user_id, last_active) for last_active, user_id in active]
+
+
+class SqliteAccountStore(AccountStore):
+    """Account store backed by an embedded SQLite database.
+
+    Each batch is committed in a single transaction with `synchronous=FULL`, so a
+    crash leaves either the old or the new state on disk, never a torn file.
+    Lookups go through a second connection: in WAL mode it reads the last
+    committed state while a batch is written, so the event loop never waits for
+    a writer thread's fsync.
+    """
+
+    def __init__(self, path, legacy_json_file=None, flush_interval=FLUSH_INTERVAL):
+        self.path = path
+        self.flush_interval = flush_interval
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        # Waits for other worker processes' write transactions instead of failing with "database is locked".
+        self._conn.execute(f"PRAGMA busy_timeout={BUSY_TIMEOUT_MS}")
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=FULL")
+        self._conn.execute(f"PRAGMA mmap_size={MMAP_SIZE}")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS accounts (user_id INTEGER PRIMARY KEY, data TEXT NOT NULL)"
+        )
+        self._conn.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT NOT NULL)")
+        self._create_activity_index()
+        # Serializes access to the writing connection between writer threads.
+        self._db_lock = threading.Lock()
+        self._reader = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._reader.execute(f"PRAGMA busy_timeout={BUSY_TIMEOUT_MS}")
+        self._reader.execute(f"PRAGMA mmap_size={MMAP_SIZE}")
+        # Serializes access to the reading connection, in case a lookup is made off the event loop.
+        self._read_lock = threading.Lock()
+        # Queued changes: {user_id: record}, where a record of None means "delete".
+        self._pending = {}
+        # Queued meta changes: {key: value}, where None means "delete".
+        self._pending_meta = {}
+        # Queued activity changes: {user_id: [last_active, last_checked]}, where None leaves a time as it is.
+        self._pending_activity = {}
+        # The batch being written by flush(), still read from here until it is committed.
+        self._writing = {}
+        self._writing_meta = {}
+        self._flush_task = None
+        self._flush_lock = None
+        if legacy_json_file:
+            self._import_legacy_json(legacy_json_file)
+
+    def _create_activity_index(self):
+        exists = self._conn.execute(
+            "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'activity'"
+        ).fetchone()
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS activity ("
+            "user_id INTEGER PRIMARY KEY, last_active REAL NOT NULL, last_checked REAL NOT NULL DEFAULT 0)"
+        )
+        # Orders accounts by how long ago anything was known about them, for least_recently_active().
+        self._conn.execute(
+            "CREATE INDEX IF NOT EXISTS activity_due ON activity (max(last_active, last_checked))"
+        )
+        # And by user activity alone, for recently_active().
+        self._conn.execute("CREATE INDEX IF NOT EXISTS activity_recent ON activity (last_active)")
+        if not exists:
+            # Accounts stored before activity was tracked start out as active now.
+            self._conn.execute(
+                "INSERT OR IGNORE INTO activity (user_id, last_active) SELECT user_id, ? FROM accounts",
+                (time.time(),),
+            )
+
+    def _import_legacy_json(self, json_file):
+        """One-time migration from the old db.json format."""
+        if not os.path.exists(json_file):
+            return
+        (count,) = self._conn.execute("SELECT COUNT(*) FROM accounts").fetchone()
+        if count:
+            return
+        try:
+            with open(json_file, 'r') as f:
+                data = json.load(f)
+        except json.JSONDecodeError as e:
+            logger.error(f"Failed to import legacy accounts from {json_file}: {e}")
+            return
+        self._write_batch({int(user_id): record for user_id, record in data.items()})
+        logger.info(f"Imported {len(data)} accounts from {json_file} into {self.path}.")
+
+    def load_all(self):
+        with self._read_lock:
+            rows = self._reader.execute("SELECT user_id, data FROM accounts").fetchall()
+        records = {user_id: json.loads(data) for user_id, data in rows}
+        for user_id, record in self._queued().items():
+            if record is None:
+                records.pop(user_id, None)
+            else:
+                records[user_id] = record
+        return records
+
+    def get(self, user_id):
+        if user_id in self._pending:
+            return self._pending[user_id]
+        if user_id in self._writing:
+            return self._writing[user_id]
+        with self._read_lock:
+            row = self._reader.execute("SELECT data FROM accounts WHERE user_id = ?", (user_id,)).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def count(self):
+        queued = self._queued()
+        with self._read_lock:
+            (count,) = self._reader.execute("SELECT COUNT(*) FROM accounts").fetchone()
+            if not queued:
+                return count
+            placeholders = ",".join("?" * len(queued))
+            stored = {user_id for (user_id,) in self._reader.execute(
+                f"SELECT user_id FROM accounts WHERE user_id IN ({placeholders})", list(queued)
+            )}
+        for user_id, record in queued.items():
+            if record is None and user_id in stored:
+                count -= 1
+            elif record is not None and user_id not in stored:
+                count += 1
+        return count
+
+    def user_ids_after(self, after=None, limit=ID_PAGE_SIZE):
+        with self._read_lock:
+            rows = self._reader.execute(
+                "SELECT user_id FROM accounts WHERE user_id > ? ORDER BY user_id LIMIT ?",
+                (after if after is not None else -(2 ** 63), limit),
+            ).fetchall()
+        pending = self._queued()
+        new_ids = sorted(user_id for user_id, record in pending.items()
+                         if record is not None and (after is None or user_id > after))
+        ids = []
+        for user_id in heapq.merge((user_id for (user_id,) in rows), new_ids):
+            if (ids and ids[-1] == user_id) or (user_id in pending and pending[user_id] is None):
+                continue
+            ids.append(user_id)
+            if len(ids) == limit:
+                break
+        return ids
+
+    def _queued(self):
+        """Changes not yet committed: the batch being written, overridden by those queued since."""
+        return {**self._writing, **self._pending} if self._writing else self._pending
+
+    def upsert(self, user_id, record):
+        self._pending[user_id] = record
+        self._schedule_flush()
+
+    def delete(self, user_id):
+        self._pending[user_id] = None
+        self._schedule_flush()
+
+    def get_meta(self, key):
+        if key in self._pending_meta:
+            return self._pending_meta[key]
+        if key in self._writing_meta:
+            return self._writing_meta[key]
+        with self._read_lock:
+            row = self._reader.execute("SELECT value FROM meta WHERE key = ?", (key,)).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def set_meta(self, key, value):
+        self._pending_meta[key] = value
+        self._schedule_flush()
+
+    def touch(self, user_id, at=None):
+        self._queue_activity(user_id, 0, at or time.time())
+
+    def mark_checked(self, user_id, at=None):
+        self._queue_activity(user_id, 1, at or time.time())
+
+    def _queue_activity(self, user_id, field, at):
+        activity = self._pending_activity.setdefault(user_id, [None, None])
+        activity[field] = max(activity[field] or 0, at)
+        self._schedule_flush()
+
+    def least_recently_active(self, before, limit):
+        with self._read_lock:
+            return self._reader.execute(
+                "SELECT user_id, last_active FROM activity WHERE max(last_active, last_checked) < ? "
+                "ORDER BY max(last_active, last_checked) LIMIT ?",
+                (before, limit),
+            ).fetchall()
+
+    def recently_active(self, since, limit):
+        with self._read_lock:
+            return self._reader.execute(
+                "SELECT user_id, last_active FROM activity WHERE last_active >= ? ORDER BY last_active DESC LIMIT ?",
+                (since, limit),
+            ).fetchall()
+
+    async def compact(self, min_free_ratio=COMPACT_FREE_RATIO):
+        await self.flush()
+        return await asyncio.to_thread(self._compact, min_free_ratio)
+
+    def _compact(self, min_free_ratio):
+        # A connection of its own, so lookups on the main one aren't held up while VACUUM runs.
+        conn = sqlite3.connect(self.path, isolation_level=None)
+        try:
+            conn.execute(f"PRAGMA busy_timeout={BUSY_TIMEOUT_MS}")
+            (page_count,) = conn.execute("PRAGMA page_count").fetchone()
+            (free_pages,) = conn.execute("PRAGMA freelist_count").fetchone()
+            if not page_count or free_pages < page_count * min_free_ratio:
+                return False
+            conn.execute("VACUUM")
+            conn.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+        finally:
+            conn.close()
+        logger.info(f"Compacted {self.path}: {free_pages} of {page_count} pages were free.")
+        return True
+
+    def _schedule_flush(self):
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            # Called outside the event loop (e.g. at startup): write synchronously.
+            batch, self._pending = self._pending, {}
+            meta_batch, self._pending_meta = self._pending_meta, {}
+            activity_batch, self._pending_activity = self._pending_activity, {}
+            self._write_batch(batch, meta_batch, activity_batch)
+            return
+        if self._flush_task is None or self._flush_task.done():
+            self._flush_task = loop.create_task(self._flush_later())
+
+    async def _flush_later(self, delay=None):
+        delay = self.flush_interval if delay is None else delay
+        await asyncio.sleep(delay)
+        try:
+            await self.flush()
+        except sqlite3.Error:
+            # flush() logged it and put the batch back; retry it, backing off while the disk stays unhappy.
+            delay = min(max(delay, self.flush_interval) * 2, FLUSH_RETRY_MAX_DELAY)
+            logger.info(f"Retrying the account write in {delay:.1f}s.")
+            self._flush_task = asyncio.get_running_loop().create_task(self._flush_later(delay))
+
+    async def flush(self):
+        if self._flush_lock is None:
+            self._flush_lock = asyncio.Lock()
+        async with self._flush_lock:
+            if not self._pending and not self._pending_meta and not self._pending_activity:
+                return
+            batch, self._pending = self._pending, {}
+            meta_batch, self._pending_meta = self._pending_meta, {}
+            activity_batch, self._pending_activity = self._pending_activity, {}
+            self._writing, self._writing_meta = batch, meta_batch
+            try:
+                await asyncio.to_thread(self._write_batch, batch, meta_batch, activity_batch)
+            except sqlite3.Error as e:
+                logger.error(f"Failed to write {len(batch)} account changes: {e}")
+                # Put the batch back, without clobbering anything queued meanwhile.
+                self._pending = {**batch, **self._pending}
+                self._pending_meta = {**meta_batch, **self._pending_meta}
+                self._pending_activity = {**activity_batch, **self._pending_activity}
+                raise
+            finally:
+                self._writing, self._writing_meta = {}, {}
+
+    def _write_batch(self, batch, meta_batch=None, activity_batch=None):
+        now = time.time()
+        upserts = [(user_id, json.dumps(record, separators=(',', ':')))
+                   for user_id, record in batch.items() if record is not None]
+        deletes = [(user_id,) for user_id, record in batch.items() if record is None]
+        activity = [(last_active, last_checked, user_id)
+                    for user_id, (last_active, last_checked) in (activity_batch or {}).items()]
+        with self._db_lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                self._conn.executemany(
+                    "INSERT INTO accounts (user_id, data) VALUES (?, ?) "
+                    "ON CONFLICT(user_id) DO UPDATE SET data = excluded.data",
+                    upserts,
+                )
+                self._conn.executemany("DELETE FROM accounts WHERE user_id = ?", deletes)
+                self._conn.executemany(
+                    "INSERT INTO activity (user_id, last_active) VALUES (?, ?) ON CONFLICT(user_id) DO NOTHING",
+                    [(user_id, now) for user_id, _ in upserts],
+                )
+                self._conn.executemany("DELETE FROM activity WHERE user_id = ?", deletes)
+                self._conn.executemany(
+                    "UPDATE activity SET last_active = max(last_active, coalesce(?, 0)), "
+                    "last_checked = max(last_checked, coalesce(?, 0)) WHERE user_id = ?",
+                    activity,
+                )
+                for key, value in (meta_batch or {}).items():
+                    if value is None:
+                        self._conn.execute("DELETE FROM meta WHERE key = ?", (key,))
+                    else:
+                        self._conn.execute(
+                            "INSERT INTO meta (key, value) VALUES (?, ?) "
+                            "ON CONFLICT(key) DO UPDATE SET value = excluded.value",
+                            (key, json.dumps(value, separators=(',', ':'))),
+                        )
+                self._conn.execute("COMMIT")
+            except sqlite3.Error:
+                self._conn.execute("ROLLBACK")
+                raise
+        logger.debug(f"Wrote {len(upserts)} upserts and {len(deletes)} deletes to {self.path}.")
+
+    async def close(self):
+        if self._flush_task is not None and not self._flush_task.done():
+            self._flush_task.cancel()
+        await self.flush()
+        with self._db_lock:
+            self._conn.close()
+        with self._read_lock:
+            self._reader.close()
+
+
+class LazyAccountMap(MutableMapping):
+    """Dict-like view of an AccountStore that decodes a user's record on first access.
+
+    Nothing is read at construction time, so startup cost doesn't grow with the
+    number of stored users. Assignments and deletions are written through to the store.
+
+    With `shared=True` (several worker processes on one store) every access
+    re-reads the record, and the account is decoded again if another worker
+    changed or deleted it.
+    """
+
+    def __init__(self, store, decode, encode, shared=False):
+        self.store = store
+        self.decode = decode
+        self.encode = encode
+        self.shared = shared
+        self._materialized = {}
+        # id(value) -> user_id for materialized values, used by save_value().
+        self._owners = {}
+        # user_id -> record the materialized value was decoded from or saved as (shared mode only).
+        self._records = {}
+
+    def __getitem__(self, user_id):
+        if not self.shared:
+            try:
+                return self._materialized[user_id]
+            except KeyError:
+                pass
+        record = self.store.get(user_id)
+        if record is None:
+            self._forget(user_id)
+            raise KeyError(user_id)
+        value = self._materialized.get(user_id)
+        if value is not None and self._records.get(user_id) == record:
+            return value
+        self._forget(user_id)
+        value = self._materialized[user_id] = self.decode(record)
+        self._owners[id(value)] = user_id
+        if self.shared:
+            self._records[user_id] = record
+        return value
+
+    def __contains__(self, user_id):
+        if not self.shared and user_id in self._materialized:
+            return True
+        return self.store.get(user_id) is not None
+
+    def __setitem__(self, user_id, value):
+        self._forget(user_id)
+        self._materialized[user_id] = value
+        self._owners[id(value)] = user_id
+        self._write(user_id, value)
+
+    def __delitem__(self, user_id):
+        if user_id not in self:
+            raise KeyError(user_id)
+        self._forget(user_id)
+        self.store.delete(user_id)
+
+    def _forget(self, user_id):
+        old = self._materialized.pop(user_id, None)
+        if old is not None:
+            self._owners.pop(id(old), None)
+        self._records.pop(user_id, None)
+
+    def _write(self, user_id, value):
+        record = self.encode(value)
+        if self.shared:
+            self._records[user_id] = record
+        self.store.upsert(user_id, record)
+
+    def __iter__(self):
+        return self.store.iter_user_ids()
+
+    def __len__(self):
+        return self.store.count()
+
+    def save(self, user_id):
+        """Writes in-place changes to an already materialized account back to the store."""
+        if user_id in self._materialized:
+            self._write(user_id, self._materialized[user_id])
+
+    def save_value(self, value):
+        """Like save(), for callers that hold the value but not its key."""
+        user_id = self._owners.get(id(value))
+        if user_id is not None:
+            self.save(user_id)
@@ -0,0 +1,139 @@
+# benchmarks/extract_throughput.py
+#
+# Measures extract.py's throughput and accuracy over a corpus of sample emails:
+# one-time-code mails in plain text and HTML, sign-in links, receipts and large
+# HTML newsletters that contain no code at all.
+# Usage: python benchmarks/extract_throughput.py [--rounds N] [--seed S]
+
+import argparse
+import json
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from extract import extract
+
+SERVICES = ["Acme", "Discord", "GitHub", "Shopify", "Binance", "TikTok", "Steam", "Notion"]
+
+# (subject, plain text) templates for code mails; {code} and {service} are filled in.
+CODE_TEMPLATES = [
+    ("Your {service} verification code", "Hi,\n\nYour verification code for {service} is: {code}\n\nIt expires in 10 minutes."),
+    ("{code} is your {service} code", "Use it to finish signing in. If you didn't ask for it, ignore this email."),
+    ("Confirm your email", "Welcome to {service}!\nEnter this code in the app:\n\n{code}\n\nThanks,\nThe {service} team"),
+    ("{service} sign-in", "Someone is signing in to your {service} account.\nOne-time passcode: {code}\nValid for 15 minutes."),
+    ("Security alert", "Your {service} PIN is {code}. Never share it with anyone, not even {service} staff."),
+]
+
+HTML_CODE_TEMPLATE = (
+    "<html><head><title>{service}</title><style>td {{ font-family: Arial; }} .code {{ font-size: 32px; }}</style></head>"
+    "<body><table width=\"100%\"><tr><td><img src=\"https://cdn.example.com/{service}.png\" alt=\"{service}\"></td></tr>"
+    "<tr><td><p>Hello,</p><p>Here is your verification code:</p></td></tr>"
+    "<tr><td class=\"code\"><b>{code}</b></td></tr>"
+    "<tr><td><p>Or <a href=\"https://{service}.example.com/verify?token={token}&amp;utm_source=email\">confirm your email</a>.</p>"
+    "<p><a href=\"https://{service}.example.com/unsubscribe?u={token}\">Unsubscribe</a> | "
+    "<a href=\"https://{service}.example.com/privacy\">Privacy</a></p></td></tr></table></body></html>"
+)
+
+LINK_TEMPLATE = (
+    "Reset your password",
+    "Hi,\n\nClick the link below to reset your {service} password:\nhttps://{service}.example.com/reset/{token}\n\n"
+    "Read our blog: https://{service}.example.com/blog\nSince 2019, {service} has served 12000 customers.",
+)
+
+RECEIPT_TEMPLATE = (
+    "Your {service} order #{order}",
+    "Thanks for your order #{order} placed on 2024-05-17.\nTotal: $1249.00\nItems: 3\n"
+    "Track it at https://{service}.example.com/orders/{order}\nQuestions? Call 1800 5550 1234.",
+)
+
+
+def newsletter(rng, service, size):
+    """An HTML newsletter of about `size` bytes with prices, dates and links but no code."""
+    blocks = []
+    while sum(map(len, blocks)) < size:
+        blocks.append(
+            f"<tr><td><h2>Deal {rng.randint(1, 999)}</h2><p>Save {rng.randint(5, 70)}% until 2025-0{rng.randint(1, 9)}-1{rng.randint(0, 9)}. "
+            f"Only ${rng.randint(10, 9999)}.99 for the next {rng.randint(2, 48)} hours. " + "Lorem ipsum dolor sit amet. " * 8 +
+            f"<a href=\"https://{service}.example.com/deal/{rng.randint(10000, 99999)}\">Shop now</a></p></td></tr>"
+        )
+    return (
+        f"<html><head><style>{'.c { color: red; } ' * 50}</style></head><body><table>{''.join(blocks)}</table>"
+        f"<p><a href=\"https://{service}.example.com/unsubscribe\">Unsubscribe</a></p></body></html>"
+    )
+
+
+def code(rng):
+    if rng.random() < 0.2:
+        return "".join(rng.choice("ABCDEFGHJKLMNPQRSTUVWXYZ23456789") for _ in range(6)) + str(rng.randint(0, 9))
+    return str(rng.randint(100000, 999999))
+
+
+def build_corpus(rng):
+    """Returns [(category, subject, text, html, expected codes, expects a link)]."""
+    corpus = []
+    for i in range(200):
+        service, value, token = rng.choice(SERVICES), code(rng), f"{rng.getrandbits(64):016x}"
+        subject, text = rng.choice(CODE_TEMPLATES)
+        corpus.append(("code_text", subject.format(service=service, code=value), text.format(service=service, code=value),
+                       None, [value], False))
+        corpus.append(("code_html", f"{service}: verify your email", None,
+                       HTML_CODE_TEMPLATE.format(service=service, code=value, token=token), [value], True))
+        subject, text = LINK_TEMPLATE
+        corpus.append(("link_text", subject, text.format(service=service, token=token), None, [], True))
+        order = rng.randint(10000000, 99999999)
+        subject, text = RECEIPT_TEMPLATE
+        corpus.append(("receipt", subject.format(service=service, order=order),
+                       text.format(service=service, order=order), None, [], False))
+    for i in range(40):
+        service = rng.choice(SERVICES)
+        corpus.append(("newsletter", f"{service} weekly deals", None, newsletter(rng, service, rng.choice([20_000, 100_000])),
+                       [], False))
+    return corpus
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--rounds", type=int, default=5)
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+    corpus = build_corpus(random.Random(args.seed))
+
+    results = {}
+    for category, subject, text, html_body, codes, has_link in corpus:
+        result = results.setdefault(category, {
+            "messages": 0, "bytes": 0, "seconds": 0.0, "codes_right": 0, "codes_wrong": 0, "links_right": 0,
+            "links_wrong": 0,
+        })
+        started = time.perf_counter()
+        for _ in range(args.rounds):
+            found = extract(subject, text, html_body)
+        result["seconds"] += (time.perf_counter() - started) / args.rounds
+        result["messages"] += 1
+        result["bytes"] += len(text or "") + len(html_body or "")
+        result["codes_right" if found["codes"] == codes else "codes_wrong"] += 1
+        result["links_right" if bool(found["links"]) == has_link else "links_wrong"] += 1
+
+    report = {}
+    for category, result in results.items():
+        report[category] = {
+            "messages": result["messages"],
+            "avg_kb": round(result["bytes"] / result["messages"] / 1024, 1),
+            "messages_per_s": round(result["messages"] / result["seconds"]),
+            "mb_per_s": round(result["bytes"] / result["seconds"] / 1e6, 1),
+            "codes_accuracy": round(result["codes_right"] / result["messages"], 3),
+            "links_accuracy": round(result["links_right"] / result["messages"], 3),
+        }
+    total_seconds = sum(result["seconds"] for result in results.values())
+    report["all"] = {
+        "messages": len(corpus),
+        "messages_per_s": round(len(corpus) / total_seconds),
+        "mb_per_s": round(sum(result["bytes"] for result in results.values()) / total_seconds / 1e6, 1),
+    }
+    print(json.dumps(report, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,595 @@
+# benchmarks/load_test.py
+#
+# Offline load test: replays a synthetic user population against the real
+# handlers of bot.py, i.py and temp.py, with local stand-ins for the Bot API,
+# mail.tm and the privatix RapidAPI.
+# Usage: python benchmarks/load_test.py [--bots bot i temp] [--users N] [--rate UPDATES_PER_S]
+#                                        [--mail-latency S] [--error-rate P] [--inbox-size N]
+#                                        [--degrade mailtm|privatix] [--degraded-latency S]
+#                                        [--degraded-error-rate P] [--rapidapi-quota N] [--rapidapi-reset S]
+#                                        [--output results.json] [--compare baseline.json]
+#
+# Each bot runs through its own main() in a fresh process, so peak RSS is its
+# own; the fake servers run in another process. Every user sends its bot's
+# script of actions (see script_for) in order; users are interleaved step by
+# step. Actions that depend on a reply (tapping an inline button, /read <id>)
+# are only sent once the bot has answered the user's previous action, and use
+# the button or ID from that answer, so they are as realistic as inbox contents.
+# Results are JSON: updates/s, handler latency percentiles, upstream calls per
+# update by service and endpoint, and peak RSS. --compare prints the change of
+# each headline number against an earlier result file and exits with status 1
+# if any got worse by more than --max-regression.
+
+import argparse
+import asyncio
+import base64
+import json
+import logging
+import multiprocessing
+import os
+import random
+import re
+import resource
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+from urllib.parse import parse_qs
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import uvicorn
+
+BOTS = ("bot", "i", "temp")
+
+# bot.py shows this many messages per inbox page.
+BOT_INBOX_PAGE_SIZE = 5
+
+# Messages per page of mail.tm's /messages.
+MAILTM_PAGE_SIZE = 30
+
+# Seconds a reply-dependent action waits for the bot's answer before the user gives up on it.
+DEPENDENCY_TIMEOUT = 5.0
+
+# Headline numbers compared by --compare, and whether higher is better.
+COMPARED = {
+    "updates_per_second": True,
+    "handler_p50_ms": False,
+    "handler_p99_ms": False,
+    "upstream_calls_per_update": False,
+    "peak_rss_mb": False,
+}
+
+
+def script_for(bot, inbox_size):
+    """Returns the actions every synthetic user performs, in order.
+
+    ("text", text) sends a message; ("tap", prefix) taps the first inline button
+    whose callback data starts with `prefix`; ("reply", template, pattern) sends
+    `template` filled with the first match of `pattern` in the bot's answer.
+    """
+    if bot == "bot":
+        actions = [("text", "/start"), ("text", "📝 Generate New Email"), ("text", "📨 Inbox")]
+        if inbox_size > BOT_INBOX_PAGE_SIZE:
+            actions.append(("tap", "inbox_page_2"))
+        if inbox_size:
+            actions.append(("tap", "read_email_"))
+        return actions + [("text", "📊 Status"), ("text", "🚀 My Email")]
+    if bot == "i":
+        return [("text", "/start"), ("text", "/new_email"), ("text", "/check_inbox"), ("text", "/my_email")]
+    actions = [("text", "/start"), ("text", "/new"), ("text", "/check")]
+    if inbox_size:
+        actions.append(("reply", "/read {}", r"<b>ID:</b> <code>([^<]+)</code>"))
+    return actions + [("text", "/delete")]
+
+
+def make_update(update_id, user_id, kind, payload, message_id=1):
+    user = {"id": user_id, "is_bot": False, "first_name": f"User{user_id}"}
+    chat = {"id": user_id, "type": "private"}
+    if kind == "tap":
+        return {"update_id": update_id, "callback_query": {
+            "id": str(update_id), "from": user, "chat_instance": str(user_id), "data": payload,
+            "message": {"message_id": message_id, "date": 0, "chat": chat, "text": "..."},
+        }}
+    entities = [{"type": "bot_command", "offset": 0, "length": len(payload.split()[0])}] if payload.startswith("/") else []
+    return {"update_id": update_id, "message": {
+        "message_id": update_id, "date": int(time.time()), "chat": chat, "from": user,
+        "text": payload, "entities": entities,
+    }}
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def wait_for_port(port, timeout=10.0):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            socket.create_connection(("127.0.0.1", port), timeout=0.1).close()
+            return
+        except OSError:
+            time.sleep(0.02)
+    raise RuntimeError(f"Nothing listening on port {port}")
+
+
+def fake_token(account):
+    claims = {"exp": time.time() + 24 * 3600, "account": account}
+    payload = base64.urlsafe_b64encode(json.dumps(claims).encode()).decode().rstrip("=")
+    return f"header.{payload}.signature"
+
+
+def token_account(authorization):
+    payload = (authorization or "").rsplit(" ", 1)[-1].split(".")[1]
+    return json.loads(base64.urlsafe_b64decode(payload + "=" * (-len(payload) % 4)))["account"]
+
+
+class FakeBackends:
+    """ASGI stand-in for the Bot API (/bot...), mail.tm (/mailtm/...) and the privatix RapidAPI (/privatix/...).
+
+    Hands out the users' actions as updates through getUpdates, at `rate`
+    updates/s (all at once when 0), keeps what the bot sends to each chat so
+    reply-dependent actions can be resolved, and counts every call by service
+    and endpoint. Every inbox has its own message IDs.
+    """
+
+    def __init__(self, actions, rate, telegram_latency, mail_latency, error_rate, inbox_size, body_size, quota,
+                 quota_reset, degrade=None, degraded_latency=0.0, degraded_error_rate=0.0):
+        # (index, user_id, action) not handed out yet, in offer order.
+        self.pending = [(index, user_id, action) for index, (user_id, action) in enumerate(actions)]
+        self.served = []
+        self.next_update_id = 1
+        self.skipped = 0
+        # chat_id -> [(sequence, message_id, text, callback data)] of what the bot sent.
+        self.sent = {}
+        self.sequence = 0
+        # user_id -> sequence when their last action was handed out, and when a blocked action started waiting.
+        self.asked_at = {}
+        self.waiting_since = {}
+        self.rate = rate
+        self.telegram_latency = telegram_latency
+        self.mail_latency = mail_latency
+        self.error_rate = error_rate
+        # One mail service made slower and/or failing on top of the above, to exercise failover.
+        self.degrade = degrade
+        self.degraded_latency = degraded_latency
+        self.degraded_error_rate = degraded_error_rate
+        self.inbox_size = inbox_size
+        self.body = ("Lorem ipsum dolor sit amet. " * (body_size // 28 + 1))[:body_size]
+        # RapidAPI requests left until the quota resets in `quota_reset` seconds; every call spends one.
+        self.quota = quota
+        self.quota_reset = quota_reset
+        self.started = None
+        self.calls = {}
+        self.message_ids = 0
+        # address -> account number, which is also carried in the account's token.
+        self.addresses = {}
+
+    async def __call__(self, scope, receive, send):
+        body = b""
+        while True:
+            message = await receive()
+            body += message.get("body", b"")
+            if not message.get("more_body"):
+                break
+        path = scope["path"]
+        query = parse_qs(scope["query_string"].decode())
+        if path == "/_stats":
+            status, headers, result = 200, {}, self.calls
+        elif path == "/_progress":
+            self.release()
+            status, headers, result = 200, {}, {
+                "released": self.next_update_id - 1, "remaining": len(self.pending), "skipped": self.skipped
+            }
+        elif path.startswith("/bot"):
+            status, headers, result = 200, {}, await self.bot_api(path.rsplit("/", 1)[-1], self.params(body))
+        elif path.startswith("/mailtm/"):
+            authorization = dict(scope["headers"]).get(b"authorization", b"").decode()
+            status, headers, result = await self.mail_call(
+                "mailtm", scope["method"], path[len("/mailtm"):], body, query, authorization
+            )
+        elif path.startswith("/privatix/"):
+            status, headers, result = await self.mail_call("privatix", "GET", path[len("/privatix"):], body, query)
+        else:
+            status, headers, result = 404, {}, None
+        payload = b"" if result is None else json.dumps(result).encode()
+        raw_headers = [(b"content-type", b"application/json")] + [(k.encode(), v.encode()) for k, v in headers.items()]
+        await send({"type": "http.response.start", "status": status, "headers": raw_headers})
+        await send({"type": "http.response.body", "body": payload})
+
+    @staticmethod
+    def params(body):
+        if not body:
+            return {}
+        try:
+            return json.loads(body)
+        except ValueError:
+            return {key: values[0] for key, values in parse_qs(body.decode()).items()}
+
+    def count(self, service, endpoint):
+        calls = self.calls.setdefault(service, {})
+        calls[endpoint] = calls.get(endpoint, 0) + 1
+
+    async def bot_api(self, method, params):
+        if method == "getUpdates":
+            return await self.get_updates(int(params.get("offset") or 0), int(params.get("limit") or 100),
+                                          float(params.get("timeout") or 0))
+        self.count("telegram", method)
+        await asyncio.sleep(self.telegram_latency)
+        if method == "getMe":
+            return {"ok": True, "result": {"id": 1, "is_bot": True, "first_name": "Bench", "username": "bench_bot"}}
+        if method in ("sendMessage", "editMessageText", "sendDocument"):
+            chat_id = int(params.get("chat_id") or 1)
+            if method == "editMessageText" and params.get("message_id"):
+                message_id = int(params["message_id"])
+            else:
+                self.message_ids += 1
+                message_id = self.message_ids
+            self.record(chat_id, message_id, params)
+            return {"ok": True, "result": {
+                "message_id": message_id, "date": int(time.time()),
+                "chat": {"id": chat_id, "type": "private"}, "text": params.get("text", ""),
+            }}
+        return {"ok": True, "result": True}
+
+    def record(self, chat_id, message_id, params):
+        markup = params.get("reply_markup") or {}
+        if isinstance(markup, str):
+            markup = json.loads(markup)
+        callbacks = [
+            button["callback_data"] for row in markup.get("inline_keyboard", []) for button in row
+            if "callback_data" in button
+        ]
+        self.sequence += 1
+        sent = self.sent.setdefault(chat_id, [])
+        sent.append((self.sequence, message_id, params.get("text", ""), callbacks))
+        del sent[:-10]
+
+    async def get_updates(self, offset, limit, timeout):
+        if self.started is None:
+            self.started = time.monotonic()
+        # Everything below the offset was confirmed by the bot.
+        while self.served and self.served[0]["update_id"] < offset:
+            self.served.pop(0)
+        deadline = time.monotonic() + timeout
+        while True:
+            self.release()
+            if self.served or time.monotonic() >= deadline:
+                break
+            await asyncio.sleep(0.005)
+        return {"ok": True, "result": self.served[:limit]}
+
+    def release(self):
+        """Turns the pending actions that are due (and whose reply dependency is met) into updates."""
+        if self.started is None:
+            return
+        now = time.monotonic()
+        # Actions are offered in index order; with no rate they are all due at once.
+        due = int((now - self.started) * self.rate) + 1 if self.rate else float("inf")
+        blocked, still_pending = set(), []
+        for position, (index, user_id, action) in enumerate(self.pending):
+            if index >= due:
+                still_pending.extend(self.pending[position:])
+                break
+            if user_id in blocked:
+                still_pending.append((index, user_id, action))
+                continue
+            update = self.resolve(user_id, action)
+            if update is None:
+                waiting_since = self.waiting_since.setdefault(index, now)
+                if now - waiting_since < DEPENDENCY_TIMEOUT:
+                    # Keeps the user's later actions behind this one.
+                    blocked.add(user_id)
+                    still_pending.append((index, user_id, action))
+                    continue
+                self.skipped += 1
+            else:
+                self.served.append(update)
+            self.waiting_since.pop(index, None)
+            self.asked_at[user_id] = self.sequence
+        self.pending = still_pending
+
+    def resolve(self, user_id, action):
+        kind = action[0]
+        if kind == "text":
+            update = make_update(self.next_update_id, user_id, "text", action[1])
+        else:
+            # Only the bot's answers to the user's previous action count.
+            answers = [sent for sent in self.sent.get(user_id, []) if sent[0] > self.asked_at.get(user_id, 0)]
+            update = None
+            for _, message_id, text, callbacks in reversed(answers):
+                if kind == "tap":
+                    data = next((data for data in callbacks if data.startswith(action[1])), None)
+                    if data is not None:
+                        update = make_update(self.next_update_id, user_id, "tap", data, message_id)
+                        break
+                else:
+                    match = re.search(action[2], text)
+                    if match:
+                        update = make_update(self.next_update_id, user_id, "text", action[1].format(match.group(1)))
+                        break
+            if update is None:
+                return None
+        self.next_update_id += 1
+        return update
+
+    async def mail_call(self, service, method, path, body, query, authorization=None):
+        segments = [segment for segment in path.split("/") if segment]
+        endpoint = f"{method} /" + "/".join(segments[:-1] + ["{id}"] if self.has_id(service, segments) else segments)
+        self.count(service, endpoint)
+        degraded = service == self.degrade
+        await asyncio.sleep(self.mail_latency + (self.degraded_latency if degraded else 0))
+        if random.random() < self.error_rate or (degraded and random.random() < self.degraded_error_rate):
+            return 500, {}, {"error": "injected failure"}
+        if service == "mailtm":
+            return self.mailtm(method, segments, body, query, authorization)
+        return self.privatix(segments)
+
+    @staticmethod
+    def has_id(service, segments):
+        if service == "mailtm":
+            return len(segments) == 2
+        return len(segments) >= 3 and segments[-2] == "id"
+
+    def mailtm(self, method, segments, body, query, authorization):
+        if segments == ["domains"]:
+            return 200, {}, {"hydra:member": [{"domain": "bench.test", "isActive": True}]}
+        if segments == ["accounts"] and method == "POST":
+            address = self.params(body)["address"]
+            account = self.addresses.setdefault(address, len(self.addresses) + 1)
+            return 201, {}, {"id": f"{account:024x}", "address": address}
+        if segments == ["token"]:
+            address = self.params(body)["address"]
+            return 200, {}, {"token": fake_token(self.addresses.setdefault(address, len(self.addresses) + 1))}
+        if segments[0] == "accounts" and method == "DELETE":
+            return 204, {}, None
+        if segments == ["messages"]:
+            account = token_account(authorization)
+            page = int((query.get("page") or ["1"])[0])
+            ids = range((page - 1) * MAILTM_PAGE_SIZE, min(page * MAILTM_PAGE_SIZE, self.inbox_size))
+            return 200, {}, {
+                "hydra:member": [self.mailtm_message(account, i) for i in ids], "hydra:totalItems": self.inbox_size
+            }
+        if segments[0] == "messages":
+            message = self.mailtm_message(int(segments[1][:12], 16), int(segments[1][12:], 16))
+            message.update({"text": self.body, "html": [f"<p>{self.body}</p>"]})
+            return 200, {}, message
+        return 404, {}, None
+
+    @staticmethod
+    def mailtm_message(account, i):
+        return {
+            "id": f"{account:012x}{i:012x}", "from": {"address": f"sender{i}@example.com", "name": f"Sender {i}"},
+            "subject": f"Subject {i}", "intro": f"Your code is {100000 + i}", "seen": False,
+            "createdAt": "2024-01-01T00:00:00+00:00",
+        }
+
+    def privatix(self, segments):
+        if self.quota <= 0:
+            return 429, {"x-ratelimit-requests-remaining": "0", "x-ratelimit-requests-reset": str(self.quota_reset)}, None
+        self.quota -= 1
+        headers = {"x-ratelimit-requests-remaining": str(self.quota), "x-ratelimit-requests-reset": str(self.quota_reset)}
+        if segments == ["request", "domains"]:
+            return 200, headers, ["@bench.test"]
+        if segments[:3] == ["request", "mail", "id"]:
+            if not self.inbox_size:
+                return 200, headers, {"error": "There are no emails yet"}
+            return 200, headers, [
+                {"mail_id": f"{segments[3][:16]}{i:08x}", "mail_subject": f"Subject {i}", "mail_from": f"sender{i}@example.com"}
+                for i in range(self.inbox_size)
+            ]
+        if segments[:2] == ["request", "id"]:
+            return 200, headers, {
+                "mail_id": segments[2], "mail_subject": "Subject", "mail_from": "sender@example.com",
+                "mail_text_only": self.body, "createdAt": {"milliseconds": 0},
+            }
+        if segments[:3] == ["request", "delete", "id"]:
+            return 200, headers, {"result": "success"}
+        return 404, headers, None
+
+
+def serve_backends(port, backends):
+    uvicorn.run(backends, host="127.0.0.1", port=port, lifespan="off", log_level="error")
+
+
+def build_actions(bot, users, inbox_size):
+    """Returns (user_id, action) for every user and step, interleaved step by step."""
+    return [(1000 + user_id, action) for action in script_for(bot, inbox_size) for user_id in range(1, users + 1)]
+
+
+def run_bot(bot, api_url, background_jobs, timeout, verbose, results):
+    """Child process: runs the bot's own main() against the fake servers until every action is handled."""
+    os.chdir(tempfile.mkdtemp(prefix=f"load_test_{bot}_"))
+    os.environ.update({
+        "TELEGRAM_API_URL": f"{api_url}/bot",
+        "MAILTM_API_URL": f"{api_url}/mailtm",
+        "RAPIDAPI_BASE_URL": f"{api_url}/privatix",
+        # Enables bot.py's and i.py's fallback provider.
+        "RAPIDAPI_KEY": "bench-key",
+        "METRICS_PORT": "0",
+        "RUN_BACKGROUND_JOBS": "1" if background_jobs else "0",
+    })
+    os.environ.pop("WEBHOOK_URL", None)
+    module = __import__(bot)
+    import httpx
+    import metrics
+    logging.getLogger().setLevel(logging.INFO if verbose else logging.CRITICAL)
+
+    captured = []
+    module.run_application = lambda application, **kwargs: captured.append(application)
+    module.main()
+    application = captured[0]
+
+    async def drive():
+        async with application:
+            if application.post_init:
+                await application.post_init(application)
+            await application.updater.start_polling(poll_interval=0, timeout=1)
+            await application.start()
+            started = time.perf_counter()
+            processor = application.update_processor
+            timed_out = False
+            async with httpx.AsyncClient(base_url=api_url) as client:
+                while True:
+                    await asyncio.sleep(0.05)
+                    progress = (await client.get("/_progress")).json()
+                    if not progress["remaining"] and processor.processed >= progress["released"]:
+                        break
+                    if time.perf_counter() - started > timeout:
+                        timed_out = True
+                        break
+            elapsed = time.perf_counter() - started
+            await application.updater.stop()
+            await application.stop()
+        if application.post_shutdown:
+            await application.post_shutdown(application)
+        return elapsed, processor.processed, timed_out, processor.stats(), progress["skipped"]
+
+    elapsed, processed, timed_out, processor_stats, skipped = asyncio.run(drive())
+    latency = metrics.HANDLER_SECONDS.total()
+    handlers = {
+        label: {"calls": calls, "failed": failed, "p50_ms": ms(p50), "p95_ms": ms(p95), "p99_ms": ms(p99)}
+        for label, calls, failed, p50, p95, p99 in metrics.latency_summary(
+            metrics.HANDLER_SECONDS, metrics.HANDLER_ERRORS, limit=None
+        )
+    }
+    results.put({
+        "updates": processed,
+        "timed_out": timed_out,
+        "skipped_actions": skipped,
+        "seconds": round(elapsed, 3),
+        "updates_per_second": round(processed / elapsed, 1),
+        "handler_p50_ms": ms(latency.percentile(0.50)),
+        "handler_p95_ms": ms(latency.percentile(0.95)),
+        "handler_p99_ms": ms(latency.percentile(0.99)),
+        "handler_failures": sum(counter.value for counter in metrics.HANDLER_ERRORS.children.values()),
+        "queue_wait_p50_ms": ms(processor_stats["wait_p50"]),
+        "queue_wait_p95_ms": ms(processor_stats["wait_p95"]),
+        "handlers": handlers,
+        # ru_maxrss is in KB on Linux.
+        "peak_rss_mb": round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1),
+    })
+
+
+def ms(seconds):
+    return round(seconds * 1000, 2)
+
+
+def run_scenario(bot, args):
+    actions = build_actions(bot, args.users, args.inbox_size)
+    backends = FakeBackends(
+        actions, args.rate, args.telegram_latency, args.mail_latency, args.error_rate,
+        args.inbox_size, args.body_size, args.rapidapi_quota, args.rapidapi_reset,
+        args.degrade, args.degraded_latency, args.degraded_error_rate,
+    )
+    port = free_port()
+    server = multiprocessing.Process(target=serve_backends, args=(port, backends), daemon=True)
+    server.start()
+    wait_for_port(port)
+    api_url = f"http://127.0.0.1:{port}"
+
+    # A fresh interpreter per bot, so module state and peak RSS don't carry over.
+    context = multiprocessing.get_context("spawn")
+    results = context.Queue()
+    child = context.Process(
+        target=run_bot, args=(bot, api_url, args.background_jobs, args.timeout, args.verbose, results)
+    )
+    child.start()
+    result = results.get()
+    child.join()
+
+    import httpx
+    calls = httpx.get(f"{api_url}/_stats").json()
+    server.terminate()
+    mail_calls = sum(n for service, endpoints in calls.items() if service != "telegram" for n in endpoints.values())
+    result.update({
+        "upstream_calls": calls,
+        "upstream_calls_per_update": round(mail_calls / max(result["updates"], 1), 3),
+        "telegram_calls_per_update": round(sum(calls.get("telegram", {}).values()) / max(result["updates"], 1), 3),
+    })
+    return {"bot": bot, "users": args.users, "actions_per_user": len(actions) // args.users, **result}
+
+
+def git_commit():
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], cwd=ROOT, capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(baseline, current, max_regression):
+    """Returns the per-bot changes of the COMPARED numbers and whether any regressed beyond `max_regression`."""
+    before = {result["bot"]: result for result in baseline["results"]}
+    changes, regressed = {}, False
+    for result in current["results"]:
+        old = before.get(result["bot"])
+        if old is None:
+            continue
+        changes[result["bot"]] = {}
+        for key, higher_is_better in COMPARED.items():
+            if not old.get(key):
+                continue
+            change = (result[key] - old[key]) / old[key]
+            worse = -change if higher_is_better else change
+            regressed = regressed or worse > max_regression
+            changes[result["bot"]][key] = {"before": old[key], "after": result[key], "change": round(change, 3)}
+    return changes, regressed
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--bots", nargs="+", choices=BOTS, default=list(BOTS))
+    parser.add_argument("--users", type=int, default=200)
+    parser.add_argument("--rate", type=float, default=0, help="updates/s offered; 0 sends everything at once")
+    parser.add_argument("--telegram-latency", type=float, default=0.0)
+    parser.add_argument("--mail-latency", type=float, default=0.02)
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    parser.add_argument("--degrade", choices=("mailtm", "privatix"),
+                        help="mail service given --degraded-latency and --degraded-error-rate on top")
+    parser.add_argument("--degraded-latency", type=float, default=0.0)
+    parser.add_argument("--degraded-error-rate", type=float, default=0.0)
+    parser.add_argument("--inbox-size", type=int, default=8)
+    parser.add_argument("--body-size", type=int, default=2000)
+    parser.add_argument("--rapidapi-quota", type=int, default=100_000,
+                        help="requests the fake RapidAPI has left until --rapidapi-reset; each call spends one")
+    parser.add_argument("--rapidapi-reset", type=float, default=30 * 24 * 3600,
+                        help="seconds until the fake RapidAPI quota resets (a monthly plan by default)")
+    parser.add_argument("--background-jobs", action="store_true",
+                        help="also run bot.py's poller and account pool (their calls are counted too)")
+    parser.add_argument("--timeout", type=float, default=300)
+    parser.add_argument("--output")
+    parser.add_argument("--compare")
+    parser.add_argument("--max-regression", type=float, default=0.10)
+    parser.add_argument("--verbose", action="store_true")
+    args = parser.parse_args()
+
+    report = {
+        "commit": git_commit(),
+        "params": {key: value for key, value in vars(args).items() if key not in ("output", "compare", "verbose")},
+        "results": [run_scenario(bot, args) for bot in args.bots],
+    }
+    regressed = False
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        report["changes"], regressed = compare(baseline, report, args.max_regression)
+        ignored = ("bots", "max_regression", "timeout")
+        if {k: v for k, v in baseline["params"].items() if k not in ignored} != \
+                {k: v for k, v in report["params"].items() if k not in ignored}:
+            report["params_differ_from_baseline"] = True
+    output = json.dumps(report, indent=2, ensure_ascii=False)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(output + "\n")
+    print(output)
+    sys.exit(1 if regressed else 0)
+
+
+if __name__ == "__main__":
+    main()
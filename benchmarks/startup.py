@@ -0,0 +1,66 @@
+# benchmarks/startup.py
+#
+# Measures bot.py's account-store cold start for growing user counts.
+# Usage: python benchmarks/startup.py [user_count ...]
+
+import json
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from account_store import LazyAccountMap, SqliteAccountStore
+from mailtm_client import Account
+
+DEFAULT_USER_COUNTS = [1_000, 10_000, 100_000]
+
+
+def populate(path, user_count):
+    """Writes `user_count` synthetic accounts in one batch."""
+    store = SqliteAccountStore(path)
+    store._write_batch({
+        user_id: {'id': f"id{user_id:024x}", 'address': f"user{user_id}@example.com", 'password': "p" * 12}
+        for user_id in range(1, user_count + 1)
+    })
+    store._conn.close()
+    store._reader.close()
+
+
+def measure(path, user_count):
+    started = time.perf_counter()
+    store = SqliteAccountStore(path)
+    accounts = LazyAccountMap(store, Account.from_dict, Account.to_dict)
+    boot = time.perf_counter() - started
+
+    started = time.perf_counter()
+    accounts[user_count // 2]
+    first_lookup = time.perf_counter() - started
+
+    started = time.perf_counter()
+    {user_id: Account.from_dict(record) for user_id, record in store.load_all().items()}
+    eager = time.perf_counter() - started
+    store._conn.close()
+    store._reader.close()
+    return {
+        'users': user_count,
+        'boot_ms': round(boot * 1000, 3),
+        'first_lookup_ms': round(first_lookup * 1000, 3),
+        'eager_load_ms': round(eager * 1000, 3),
+    }
+
+
+def main():
+    user_counts = [int(arg) for arg in sys.argv[1:]] or DEFAULT_USER_COUNTS
+    results = []
+    with tempfile.TemporaryDirectory() as tmp:
+        for user_count in user_counts:
+            path = os.path.join(tmp, f"accounts-{user_count}.sqlite3")
+            populate(path, user_count)
+            results.append(measure(path, user_count))
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == "__main__":
+    main()
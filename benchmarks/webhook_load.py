@@ -0,0 +1,239 @@
+# benchmarks/webhook_load.py
+#
+# Sustained update ingestion: long polling against a local fake Bot API versus
+# the built-in webhook receiver, both feeding a no-op handler.
+# Usage: python benchmarks/webhook_load.py [update_count] [--rtt SECONDS] [--connections N]
+#
+# --rtt adds simulated network latency to every getUpdates call and every
+# webhook delivery; --connections is the number of parallel webhook deliveries
+# (Telegram's max_connections). The fake Bot API and the webhook sender run in
+# their own processes, so only the bot's side is measured in this one.
+
+import argparse
+import asyncio
+import json
+import multiprocessing
+import os
+import socket
+import statistics
+import sys
+import time
+from urllib.parse import parse_qs
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import uvicorn
+from telegram.ext import Application, MessageHandler, filters
+
+from webhook import WebhookReceiver, bounded_update_queue
+
+TOKEN = "123456:benchmark"
+SECRET = "benchmark-secret"
+
+
+def make_update(update_id):
+    # The send time travels in the text, so latency can be measured across processes
+    # (time.perf_counter() is the system-wide monotonic clock on Linux).
+    return {
+        "update_id": update_id,
+        "message": {
+            "message_id": update_id, "date": 0, "text": repr(time.perf_counter()),
+            "chat": {"id": update_id % 1000 + 1, "type": "private"},
+            "from": {"id": update_id % 1000 + 1, "is_bot": False, "first_name": "Bench"},
+        },
+    }
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def wait_for_port(port, timeout=10.0):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            socket.create_connection(("127.0.0.1", port), timeout=0.1).close()
+            return
+        except OSError:
+            time.sleep(0.02)
+    raise RuntimeError(f"Nothing listening on port {port}")
+
+
+class FakeBotApi:
+    """ASGI stand-in for the Bot API methods the bot needs, serving `update_count` updates."""
+
+    def __init__(self, update_count, rtt):
+        self.update_count = update_count
+        self.rtt = rtt
+
+    async def __call__(self, scope, receive, send):
+        body = b""
+        while True:
+            message = await receive()
+            body += message.get("body", b"")
+            if not message.get("more_body"):
+                break
+        method = scope["path"].rsplit("/", 1)[-1]
+        try:
+            params = json.loads(body) if body else {}
+        except ValueError:
+            params = {key: values[0] for key, values in parse_qs(body.decode()).items()}
+        if method == "getMe":
+            result = {"id": 1, "is_bot": True, "first_name": "Bench", "username": "bench_bot"}
+        elif method == "getUpdates":
+            result = await self.get_updates(int(params.get("offset") or 1), int(params.get("limit") or 100))
+        else:
+            result = True
+        payload = json.dumps({"ok": True, "result": result}).encode()
+        await send({"type": "http.response.start", "status": 200, "headers": [(b"content-type", b"application/json")]})
+        await send({"type": "http.response.body", "body": payload})
+
+    async def get_updates(self, offset, limit):
+        await asyncio.sleep(self.rtt)
+        last = min(offset + limit - 1, self.update_count)
+        if offset > last:
+            await asyncio.sleep(0.05)
+            return []
+        return [make_update(update_id) for update_id in range(offset, last + 1)]
+
+
+def serve_fake_api(port, update_count, rtt):
+    uvicorn.run(FakeBotApi(update_count, rtt), host="127.0.0.1", port=port, lifespan="off", log_level="error")
+
+
+def send_updates(port, update_count, rtt, connections, results):
+    """Plays Telegram: posts every update to the receiver over `connections` parallel keep-alive connections.
+
+    Uses bare asyncio streams rather than an HTTP client library, so the sender
+    stays cheap next to the receiver being measured.
+    """
+    async def deliver(pending, statuses):
+        reader, writer = await asyncio.open_connection("127.0.0.1", port)
+        for update_id in pending:
+            while True:
+                await asyncio.sleep(rtt)
+                body = json.dumps(make_update(update_id)).encode()
+                writer.write(
+                    b"POST /webhook HTTP/1.1\r\nHost: 127.0.0.1\r\nContent-Type: application/json\r\n"
+                    b"X-Telegram-Bot-Api-Secret-Token: " + SECRET.encode() + b"\r\n"
+                    b"Content-Length: " + str(len(body)).encode() + b"\r\n\r\n" + body
+                )
+                head = await reader.readuntil(b"\r\n\r\n")
+                status = int(head.split(b" ", 2)[1])
+                length = next((int(line.split(b":")[1]) for line in head.split(b"\r\n")
+                               if line.lower().startswith(b"content-length:")), 0)
+                await reader.readexactly(length)
+                statuses[status] = statuses.get(status, 0) + 1
+                if status == 200:
+                    break
+        writer.close()
+
+    async def run():
+        pending = iter(range(1, update_count + 1))
+        statuses = {}
+        await asyncio.gather(*(deliver(pending, statuses) for _ in range(connections)))
+        return statuses
+
+    results.put(asyncio.run(run()))
+
+
+def build_application(update_count, latencies, done, api_port):
+    async def record(update, context):
+        latencies.append(time.perf_counter() - float(update.message.text))
+        if len(latencies) == update_count:
+            done.set()
+
+    application = (
+        Application.builder().token(TOKEN).update_queue(bounded_update_queue())
+        .base_url(f"http://127.0.0.1:{api_port}/bot").build()
+    )
+    application.add_handler(MessageHandler(filters.ALL, record))
+    return application
+
+
+def summarize(mode, update_count, elapsed, latencies, extra=None):
+    latencies = sorted(latencies)
+    result = {
+        "mode": mode,
+        "updates": update_count,
+        "seconds": round(elapsed, 3),
+        "updates_per_second": round(update_count / elapsed, 1),
+        "latency_p50_ms": round(statistics.median(latencies) * 1000, 2),
+        "latency_p99_ms": round(latencies[int(len(latencies) * 0.99) - 1] * 1000, 2),
+    }
+    result.update(extra or {})
+    return result
+
+
+def start_fake_api(update_count, rtt):
+    port = free_port()
+    process = multiprocessing.Process(target=serve_fake_api, args=(port, update_count, rtt), daemon=True)
+    process.start()
+    wait_for_port(port)
+    return port, process
+
+
+async def run_polling(update_count, rtt):
+    latencies, done = [], asyncio.Event()
+    api_port, api_process = start_fake_api(update_count, rtt)
+    application = build_application(update_count, latencies, done, api_port)
+    async with application:
+        started = time.perf_counter()
+        await application.updater.start_polling(poll_interval=0, timeout=1)
+        await application.start()
+        await done.wait()
+        elapsed = time.perf_counter() - started
+        await application.updater.stop()
+        await application.stop()
+    api_process.terminate()
+    return summarize("polling", update_count, elapsed, latencies)
+
+
+async def run_webhook(update_count, rtt, connections):
+    latencies, done = [], asyncio.Event()
+    # The fake Bot API only answers getMe here; updates arrive through the receiver.
+    api_port, api_process = start_fake_api(0, 0)
+    application = build_application(update_count, latencies, done, api_port)
+    port = free_port()
+    receiver = WebhookReceiver(application.bot, application.update_queue, path="/webhook", secret_token=SECRET)
+    server = uvicorn.Server(uvicorn.Config(
+        receiver, host="127.0.0.1", port=port, lifespan="off", log_level="error", access_log=False
+    ))
+    server_task = asyncio.create_task(server.serve())
+    while not server.started:
+        await asyncio.sleep(0.01)
+    results = multiprocessing.Queue()
+    sender = multiprocessing.Process(target=send_updates, args=(port, update_count, rtt, connections, results))
+    async with application:
+        await application.start()
+        started = time.perf_counter()
+        sender.start()
+        await done.wait()
+        elapsed = time.perf_counter() - started
+        await application.stop()
+    statuses = await asyncio.to_thread(results.get)
+    sender.join()
+    server.should_exit = True
+    await server_task
+    api_process.terminate()
+    return summarize("webhook", update_count, elapsed, latencies,
+                     {"connections": connections, "responses": statuses})
+
+
+async def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("update_count", type=int, nargs="?", default=5000)
+    parser.add_argument("--rtt", type=float, default=0.0)
+    parser.add_argument("--connections", type=int, default=40)
+    args = parser.parse_args()
+    results = [
+        await run_polling(args.update_count, args.rtt),
+        await run_webhook(args.update_count, args.rtt, args.connections),
+    ]
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
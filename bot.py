@@ -1,9 +1,35 @@
 # telegram_bot.py
 
+import asyncio
+import html
 import logging
-import json
 import os
-from pymailtm import MailTm, Account
+import time
+from urllib.parse import urlsplit
+from account_pool import AccountPool
+from account_store import FLUSH_INTERVAL, LazyAccountMap, SqliteAccountStore
+from broadcast import BroadcastEngine
+from cache import ByteBudgetCache
+from coalesce import SingleFlight, TapDebouncer
+from delivery import send_html
+from extract import extract
+from mailtm_client import Account, MailTmClient, Message
+from metrics import (
+    HANDLER_ERRORS,
+    HANDLER_SECONDS,
+    UPSTREAM_ERRORS,
+    UPSTREAM_SECONDS,
+    instrument_application,
+    latency_summary,
+    start_metrics_server,
+    stop_metrics_server,
+)
+from poller import InboxPoller
+from providers import MailTmProvider, PrivatixProvider, ProviderError, ProviderRouter
+from rapidapi_client import RapidApiClient
+from state_backend import StateNamespace, open_state_backend
+from stream import StreamMultiplexer
+from sweeper import AccountSweeper
 from telegram import Update, ReplyKeyboardMarkup, KeyboardButton, ReplyKeyboardRemove, InlineKeyboardButton, InlineKeyboardMarkup
 from telegram.ext import (
     Application,
@@ -13,6 +39,9 @@ from telegram.ext import (
     filters,
     CallbackQueryHandler
 )
+from update_processor import KeyedUpdateProcessor
+from user_export import EXPORT_FORMATS, export_users
+from webhook import bounded_update_queue, run_application
 
 # --- Configuration ---
 # Replace this with your bot token provided by BotFather.
@@ -22,61 +51,327 @@ BOT_TOKEN = "8444165710:AAGdrrL7rxdBudCf1amuFldtcYQ1KSFySIE"
 # This ID will be used to grant access to the admin panel.
 ADMIN_ID = 6994528708 # TODO: Change this to your actual user ID
 
+# Bot API server. Override to use a self-hosted Bot API server or a local test server.
+TELEGRAM_API_URL = os.environ.get("TELEGRAM_API_URL", "https://api.telegram.org/bot")
+
 # File to store user accounts
+STORE_FILE = "accounts.sqlite3"
+
+# Legacy JSON file, imported into STORE_FILE on first start
 DB_FILE = "db.json"
 
+# Cached mail.tm domain list, so a cold start doesn't wait on it
+DOMAINS_FILE = "mailtm_domains.json"
+
+# Fallback mail provider (privatix on RapidAPI): new addresses are created there
+# while mail.tm is slow or failing. Leave RAPIDAPI_KEY empty to use mail.tm only
+RAPIDAPI_KEY = os.environ.get("RAPIDAPI_KEY", "")
+RAPIDAPI_HOST = os.environ.get("RAPIDAPI_HOST", "privatix-temp-mail-v1.p.rapidapi.com")
+RAPIDAPI_BASE_URL = os.environ.get("RAPIDAPI_BASE_URL", f"https://{RAPIDAPI_HOST}")
+PRIVATIX_DOMAINS_FILE = "privatix_domains.json"
+
+# Memory budget and lifetimes for cached inbox previews and message bodies
+INBOX_CACHE_MAX_BYTES = 64 * 1024 * 1024
+INBOX_PREVIEW_TTL = 30 * 60
+MESSAGE_BODY_TTL = 10 * 60
+
+# Messages shown per page of the inbox view
+INBOX_PAGE_SIZE = 5
+
+# Users shown per page of /get_all_users
+USERS_PAGE_SIZE = 20
+
+# Pre-created accounts kept ready for "Generate New Email", the level at
+# which the pool is refilled, and how long a pooled account stays usable
+ACCOUNT_POOL_SIZE = 20
+ACCOUNT_POOL_LOW_WATERMARK = 5
+ACCOUNT_POOL_MAX_AGE = 6 * 60 * 60
+
+# Background sweep of the least recently active accounts: every SWEEP_INTERVAL
+# seconds up to SWEEP_BATCH_SIZE accounts nobody used for SWEEP_RECHECK_AFTER
+# seconds are checked on mail.tm, SWEEP_CONCURRENCY at a time. Expired accounts,
+# and accounts idle for IDLE_ACCOUNT_TTL, are deleted. Sweeping pauses while more
+# than SWEEP_PAUSE_ACTIVE_USERS users have updates in progress
+SWEEP_INTERVAL = 60
+SWEEP_BATCH_SIZE = 30
+SWEEP_CONCURRENCY = 3
+SWEEP_RECHECK_AFTER = 24 * 60 * 60
+IDLE_ACCOUNT_TTL = 30 * 24 * 60 * 60
+SWEEP_PAUSE_ACTIVE_USERS = 20
+
+# Background inbox polls wait while more than this many users have updates in progress
+POLL_PAUSE_ACTIVE_USERS = 50
+
+# Status answers from cached message counts up to this many seconds old
+STATUS_MAX_AGE = 60
+INBOX_META_TTL = 24 * 60 * 60
+
+# Repeat taps of the same inline button within this many seconds are acknowledged but not handled again.
+# Only buttons that send content are debounced; paging and the like always go through
+CALLBACK_DEBOUNCE_WINDOW = 3.0
+DEBOUNCED_CALLBACKS = ("read_email_", "confirm_new_email")
+
+# Where caches and locks live: "memory" keeps them in this process, "sqlite" shares
+# them through STATE_FILE with other worker processes serving the same token
+STATE_BACKEND = os.environ.get("STATE_BACKEND", "memory")
+STATE_FILE = os.environ.get("STATE_FILE", "state.sqlite3")
+
+# Exactly one worker should run the inbox poller, event streams, broadcast resume
+# and account pool; set RUN_BACKGROUND_JOBS=0 on every other worker
+RUN_BACKGROUND_JOBS = os.environ.get("RUN_BACKGROUND_JOBS", "1") == "1"
+
+# How often the background worker picks up accounts created by other workers
+TRACK_REQUESTS_INTERVAL = 2
+
 # Enable logging for a better understanding of the bot's behavior
 logging.basicConfig(
     format="%(asctime)s - %(name)s - %(levelname)s - %(message)s", level=logging.INFO
 )
 logging.getLogger("httpx").setLevel(logging.WARNING)
 
-# A simple in-memory dictionary to store user data.
-# This will be loaded from and saved to the DB_FILE.
-# The structure will be: {telegram_user_id: MailTm.Account}
+# A dictionary-like view of the user data in STORE_FILE; see load_accounts().
+# The structure will be: {telegram_user_id: mailtm_client.Account}
 user_accounts = {}
-# Dictionary to store message details temporarily for full view
-# Structure: {user_id: {message_id: message_object}}
-user_inbox_cache = {}
+# Caches and locks, in this process or shared with the other workers (see STATE_BACKEND).
+state_backend = open_state_backend(STATE_BACKEND, STATE_FILE)
+SHARED_STATE = STATE_BACKEND != "memory"
 
-# --- Data Persistence Helpers ---
+# Shared, size-bounded cache of inbox data. Entries:
+#   ("inbox", user_id) -> {message_id: preview Message}   (kept hot)
+#   ("body", message_id) -> full Message                  (evicted first)
+#   ("codes", message_id) -> codes and links found in it (see extract_codes)
+#   ("meta", user_id) -> message count, unread count and when they were checked
+if SHARED_STATE:
+    user_inbox_cache = StateNamespace(
+        state_backend, "inbox_cache", ttl=INBOX_PREVIEW_TTL, max_bytes=INBOX_CACHE_MAX_BYTES,
+        encode=lambda value: encode_cached(value), decode=lambda data: decode_cached(data)
+    )
+else:
+    user_inbox_cache = ByteBudgetCache(INBOX_CACHE_MAX_BYTES, ttl=INBOX_PREVIEW_TTL)
 
-def save_accounts():
-    """Saves the user_accounts dictionary to a JSON file."""
-    # We can't directly serialize the MailTm.Account object, so we convert it to a dictionary.
-    data_to_save = {
-        user_id: {
-            'id': account.id_,
-            'address': account.address,
-            'password': account.password
-        } for user_id, account in user_accounts.items()
-    }
-    with open(DB_FILE, 'w') as f:
-        json.dump(data_to_save, f, indent=4)
-    logging.info("User accounts saved to file.")
+# Upstream reads in flight, keyed ("list", user_id) or ("body", message_id), so
+# concurrent Inbox/Status/Read requests for the same data share one call.
+inflight = SingleFlight()
+
+# Recent inline-button taps, so impatient repeat taps don't re-send the same content.
+tap_debouncer = TapDebouncer(CALLBACK_DEBOUNCE_WINDOW)
+
+# Background upstream deletions of pruned accounts, referenced until they finish.
+upstream_deletions = set()
+
+# Runs different users' updates concurrently and each user's updates in order.
+update_processor = KeyedUpdateProcessor()
+
+# Local Prometheus endpoint, started in post_init (see metrics.METRICS_PORT).
+metrics_server = None
+
+# Shared asyncio mail.tm client. All handlers go through its connection pool.
+# Refreshed tokens are written back to the store so restarts don't log in again.
+mail_client = MailTmClient(
+    on_token_refresh=lambda account: user_accounts.save_value(account),
+    domain_cache_file=DOMAINS_FILE
+)
+
+# Mail providers in order of preference. Account creation is hedged across them and fails
+# over when one keeps failing; everything else goes to the provider the address lives on.
+mail_router = ProviderRouter(
+    [MailTmProvider(mail_client)] + (
+        [PrivatixProvider(RapidApiClient(RAPIDAPI_KEY, RAPIDAPI_HOST, base_url=RAPIDAPI_BASE_URL), PRIVATIX_DOMAINS_FILE)]
+        if RAPIDAPI_KEY else []
+    )
+)
+
+# Persistent account store. Changes are queued per user and flushed in batches;
+# with shared state they are flushed right away so other workers see them.
+account_store = SqliteAccountStore(
+    STORE_FILE, legacy_json_file=DB_FILE, flush_interval=0 if SHARED_STATE else FLUSH_INTERVAL
+)
+
+# Warm pool of pre-created mail.tm accounts, saved in the account store across restarts.
+# Nobody waits on a refill, so it only asks mail.tm, without hedging.
+account_pool = AccountPool(
+    lambda: mail_router.create_account(hedged=False),
+    mail_router.delete_account,
+    Account.to_dict,
+    Account.from_dict,
+    store=account_store,
+    size=ACCOUNT_POOL_SIZE,
+    low_watermark=ACCOUNT_POOL_LOW_WATERMARK,
+    max_age=ACCOUNT_POOL_MAX_AGE
+)
+
+# Background inbox poller for new and recently active accounts (from the store's activity
+# index). New mail is pushed to users as it arrives.
+inbox_poller = InboxPoller(
+    mail_router,
+    lambda user_id: pollable_account(user_id),
+    lambda *args: notify_new_messages(*args),
+    on_poll=lambda user_id, messages: update_inbox_meta(user_id, messages),
+    recently_active=account_store.recently_active,
+    is_busy=lambda: update_processor.active_keys > POLL_PAUSE_ACTIVE_USERS
+)
+
+# Live mail.tm event streams for recently active users; the poller covers everyone else,
+# and every address on other providers.
+mail_streams = StreamMultiplexer(
+    mail_client, inbox_poller, lambda user_id: streamable_account(user_id), lambda *args: notify_new_messages(*args)
+)
+
+# Background broadcast runner. Its cursor is checkpointed in the account store.
+broadcast_engine = BroadcastEngine(
+    account_store, account_store.user_ids_after, on_blocked=lambda chat_id: prune_blocked_user(chat_id)
+)
+
+# Background sweeper that purges expired and long-idle accounts, least recently active first.
+account_sweeper = AccountSweeper(
+    account_store,
+    lambda user_id: user_accounts.get(user_id),
+    mail_router.account_exists,
+    lambda *args: purge_account(*args),
+    is_busy=lambda: update_processor.active_keys > SWEEP_PAUSE_ACTIVE_USERS,
+    interval=SWEEP_INTERVAL,
+    batch_size=SWEEP_BATCH_SIZE,
+    concurrency=SWEEP_CONCURRENCY,
+    recheck_after=SWEEP_RECHECK_AFTER,
+    idle_ttl=IDLE_ACCOUNT_TTL
+)
+
+# --- Data Persistence Helpers ---
 
 def load_accounts():
-    """Loads user accounts from a JSON file into the user_accounts dictionary."""
+    """Opens the account store. Accounts are decoded lazily, on each user's first update."""
     global user_accounts
-    if os.path.exists(DB_FILE):
-        with open(DB_FILE, 'r') as f:
-            try:
-                data = json.load(f)
-                # Reconstruct MailTm.Account objects from the saved data.
-                user_accounts = {
-                    int(user_id): Account(
-                        id=details['id'],
-                        address=details['address'],
-                        password=details['password']
-                    ) for user_id, details in data.items()
-                }
-                logging.info(f"Loaded {len(user_accounts)} user accounts from file.")
-            except (json.JSONDecodeError, KeyError) as e:
-                logging.error(f"Failed to load accounts from {DB_FILE}: {e}")
-                user_accounts = {}
+    # Reconstructing an Account from its record does not log in.
+    user_accounts = LazyAccountMap(account_store, Account.from_dict, Account.to_dict, shared=SHARED_STATE)
+    logging.info(f"Opened account store {STORE_FILE}.")
+
+def encode_cached(value):
+    """Encodes the Messages in cached values when the cache is shared between workers."""
+    if isinstance(value, Message):
+        return {'__message__': value.to_dict()}
+    raise TypeError(f"Can't cache {type(value).__name__}")
+
+def decode_cached(data):
+    return Message.from_dict(data['__message__']) if '__message__' in data else data
+
+async def create_user_account():
+    """Hands out a pre-created account when one is ready; creates one only if the pool is empty."""
+    # The pool lives in the background worker; other workers always create.
+    account = account_pool.pop() if RUN_BACKGROUND_JOBS else None
+    return account or await mail_router.create_account()
+
+def streamable_account(user_id):
+    """Returns the user's account if it is on mail.tm, the only provider with an event stream."""
+    account = user_accounts.get(user_id)
+    return account if account is not None and account.provider == MailTmProvider.name else None
+
+def pollable_account(user_id):
+    """Returns the user's account unless its provider charges for every call (privatix), which isn't polled."""
+    account = user_accounts.get(user_id)
+    return account if account is not None and not mail_router.is_metered(account) else None
+
+def account_is_gone(error):
+    """Whether an error from the mail provider says the account no longer exists, rather than that the provider is unwell."""
+    return isinstance(error, ProviderError) and not error.is_outage()
+
+def watch_account(user_id):
+    """Starts polling and streaming a new account's inbox, on whichever worker runs the background jobs."""
+    if RUN_BACKGROUND_JOBS:
+        inbox_poller.track(user_id)
+        mail_streams.subscribe(user_id)
     else:
-        logging.info("No existing user accounts file found.")
-        user_accounts = {}
+        state_backend.set("track_requests", str(user_id), "1")
+
+async def apply_track_requests(context: ContextTypes.DEFAULT_TYPE):
+    """Starts watching accounts that other workers created."""
+    for user_id in await state_backend.run(state_backend.drain, "track_requests"):
+        watch_account(int(user_id))
+
+def cache_messages(user_id, messages, replace=False):
+    """Caches messages: previews in the user's inbox entry, bodies (if fetched) separately so they can be dropped."""
+    previews = {} if replace else dict(user_inbox_cache.get(("inbox", user_id), {}))
+    for message in messages:
+        previews[message.id_] = message.preview()
+        extract_codes(message)
+        if message.text is not None or message.html is not None:
+            user_inbox_cache.set(("body", message.id_), message, ttl=MESSAGE_BODY_TTL, evict_first=True)
+    user_inbox_cache.set(("inbox", user_id), previews)
+
+async def get_message_body(user_id, message_id):
+    """Returns a full message from the user's inbox, fetching its body only on a cache miss."""
+    if message_id not in user_inbox_cache.get(("inbox", user_id), {}):
+        return None
+    message = user_inbox_cache.get(("body", message_id))
+    if message is None and user_id in user_accounts:
+        message = await inflight.do(("body", message_id), lambda: fetch_message_body(user_accounts[user_id], message_id))
+    return message
+
+async def fetch_message_body(account, message_id):
+    message = await mail_router.get_message(account, message_id)
+    user_inbox_cache.set(("body", message_id), message, ttl=MESSAGE_BODY_TTL, evict_first=True)
+    extract_codes(message)
+    return message
+
+def extract_codes(message):
+    """Finds a message's codes and verification links once, when it is first fetched.
+
+    A result taken from the preview alone is replaced once the body is fetched.
+    """
+    key = ("codes", message.id_)
+    has_body = message.text is not None or message.html is not None
+    found = user_inbox_cache.get(key)
+    if found is None or (has_body and found['partial']):
+        found = extract(message.subject, message.text if has_body else message.intro, message.html, partial=not has_body)
+        found['partial'] = not has_body
+        user_inbox_cache.set(key, found, ttl=INBOX_PREVIEW_TTL)
+    return found
+
+def format_codes(found, max_links=None):
+    """Formats the codes and links from extract_codes() as preview lines (empty if there are none)."""
+    lines = ""
+    if found['codes']:
+        lines += "🔑 <b>Code:</b> " + ", ".join(f"<code>{html.escape(code)}</code>" for code in found['codes']) + "\n"
+    for link in found['links'][:max_links]:
+        lines += f"🔗 <b>Link:</b> <a href=\"{html.escape(link)}\">{html.escape(urlsplit(link).netloc)}</a>\n"
+    return lines
+
+async def list_messages(user_id, account):
+    """Lists the account's inbox, sharing a listing already in flight for the same user."""
+    return await inflight.do(("list", user_id), lambda: mail_router.list_messages(account))
+
+def update_inbox_meta(user_id, messages, viewed=False):
+    """Records the message count of a freshly listed inbox, and how many arrived since the user last viewed it."""
+    meta = user_inbox_cache.get(("meta", user_id)) or {'seen_until': ""}
+    seen_until = meta['seen_until']
+    if viewed:
+        seen_until = max([seen_until] + [msg.created_at or "" for msg in messages])
+    meta = {
+        'count': getattr(messages, 'total', len(messages)),
+        'unread': sum(1 for msg in messages if (msg.created_at or "") > seen_until),
+        'checked_at': time.time(),
+        'seen_until': seen_until,
+    }
+    user_inbox_cache.set(("meta", user_id), meta, ttl=INBOX_META_TTL)
+    return meta
+
+def format_age(seconds):
+    """Formats an age in seconds as e.g. 'Just now', '42s ago' or '3m ago'."""
+    if seconds < 5:
+        return "Just now"
+    if seconds < 60:
+        return f"{int(seconds)}s ago"
+    if seconds < 3600:
+        return f"{int(seconds // 60)}m ago"
+    return f"{int(seconds // 3600)}h ago"
+
+def remove_account(user_id):
+    """Forgets a user's account and everything cached for it."""
+    user_accounts.pop(user_id, None)
+    for message_id in user_inbox_cache.pop(("inbox", user_id)) or {}:
+        user_inbox_cache.pop(("codes", message_id))
+    user_inbox_cache.pop(("meta", user_id))
+    mail_streams.unsubscribe(user_id)
+    inbox_poller.forget(user_id)
 
 # --- UI Layouts ---
 
@@ -136,6 +431,12 @@ async def my_email_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
 async def new_email_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Generates a new temporary email address for the user."""
     user_id = update.effective_user.id
+    # Held across workers, so two quick taps can't create two accounts.
+    async with state_backend.lock(f"account:{user_id}"):
+        await new_email_locked(update, user_id)
+
+async def new_email_locked(update, user_id):
+    """The body of new_email_command, run while holding the user's account lock."""
     if user_id in user_accounts:
         await update.message.reply_text(
             "⚠️ <b>Email Already Exists</b>\n\n"
@@ -148,10 +449,9 @@ async def new_email_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await update.message.reply_text("⏳ <b>Generating New Email...</b>", parse_mode="HTML")
 
     try:
-        mt = MailTm()
-        account = mt.get_account()
+        account = await create_user_account()
         user_accounts[user_id] = account
-        save_accounts()
+        watch_account(user_id)
         
         await update.message.reply_html(
             "🎉 <b>Email Created Successfully!</b>\n\n"
@@ -181,10 +481,14 @@ async def check_inbox_command(update: Update, context: ContextTypes.DEFAULT_TYPE
         return
     
     account = user_accounts[user_id]
-    await update.message.reply_text("📧 <b>Checking Inbox...</b>", parse_mode="HTML")
+    mail_streams.subscribe(user_id)
+    # The placeholder is edited into the inbox view, so the inbox costs one message whatever its size.
+    placeholder = await update.message.reply_text("📧 <b>Checking Inbox...</b>", parse_mode="HTML")
     
     try:
-        messages = account.get_messages()
+        # Previews only: bodies are fetched when "Read Full Message" is pressed.
+        messages = await list_messages(user_id, account)
+        update_inbox_meta(user_id, messages, viewed=True)
         
         if not messages:
             inbox_text = (
@@ -193,64 +497,112 @@ async def check_inbox_command(update: Update, context: ContextTypes.DEFAULT_TYPE
                 f"📮 Messages: <b>0</b>\n\n"
                 "No new messages found."
             )
-            await update.message.reply_html(inbox_text)
+            await placeholder.edit_text(inbox_text, parse_mode="HTML")
         else:
-            user_inbox_cache[user_id] = {msg.id_: msg for msg in messages}
-            inbox_text = f"📬 <b>You have {len(messages)} message(s)!</b>\n\n"
-            for i, message in enumerate(messages):
-                # Prepare a unique callback data for each message
-                callback_data = f"read_email_{message.id_}"
-                keyboard = InlineKeyboardMarkup([
-                    [InlineKeyboardButton("📖 Read Full Message", callback_data=callback_data)]
-                ])
-                
-                message_preview = (
-                    f"<b>📧 Message {i+1}:</b>\n"
-                    f"👤 <b>From:</b> {message.from_['address']}\n"
-                    f"📝 <b>Subject:</b> {message.subject}\n"
-                    f"💬 <b>Preview:</b> {message.intro[:100]}{'...' if len(message.intro) > 100 else ''}\n"
-                )
-                
-                await update.message.reply_html(message_preview, reply_markup=keyboard)
+            cache_messages(user_id, messages, replace=True)
+            inbox_poller.mark_seen(user_id, [msg.id_ for msg in messages])
+            inbox_text, keyboard = render_inbox_page(user_id, 1)
+            await placeholder.edit_text(inbox_text, parse_mode="HTML", reply_markup=keyboard)
             
     except Exception as e:
         logging.error(f"Error checking inbox for user {user_id}: {e}")
-        await update.message.reply_text(
+        if not account_is_gone(e):
+            # Slow, failing or throttled upstream: the address is kept.
+            await placeholder.edit_text(
+                "⚠️ <b>Inbox Unavailable</b>\n\n"
+                "Couldn't reach the mail service right now. Your email address is kept; "
+                "please try again in a minute.",
+                parse_mode="HTML"
+            )
+            return
+        await placeholder.edit_text(
             "❌ <b>Error Checking Inbox</b>\n\n"
             "Couldn't fetch your messages. Your account may have expired. "
             "Your account has been removed. Please create a new email address.",
             parse_mode="HTML"
         )
-        if user_id in user_accounts:
-            del user_accounts[user_id]
-            save_accounts()
+        remove_account(user_id)
+
+def render_inbox_page(user_id, page):
+    """Builds the text and inline keyboard for one page of the user's cached inbox."""
+    previews = sorted(
+        user_inbox_cache.get(("inbox", user_id), {}).values(),
+        key=lambda msg: msg.created_at or "",
+        reverse=True
+    )
+    if not previews:
+        return (
+            "❌ <b>Inbox Expired</b>\n\nThis inbox view is out of date. Please tap '📨 Inbox' again.",
+            None
+        )
+    page_count = (len(previews) + INBOX_PAGE_SIZE - 1) // INBOX_PAGE_SIZE
+    page = min(max(page, 1), page_count)
+    first = (page - 1) * INBOX_PAGE_SIZE
+    page_messages = previews[first:first + INBOX_PAGE_SIZE]
+
+    inbox_text = f"📬 <b>You have {len(previews)} message(s)!</b>\n\n"
+    for i, message in enumerate(page_messages, first + 1):
+        intro = message.intro[:100] + ('...' if len(message.intro) > 100 else '')
+        inbox_text += (
+            f"<b>📧 Message {i}:</b>\n"
+            f"👤 <b>From:</b> {html.escape(message.from_.get('address', ''))}\n"
+            f"📝 <b>Subject:</b> {html.escape(message.subject)}\n"
+            f"💬 <b>Preview:</b> {html.escape(intro)}\n"
+            f"{format_codes(extract_codes(message), max_links=1)}\n"
+        )
+    inbox_text += "📖 Tap a number to read the full message."
+
+    read_buttons = [
+        InlineKeyboardButton(f"📖 {i}", callback_data=f"read_email_{message.id_}")
+        for i, message in enumerate(page_messages, first + 1)
+    ]
+    nav_buttons = [
+        InlineKeyboardButton("◀️ Prev", callback_data=f"inbox_page_{page - 1}") if page > 1
+        else InlineKeyboardButton(" ", callback_data="inbox_noop"),
+        InlineKeyboardButton(f"Page {page}/{page_count}", callback_data="inbox_noop"),
+        InlineKeyboardButton("Next ▶️", callback_data=f"inbox_page_{page + 1}") if page < page_count
+        else InlineKeyboardButton(" ", callback_data="inbox_noop"),
+    ]
+    return inbox_text, InlineKeyboardMarkup([read_buttons, nav_buttons])
 
 async def status_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Displays the user's account status."""
     user_id = update.effective_user.id
     if user_id in user_accounts:
         account = user_accounts[user_id]
+        mail_streams.subscribe(user_id)
         try:
-            messages = account.get_messages()
+            # Answer from the cached counts unless they are older than STATUS_MAX_AGE.
+            meta = user_inbox_cache.get(("meta", user_id))
+            if meta is None or time.time() - meta['checked_at'] > STATUS_MAX_AGE:
+                meta = update_inbox_meta(user_id, await list_messages(user_id, account))
             status_text = (
                 f"📊 <b>Account Status</b>\n\n"
                 f"📧 <b>Email:</b> <code>{account.address}</code>\n"
                 f"✅ <b>Status:</b> Active\n"
-                f"📮 <b>Messages:</b> {len(messages)}\n"
+                f"📮 <b>Messages:</b> {meta['count']}\n"
+                f"🆕 <b>Unread:</b> {meta['unread']}\n"
                 f"👤 <b>User ID:</b> <code>{user_id}</code>\n\n"
-                f"🔄 <b>Last Checked:</b> Just now\n"
+                f"🔄 <b>Last Checked:</b> {format_age(time.time() - meta['checked_at'])}\n"
                 f"⏰ <b>Account:</b> Temporary (may expire)"
             )
-        except Exception:
-            status_text = (
-                f"📊 <b>Account Status</b>\n\n"
-                f"❌ <b>Status:</b> Account may have expired\n"
-                f"👤 <b>User ID:</b> <code>{user_id}</code>\n\n"
-                f"💡 Please create a new email address."
-            )
-            if user_id in user_accounts:
-                del user_accounts[user_id]
-                save_accounts()
+        except Exception as e:
+            if account_is_gone(e):
+                status_text = (
+                    f"📊 <b>Account Status</b>\n\n"
+                    f"❌ <b>Status:</b> Account may have expired\n"
+                    f"👤 <b>User ID:</b> <code>{user_id}</code>\n\n"
+                    f"💡 Please create a new email address."
+                )
+                remove_account(user_id)
+            else:
+                logging.error(f"Error checking the status of user {user_id}: {e}")
+                status_text = (
+                    f"📊 <b>Account Status</b>\n\n"
+                    f"📧 <b>Email:</b> <code>{account.address}</code>\n"
+                    f"⚠️ <b>Status:</b> Mail service unavailable, please try again in a minute\n"
+                    f"👤 <b>User ID:</b> <code>{user_id}</code>"
+                )
     else:
         status_text = (
             f"📊 <b>Account Status</b>\n\n"
@@ -274,32 +626,71 @@ async def admin_panel_command(update: Update, context: ContextTypes.DEFAULT_TYPE
         "🔧 <b>Admin Panel</b>\n\n"
         "Welcome, Admin! Here are your available commands:\n\n"
         "• /get_all_users - List all active users and their email addresses.\n"
+        "• /export_users [csv|jsonl] - Download all users as a file.\n"
         "• /stats - See bot usage statistics.\n"
         "• /broadcast [message] - Send a message to all active users.\n"
+        "• /cancel_broadcast - Stop the running broadcast.\n"
         "• /delete_account [user_id] - Delete a user's temporary account."
     )
     await update.message.reply_html(admin_text)
 
 async def get_all_users_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    """Admin command to list all active users and their emails."""
+    """Admin command to list active users and their emails, one page at a time."""
     user_id = update.effective_user.id
     if user_id != ADMIN_ID:
         await update.message.reply_text("❌ You are not authorized to use this command.")
         return
 
-    if not user_accounts:
-        await update.message.reply_text("👥 <b>Active Users</b>\n\n❌ No users have created temporary accounts yet.", parse_mode="HTML")
-        return
+    users_text, keyboard = render_users_page()
+    await update.message.reply_html(users_text, reply_markup=keyboard)
+
+def render_users_page(page=1, after=None):
+    """Builds one page of the user list: the users with IDs after `after`, in ID order."""
+    user_ids = account_store.user_ids_after(after, USERS_PAGE_SIZE + 1)
+    has_next = len(user_ids) > USERS_PAGE_SIZE
+    user_ids = user_ids[:USERS_PAGE_SIZE]
+    if not user_ids:
+        return "👥 <b>Active Users</b>\n\n❌ No users have created temporary accounts yet.", None
 
-    response_text = f"👥 <b>Active Users ({len(user_accounts)})</b>\n\n"
-    for i, (telegram_id, account) in enumerate(user_accounts.items(), 1):
-        response_text += (
+    blocks = [f"👥 <b>Active Users ({account_store.count()})</b> · Page {page}\n\n"]
+    for i, telegram_id in enumerate(user_ids, (page - 1) * USERS_PAGE_SIZE + 1):
+        # Read the stored record directly, so listing doesn't load every Account into memory.
+        record = account_store.get(telegram_id) or {}
+        blocks.append(
             f"<b>{i}. User #{telegram_id}</b>\n"
-            f"📧 <code>{account.address}</code>\n"
+            f"📧 <code>{html.escape(record.get('address', '?'))}</code>\n"
             f"{'─' * 25}\n"
         )
-    
-    await update.message.reply_html(response_text)
+    buttons = []
+    if page > 1:
+        buttons.append(InlineKeyboardButton("⏮️ First", callback_data="users_page_1_"))
+    if has_next:
+        buttons.append(InlineKeyboardButton("Next ▶️", callback_data=f"users_page_{page + 1}_{user_ids[-1]}"))
+    return "".join(blocks), InlineKeyboardMarkup([buttons]) if buttons else None
+
+async def export_users_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Admin command to export every user as one CSV or JSONL document."""
+    user_id = update.effective_user.id
+    if user_id != ADMIN_ID:
+        await update.message.reply_text("❌ You are not authorized to use this command.")
+        return
+
+    fmt = context.args[0].lower() if context.args else "csv"
+    if fmt not in EXPORT_FORMATS:
+        await update.message.reply_text("Usage: /export_users [csv|jsonl]")
+        return
+
+    status_message = await update.message.reply_text("⏳ Exporting users...")
+    buffer, count = await export_users(
+        account_store.user_ids_after, lambda telegram_id: (account_store.get(telegram_id) or {}).get('address'), fmt
+    )
+    with buffer:
+        await update.message.reply_document(
+            document=buffer,
+            filename=f"users-{time.strftime('%Y%m%d-%H%M%S')}.{fmt}",
+            caption=f"👥 {count} users"
+        )
+    await status_message.edit_text(f"✅ Exported {count} users.")
 
 async def stats_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Admin command to show bot statistics."""
@@ -309,17 +700,63 @@ async def stats_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return
     
     total_users = len(user_accounts)
+    cache_stats = user_inbox_cache.stats()
+    processor_stats = update_processor.stats()
+    handler_latency = HANDLER_SECONDS.total()
+    handler_errors = sum(counter.value for counter in HANDLER_ERRORS.children.values())
     stats_text = (
         f"📊 <b>Bot Statistics</b>\n\n"
         f"👥 <b>Total Active Users:</b> {total_users}\n"
         f"📧 <b>Total Active Emails:</b> {total_users}\n"
         f"🤖 <b>Bot Status:</b> Online ✅\n"
-        f"📈 <b>Performance:</b> Good\n"
-        f"⚡ <b>Response Time:</b> Fast"
+        f"📈 <b>Handled Updates:</b> {handler_latency.count} ({handler_errors} failed)\n"
+        f"⚡ <b>Response Time p50 / p95 / p99:</b> {format_percentiles(handler_latency)}\n\n"
+        f"⏱️ <b>Busiest Handlers</b> (calls, failed, p50 / p95 / p99):\n"
+        f"{format_latency_rows(latency_summary(HANDLER_SECONDS, HANDLER_ERRORS))}\n\n"
+        f"🌐 <b>Upstream Calls</b> (calls, failed, p50 / p95 / p99):\n"
+        f"{format_latency_rows(latency_summary(UPSTREAM_SECONDS, UPSTREAM_ERRORS))}\n\n"
+        f"🗂️ <b>Inbox Cache:</b>\n"
+        f"• Entries: {cache_stats['entries']}\n"
+        f"• Memory: {cache_stats['bytes'] / 1024 / 1024:.1f} / {cache_stats['max_bytes'] / 1024 / 1024:.0f} MB\n"
+        f"• Hits / Misses: {cache_stats['hits']} / {cache_stats['misses']} ({cache_stats['hit_rate']:.0%})\n"
+        f"• Evictions / Expired: {cache_stats['evictions']} / {cache_stats['expirations']}\n\n"
+        f"🔁 <b>Coalesced Requests:</b>\n"
+        f"• Shared upstream calls: {inflight.shared} of {inflight.calls + inflight.shared}\n"
+        f"• Repeat taps skipped: {tap_debouncer.skipped}\n\n"
+        f"🔀 <b>Mail Providers</b> (created, failed, p95):\n"
+        f"{format_provider_rows(mail_router.stats())}\n"
+        f"• Hedged / failed-over creations: {mail_router.hedged} / {mail_router.failovers}\n\n"
+        f"🧹 <b>Account Sweeper:</b>\n"
+        f"• Checked: {account_sweeper.checked} ({account_sweeper.errors} failed)\n"
+        f"• Purged expired / idle: {account_sweeper.expired} / {account_sweeper.idle}\n"
+        f"• Sweeps deferred for traffic: {account_sweeper.deferred_sweeps}\n\n"
+        f"⚙️ <b>Update Processing:</b>\n"
+        f"• Users in progress: {processor_stats['active_keys']} ({processor_stats['queued']} queued, max depth {processor_stats['max_depth']})\n"
+        f"• Queue wait p50 / p95 / max: {processor_stats['wait_p50'] * 1000:.0f} / {processor_stats['wait_p95'] * 1000:.0f} / {processor_stats['wait_max'] * 1000:.0f} ms"
     )
     
     await update.message.reply_html(stats_text)
 
+def format_percentiles(histogram):
+    return " / ".join(f"{histogram.percentile(p) * 1000:.0f}" for p in (0.50, 0.95, 0.99)) + " ms"
+
+def format_latency_rows(rows):
+    if not rows:
+        return "• No calls yet"
+    return "\n".join(
+        f"• <code>{html.escape(label)}</code>: {calls}, {errors}, "
+        f"{p50 * 1000:.0f} / {p95 * 1000:.0f} / {p99 * 1000:.0f} ms"
+        for label, calls, errors, p50, p95, p99 in rows
+    )
+
+def format_provider_rows(stats):
+    rows = []
+    for name, row in stats.items():
+        p95 = "-" if row['p95'] is None else f"{row['p95'] * 1000:.0f} ms"
+        status = "" if row['in_rotation'] else " ⛔ out of rotation"
+        rows.append(f"• <code>{name}</code>: {row['created']}, {row['failed']}, {p95}{status}")
+    return "\n".join(rows)
+
 async def broadcast_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Admin command to broadcast a message to all users."""
     user_id = update.effective_user.id
@@ -337,26 +774,65 @@ async def broadcast_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return
     
     message_to_send = " ".join(context.args)
-    if not user_accounts:
+    total_users = len(user_accounts)
+    if not total_users:
         await update.message.reply_text("❌ No users to broadcast to.", parse_mode="HTML")
         return
-    
-    success_count = 0
-    for telegram_id in user_accounts:
-        try:
-            await context.bot.send_message(
-                chat_id=telegram_id,
-                text=f"📢 <b>Broadcast Message:</b>\n\n{message_to_send}",
-                parse_mode="HTML"
-            )
-            success_count += 1
-        except Exception as e:
-            logging.error(f"Failed to send broadcast to user {telegram_id}: {e}")
-    
-    await update.message.reply_html(
-        f"✅ <b>Broadcast Sent!</b>\n\n"
-        f"📊 Delivered to {success_count}/{len(user_accounts)} users"
-    )
+
+    # The broadcast runs in the background; its progress message is edited as it goes.
+    started = await broadcast_engine.start(context.bot, message_to_send, update.effective_chat.id, total_users)
+    if not started:
+        await update.message.reply_html(
+            "⚠️ <b>Broadcast Already Running</b>\n\n"
+            "Wait for it to finish or stop it with /cancel_broadcast."
+        )
+
+async def cancel_broadcast_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Admin command to stop the running broadcast."""
+    user_id = update.effective_user.id
+    if user_id != ADMIN_ID:
+        await update.message.reply_text("❌ You are not authorized to use this command.")
+        return
+
+    if broadcast_engine.cancel():
+        await update.message.reply_html("🛑 <b>Stopping Broadcast...</b>\n\nIt will stop after the current batch.")
+    else:
+        await update.message.reply_html("❌ No broadcast is running.")
+
+async def delete_upstream(account):
+    """Deletes an account the bot already forgot on its provider; a failure is only logged."""
+    try:
+        await mail_router.delete_account(account)
+    except Exception as e:
+        logging.warning(f"Couldn't delete account {account.address} upstream: {e}")
+
+async def purge_account(user_id, account, idle):
+    """Deletes an account the sweeper found expired or long idle, unless the user replaced it meanwhile."""
+    async with state_backend.lock(f"account:{user_id}"):
+        current = user_accounts.get(user_id)
+        if current is None or current.id_ != account.id_:
+            return
+        remove_account(user_id)
+    if idle:
+        # Expired accounts are already gone upstream; idle ones still hold an address. Deleted
+        # after the lock is released, so the user's own commands don't wait on the provider.
+        await delete_upstream(account)
+    logging.info(f"Swept the {'idle' if idle else 'expired'} account of user {user_id}.")
+
+async def record_activity(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Notes that the user is active, so the sweeper leaves their account alone."""
+    if update.effective_user is not None:
+        account_store.touch(update.effective_user.id)
+
+def prune_blocked_user(telegram_id):
+    """Forgets a user who blocked the bot, so later broadcasts skip them, and deletes their address upstream."""
+    account = user_accounts.get(telegram_id)
+    remove_account(telegram_id)
+    if account is not None:
+        deletion = asyncio.ensure_future(delete_upstream(account))
+        upstream_deletions.add(deletion)
+        deletion.add_done_callback(upstream_deletions.discard)
+    logging.info(f"Pruned user {telegram_id}: the bot was blocked or the chat no longer exists.")
 
 async def delete_account_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Admin command to delete a specific user's temporary account."""
@@ -378,10 +854,9 @@ async def delete_account_command(update: Update, context: ContextTypes.DEFAULT_T
         target_user_id = int(context.args[0])
         if target_user_id in user_accounts:
             account = user_accounts[target_user_id]
-            is_deleted = account.delete_account()
+            is_deleted = await mail_router.delete_account(account)
             if is_deleted:
-                del user_accounts[target_user_id]
-                save_accounts()
+                remove_account(target_user_id)
                 await update.message.reply_html(
                     f"✅ Account for user ID <code>{target_user_id}</code> deleted successfully."
                 )
@@ -413,8 +888,10 @@ async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
         "<b>Admin Commands:</b>\n"
         "• /admin - Access the admin panel.\n"
         "• /get_all_users - List all active users.\n"
+        "• /export_users [csv|jsonl] - Download all users as a file.\n"
         "• /stats - View bot usage statistics.\n"
         "• /broadcast [message] - Send a message to all users.\n"
+        "• /cancel_broadcast - Stop the running broadcast.\n"
         "• /delete_account [user_id] - Delete a user's account.\n\n"
         "💡 <b>Tip:</b> You can use the buttons at the bottom of the screen for quick actions."
     )
@@ -425,68 +902,92 @@ async def handle_callback_query(update: Update, context: ContextTypes.DEFAULT_TY
     query = update.callback_query
     await query.answer()
     user_id = query.from_user.id
+    if query.data.startswith(DEBOUNCED_CALLBACKS) and tap_debouncer.is_repeat((user_id, query.data)):
+        # Already answered above; the first tap is delivering the content.
+        return
     
     if query.data == "confirm_new_email":
-        old_account = user_accounts.get(user_id)
-        if old_account:
-            await query.edit_message_text("🗑️ Deleting your old email account...")
-            try:
-                is_deleted = old_account.delete_account()
-                if is_deleted:
-                    del user_accounts[user_id]
-                    save_accounts()
-                    await query.edit_message_text("✅ Old account deleted. Generating new email...")
-                    # Now call the new email logic to create a fresh one
-                    await new_email_logic(query, user_id)
-                else:
-                    await query.edit_message_text(
-                        "❌ Failed to delete old account. Please try again or contact an admin.",
-                        parse_mode="HTML"
-                    )
-            except Exception as e:
-                logging.error(f"Error deleting old account for user {user_id}: {e}")
-                await query.edit_message_text(
-                    "❌ An error occurred while deleting your old account. Please try again.",
-                    parse_mode="HTML"
-                )
-        else:
-            await query.edit_message_text("No old account found. Generating new email...", parse_mode="HTML")
-            await new_email_logic(query, user_id)
+        async with state_backend.lock(f"account:{user_id}"):
+            await replace_account(query, user_id)
+    elif query.data.startswith("inbox_page_"):
+        inbox_text, keyboard = render_inbox_page(user_id, int(query.data.split("_")[2]))
+        await query.edit_message_text(inbox_text, parse_mode="HTML", reply_markup=keyboard)
+    elif query.data == "inbox_noop":
+        pass
+    elif query.data.startswith("users_page_"):
+        if user_id != ADMIN_ID:
+            return
+        _, _, page, after = query.data.split("_", 3)
+        users_text, keyboard = render_users_page(int(page), int(after) if after else None)
+        await query.edit_message_text(users_text, parse_mode="HTML", reply_markup=keyboard)
     elif query.data == "cancel_new_email":
         await query.edit_message_text("Keeping your current email. You can find it with /my_email.")
     elif query.data.startswith("read_email_"):
         message_id = query.data.split("_")[2]
-        if user_id in user_inbox_cache and message_id in user_inbox_cache[user_id]:
-            message = user_inbox_cache[user_id][message_id]
-            full_message_text = (
+        try:
+            message = await get_message_body(user_id, message_id)
+        except ProviderError as e:
+            logging.error(f"Error fetching message {message_id} for user {user_id}: {e}")
+            message = None
+        if message is not None:
+            header = (
                 f"<b>📧 Full Message:</b>\n\n"
-                f"👤 <b>From:</b> {message.from_['address']}\n"
-                f"📝 <b>Subject:</b> {message.subject}\n\n"
-                f"<b>Message Content:</b>\n"
-                f"{message.text}"
+                f"👤 <b>From:</b> {html.escape(message.from_.get('address', ''))}\n"
+                f"📝 <b>Subject:</b> {html.escape(message.subject or '')}\n"
+                f"{format_codes(extract_codes(message))}\n"
+            )
+            body = message.text or ""
+            # Long messages are split on safe boundaries, or sent as one file (the original HTML when there is one).
+            await send_html(
+                context.bot, user_id,
+                header + f"<b>Message Content:</b>\n{html.escape(body)}",
+                document=message.html or body,
+                filename=f"message-{message.id_}.{'html' if message.html else 'txt'}",
+                caption=header + "📎 <i>The message is too long to show here, so it is attached as a file.</i>"
             )
-            # The original message might be too long, so we split it into multiple parts if necessary
-            for i in range(0, len(full_message_text), 4096):
-                await context.bot.send_message(
-                    chat_id=user_id,
-                    text=full_message_text[i:i+4096],
-                    parse_mode="HTML"
-                )
         else:
+            # Nothing was sent, so let the user retry straight away.
+            tap_debouncer.forget((user_id, query.data))
             await context.bot.send_message(
                 chat_id=user_id,
                 text="❌ Error: Could not find that message. It might have expired from the cache. Please use /check_inbox again.",
                 parse_mode="HTML"
             )
 
+async def replace_account(query, user_id):
+    """Deletes the user's old account and creates a new one, after they confirmed it."""
+    old_account = user_accounts.get(user_id)
+    if old_account:
+        await query.edit_message_text("🗑️ Deleting your old email account...")
+        try:
+            is_deleted = await mail_router.delete_account(old_account)
+            if is_deleted:
+                remove_account(user_id)
+                await query.edit_message_text("✅ Old account deleted. Generating new email...")
+                # Now call the new email logic to create a fresh one
+                await new_email_logic(query, user_id)
+            else:
+                await query.edit_message_text(
+                    "❌ Failed to delete old account. Please try again or contact an admin.",
+                    parse_mode="HTML"
+                )
+        except Exception as e:
+            logging.error(f"Error deleting old account for user {user_id}: {e}")
+            await query.edit_message_text(
+                "❌ An error occurred while deleting your old account. Please try again.",
+                parse_mode="HTML"
+            )
+    else:
+        await query.edit_message_text("No old account found. Generating new email...", parse_mode="HTML")
+        await new_email_logic(query, user_id)
+
 async def new_email_logic(query, user_id):
     """Logic to generate a new email, separated for reuse."""
     await query.edit_message_text("⏳ <b>Generating New Email...</b>", parse_mode="HTML")
     try:
-        mt = MailTm()
-        account = mt.get_account()
+        account = await create_user_account()
         user_accounts[user_id] = account
-        save_accounts()
+        watch_account(user_id)
         
         await query.edit_message_text(
             "🎉 <b>Email Created Successfully!</b>\n\n"
@@ -504,11 +1005,69 @@ async def new_email_logic(query, user_id):
             parse_mode="HTML"
         )
     
+async def notify_new_messages(bot, user_id, account, messages):
+    """Pushes messages found by the inbox poller to their owner."""
+    cache_messages(user_id, messages)
+    for message in messages:
+        keyboard = InlineKeyboardMarkup([
+            [InlineKeyboardButton("📖 Read Full Message", callback_data=f"read_email_{message.id_}")]
+        ])
+        await bot.send_message(
+            chat_id=user_id,
+            text=(
+                f"📬 <b>New Email Received!</b>\n\n"
+                f"📧 <b>To:</b> <code>{account.address}</code>\n"
+                f"👤 <b>From:</b> {html.escape(message.from_.get('address', ''))}\n"
+                f"📝 <b>Subject:</b> {html.escape(message.subject)}\n"
+                f"💬 <b>Preview:</b> {html.escape(message.intro[:100])}{'...' if len(message.intro) > 100 else ''}\n"
+                f"{format_codes(extract_codes(message))}"
+            ),
+            parse_mode="HTML",
+            reply_markup=keyboard
+        )
+
+async def purge_inbox_cache(context: ContextTypes.DEFAULT_TYPE):
+    """Periodically frees cache entries that expired without being looked up again."""
+    await state_backend.run(user_inbox_cache.purge_expired)
+
+async def post_init(application: Application):
+    """Starts the metrics endpoint; on the background worker, also resumes an interrupted broadcast and starts the event streams and account pool."""
+    global metrics_server
+    metrics_server = await start_metrics_server()
+    if not RUN_BACKGROUND_JOBS:
+        return
+    broadcast_engine.resume(application.bot)
+    mail_streams.start(application.bot, application.job_queue)
+    account_pool.load()
+    application.job_queue.run_repeating(account_pool.maintain, interval=60, first=1)
+
+async def post_shutdown(application: Application):
+    """Closes the pooled mail provider connections and flushes pending account writes."""
+    await broadcast_engine.stop()
+    if RUN_BACKGROUND_JOBS:
+        # Only the background worker owns the saved pool; others would overwrite it with an empty one.
+        await account_pool.stop()
+    await mail_streams.close()
+    await mail_router.close()
+    await account_store.close()
+    state_backend.close()
+    await stop_metrics_server(metrics_server)
+
 # The main function to set up and run the bot
 def main():
     """Start the bot."""
     load_accounts()
-    application = Application.builder().token(BOT_TOKEN).build()
+    # Different users' updates run concurrently; each user's run one at a time, in order
+    application = (
+        Application.builder()
+        .token(BOT_TOKEN)
+        .base_url(TELEGRAM_API_URL)
+        .update_queue(bounded_update_queue())
+        .concurrent_updates(update_processor)
+        .post_init(post_init)
+        .post_shutdown(post_shutdown)
+        .build()
+    )
 
     # Register command handlers
     application.add_handler(CommandHandler("start", start_command))
@@ -525,14 +1084,31 @@ def main():
     # Register admin-specific command handlers
     application.add_handler(CommandHandler("admin", admin_panel_command))
     application.add_handler(CommandHandler("get_all_users", get_all_users_command))
+    application.add_handler(CommandHandler("export_users", export_users_command))
     application.add_handler(CommandHandler("stats", stats_command))
     application.add_handler(CommandHandler("broadcast", broadcast_command))
+    application.add_handler(CommandHandler("cancel_broadcast", cancel_broadcast_command))
     application.add_handler(CommandHandler("delete_account", delete_account_command))
     
     # Register callback query handler for inline buttons
     application.add_handler(CallbackQueryHandler(handle_callback_query))
+
+    # Record every user's last activity first, for the account sweeper (group -1 isn't timed)
+    application.add_handler(MessageHandler(filters.ALL, record_activity), group=-1)
+    application.add_handler(CallbackQueryHandler(record_activity), group=-1)
+
+    # Poll tracked inboxes in the background and push new mail to users
+    if RUN_BACKGROUND_JOBS:
+        inbox_poller.start(application.job_queue)
+        account_sweeper.start(application.job_queue)
+        application.job_queue.run_repeating(apply_track_requests, interval=TRACK_REQUESTS_INTERVAL, first=1)
+    application.job_queue.run_repeating(purge_inbox_cache, interval=60, first=60)
+
+    # Time every handler and expose the queue depths (served on the metrics endpoint and in /stats)
+    instrument_application(application)
     
-    application.run_polling(allowed_updates=Update.ALL_TYPES)
+    # Webhook when WEBHOOK_URL is set, long polling otherwise; only the handled update types are requested
+    run_application(application, set_webhook=RUN_BACKGROUND_JOBS)
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
@@ -0,0 +1,263 @@
+# broadcast.py
+
+import asyncio
+import logging
+import time
+
+from telegram.error import BadRequest, Forbidden, RetryAfter, TelegramError
+
+# Telegram allows a bot roughly 30 messages per second across all chats.
+BROADCAST_RATE = 30
+
+# Sends in flight at once. Only needs to cover the round-trip time at BROADCAST_RATE.
+MAX_CONCURRENT_SENDS = 30
+
+# User IDs taken from the store per batch. The cursor is checkpointed after each batch.
+BATCH_SIZE = 100
+
+# Seconds between edits of the admin's progress message.
+PROGRESS_INTERVAL = 5
+
+# Times a single chat is retried after a RetryAfter before it is counted as failed.
+MAX_RETRIES = 3
+
+# Key under which the running job is checkpointed in the account store.
+CHECKPOINT_KEY = "broadcast"
+
+logger = logging.getLogger(__name__)
+
+
+class RateLimiter:
+    """Token bucket shared by all sends. `pause` stops everyone, for Telegram's RetryAfter."""
+
+    def __init__(self, rate):
+        self.rate = rate
+        self._tokens = rate
+        self._updated = time.monotonic()
+        self._paused_until = 0.0
+        self._lock = asyncio.Lock()
+
+    async def acquire(self):
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                if now < self._paused_until:
+                    await asyncio.sleep(self._paused_until - now)
+                    continue
+                self._tokens = min(self.rate, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                await asyncio.sleep((1 - self._tokens) / self.rate)
+
+    def pause(self, seconds):
+        self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+
+
+class BroadcastJob:
+    """State of one broadcast. Everything here is checkpointed, so a job survives restarts."""
+
+    def __init__(self, text, admin_chat_id, total, status_message_id=None, cursor=None,
+                 sent=0, failed=0, blocked=0, cancelled=False, started_at=None):
+        self.text = text
+        self.admin_chat_id = admin_chat_id
+        self.total = total
+        self.status_message_id = status_message_id
+        # Highest user ID whose batch is fully processed.
+        self.cursor = cursor
+        self.sent = sent
+        self.failed = failed
+        self.blocked = blocked
+        self.cancelled = cancelled
+        self.started_at = started_at or time.time()
+
+    @property
+    def processed(self):
+        return self.sent + self.failed + self.blocked
+
+    def eta_seconds(self):
+        elapsed = time.time() - self.started_at
+        if not self.processed or elapsed <= 0:
+            return None
+        remaining = max(self.total - self.processed, 0)
+        return remaining / (self.processed / elapsed)
+
+    def to_dict(self):
+        return dict(vars(self))
+
+    @classmethod
+    def from_dict(cls, data):
+        return cls(**data)
+
+
+def format_eta(seconds):
+    if seconds is None:
+        return "calculating..."
+    seconds = int(seconds)
+    if seconds < 60:
+        return f"{seconds}s"
+    if seconds < 3600:
+        return f"{seconds // 60}m {seconds % 60}s"
+    return f"{seconds // 3600}h {seconds % 3600 // 60}m"
+
+
+class BroadcastEngine:
+    """Runs one broadcast at a time as a background task.
+
+    Sends go out concurrently, capped by MAX_CONCURRENT_SENDS and a shared token
+    bucket at BROADCAST_RATE. The cursor is checkpointed into the account store
+    after every batch, so a restarted bot resumes where it stopped. Chats that
+    have blocked the bot are reported to `on_blocked` so they can be pruned.
+    """
+
+    def __init__(self, store, user_ids_after, on_blocked=None, rate=BROADCAST_RATE,
+                 max_concurrency=MAX_CONCURRENT_SENDS, batch_size=BATCH_SIZE):
+        self.store = store
+        self.user_ids_after = user_ids_after
+        self.on_blocked = on_blocked
+        self.batch_size = batch_size
+        self.max_concurrency = max_concurrency
+        self.limiter = RateLimiter(rate)
+        self.job = None
+        self._task = None
+        self._last_progress = 0.0
+
+    @property
+    def running(self):
+        return self._task is not None and not self._task.done()
+
+    def format_message(self, text):
+        return f"📢 <b>Broadcast Message:</b>\n\n{text}"
+
+    async def start(self, bot, text, admin_chat_id, total):
+        """Starts a new broadcast. Returns False if one is already running."""
+        if self.running:
+            return False
+        job = BroadcastJob(text, admin_chat_id, total)
+        status = await bot.send_message(
+            chat_id=admin_chat_id, text=self.progress_text(job), parse_mode="HTML"
+        )
+        job.status_message_id = status.message_id
+        self._launch(bot, job)
+        return True
+
+    def resume(self, bot):
+        """Resumes a checkpointed broadcast, if the bot stopped in the middle of one."""
+        data = self.store.get_meta(CHECKPOINT_KEY) if self.store is not None else None
+        if not data or self.running:
+            return False
+        job = BroadcastJob.from_dict(data)
+        logger.info(f"Resuming broadcast after user {job.cursor} ({job.processed}/{job.total} done).")
+        self._launch(bot, job)
+        return True
+
+    def cancel(self):
+        """Asks the running broadcast to stop after the current batch."""
+        if not self.running:
+            return False
+        self.job.cancelled = True
+        return True
+
+    async def stop(self):
+        """Stops the running task on shutdown, keeping its checkpoint for resume()."""
+        if self.running:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+
+    def _launch(self, bot, job):
+        self.job = job
+        self._checkpoint()
+        self._task = asyncio.create_task(self._run(bot, job))
+
+    def _checkpoint(self):
+        if self.store is not None:
+            self.store.set_meta(CHECKPOINT_KEY, self.job.to_dict())
+
+    async def _run(self, bot, job):
+        semaphore = asyncio.Semaphore(self.max_concurrency)
+
+        async def send(chat_id):
+            async with semaphore:
+                return chat_id, await self._send(bot, chat_id, job.text)
+
+        try:
+            while not job.cancelled:
+                batch = self.user_ids_after(job.cursor, self.batch_size)
+                if not batch:
+                    break
+                for chat_id, outcome in await asyncio.gather(*(send(chat_id) for chat_id in batch)):
+                    if outcome == "sent":
+                        job.sent += 1
+                    elif outcome == "blocked":
+                        job.blocked += 1
+                        if self.on_blocked is not None:
+                            self.on_blocked(chat_id)
+                    else:
+                        job.failed += 1
+                job.cursor = batch[-1]
+                self._checkpoint()
+                await self._report_progress(bot, job)
+        except Exception as e:
+            # Keep the checkpoint so the broadcast resumes on the next start.
+            logger.error(f"Broadcast stopped after user {job.cursor}: {e}")
+            raise
+        if self.store is not None:
+            self.store.set_meta(CHECKPOINT_KEY, None)
+        await self._report_progress(bot, job, final=True)
+
+    async def _send(self, bot, chat_id, text):
+        for _ in range(MAX_RETRIES + 1):
+            await self.limiter.acquire()
+            try:
+                await bot.send_message(chat_id=chat_id, text=self.format_message(text), parse_mode="HTML")
+                return "sent"
+            except RetryAfter as e:
+                logger.warning(f"Broadcast flood-limited, pausing for {e.retry_after}s.")
+                self.limiter.pause(e.retry_after)
+            except Forbidden:
+                return "blocked"
+            except BadRequest as e:
+                if "chat not found" in str(e).lower():
+                    return "blocked"
+                logger.error(f"Failed to send broadcast to user {chat_id}: {e}")
+                return "failed"
+            except TelegramError as e:
+                logger.error(f"Failed to send broadcast to user {chat_id}: {e}")
+                return "failed"
+        return "failed"
+
+    def progress_text(self, job, final=False):
+        if final:
+            title = "🛑 <b>Broadcast Cancelled</b>" if job.cancelled else "✅ <b>Broadcast Sent!</b>"
+        else:
+            title = "📢 <b>Broadcast in Progress...</b>"
+        text = (
+            f"{title}\n\n"
+            f"📊 Processed: {job.processed}/{job.total}\n"
+            f"✅ Delivered: {job.sent}\n"
+            f"🚫 Blocked (pruned): {job.blocked}\n"
+            f"❌ Failed: {job.failed}\n"
+        )
+        if not final:
+            text += f"⏳ ETA: {format_eta(job.eta_seconds())}\n\nUse /cancel_broadcast to stop it."
+        return text
+
+    async def _report_progress(self, bot, job, final=False):
+        now = time.monotonic()
+        if not final and now - self._last_progress < PROGRESS_INTERVAL:
+            return
+        self._last_progress = now
+        try:
+            if job.status_message_id is not None:
+                await bot.edit_message_text(
+                    chat_id=job.admin_chat_id,
+                    message_id=job.status_message_id,
+                    text=self.progress_text(job, final),
+                    parse_mode="HTML",
+                )
+        except TelegramError as e:
+            logger.warning(f"Couldn't update broadcast progress: {e}")
@@ -0,0 +1,131 @@
+# cache.py
+
+import sys
+import time
+from collections import OrderedDict
+
+# Fixed per-entry cost added to the estimated size of every cached value
+# (key, bookkeeping object and dict slots).
+ENTRY_OVERHEAD = 200
+
+
+def estimate_size(value):
+    """Roughly estimates the memory held by a value, following containers and plain objects."""
+    if isinstance(value, (str, bytes, bytearray)):
+        return sys.getsizeof(value)
+    if isinstance(value, dict):
+        return sys.getsizeof(value) + sum(estimate_size(k) + estimate_size(v) for k, v in value.items())
+    if isinstance(value, (list, tuple, set, frozenset)):
+        return sys.getsizeof(value) + sum(estimate_size(item) for item in value)
+    if hasattr(value, "__dict__"):
+        return sys.getsizeof(value) + estimate_size(vars(value))
+    if hasattr(value, "__slots__"):
+        return sys.getsizeof(value) + sum(estimate_size(getattr(value, name, None)) for name in value.__slots__)
+    return sys.getsizeof(value)
+
+
+class _Entry:
+    __slots__ = ("value", "size", "expires", "evict_first")
+
+    def __init__(self, value, size, expires, evict_first):
+        self.value = value
+        self.size = size
+        self.expires = expires
+        self.evict_first = evict_first
+
+
+class ByteBudgetCache:
+    """LRU + TTL cache bounded by the total estimated size of its entries.
+
+    Entries stored with `evict_first=True` (e.g. message bodies, which can be
+    fetched again) are all evicted before any other entry, so cheap previews
+    stay hot while bodies are dropped under memory pressure.
+    """
+
+    def __init__(self, max_bytes, ttl):
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.bytes = 0
+        # Two LRU lists, oldest first: index 0 is evicted before index 1.
+        self._lru = (OrderedDict(), OrderedDict())
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    def __len__(self):
+        return len(self._lru[0]) + len(self._lru[1])
+
+    def __contains__(self, key):
+        return self._find(key) is not None
+
+    def _find(self, key):
+        for lru in self._lru:
+            entry = lru.get(key)
+            if entry is not None:
+                if entry.expires <= time.monotonic():
+                    self._remove(key, entry)
+                    self.expirations += 1
+                    return None
+                return entry
+        return None
+
+    def get(self, key, default=None):
+        entry = self._find(key)
+        if entry is None:
+            self.misses += 1
+            return default
+        self.hits += 1
+        self._lru[0 if entry.evict_first else 1].move_to_end(key)
+        return entry.value
+
+    def set(self, key, value, size=None, ttl=None, evict_first=False):
+        """Caches a value. Values larger than the whole budget are not cached."""
+        self.pop(key)
+        size = (size if size is not None else estimate_size(value)) + ENTRY_OVERHEAD
+        if size > self.max_bytes:
+            return
+        entry = _Entry(value, size, time.monotonic() + (ttl if ttl is not None else self.ttl), evict_first)
+        self._lru[0 if evict_first else 1][key] = entry
+        self.bytes += size
+        self._evict()
+
+    def pop(self, key, default=None):
+        for lru in self._lru:
+            entry = lru.get(key)
+            if entry is not None:
+                self._remove(key, entry)
+                return entry.value
+        return default
+
+    def _remove(self, key, entry):
+        del self._lru[0 if entry.evict_first else 1][key]
+        self.bytes -= entry.size
+
+    def _evict(self):
+        for lru in self._lru:
+            while self.bytes > self.max_bytes and lru:
+                _, entry = lru.popitem(last=False)
+                self.bytes -= entry.size
+                self.evictions += 1
+
+    def purge_expired(self):
+        """Drops every expired entry. Expired entries are otherwise only noticed on lookup."""
+        now = time.monotonic()
+        for lru in self._lru:
+            for key in [key for key, entry in lru.items() if entry.expires <= now]:
+                self.bytes -= lru.pop(key).size
+                self.expirations += 1
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            "entries": len(self),
+            "bytes": self.bytes,
+            "max_bytes": self.max_bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+            "evictions": self.evictions,
+            "expirations": self.expirations,
+        }
@@ -0,0 +1,70 @@
+# coalesce.py
+
+import asyncio
+import time
+from collections import OrderedDict
+
+# Repeat taps of the same inline button within this many seconds are ignored.
+DEBOUNCE_WINDOW = 3.0
+
+
+class SingleFlight:
+    """Coalesces concurrent calls with the same key into one in-flight call.
+
+    Callers that arrive while a call for their key is running await that call
+    instead of starting another, and all of them get its result (or exception).
+    Nothing is cached: the next call after it finishes runs again.
+    """
+
+    def __init__(self):
+        self._calls = {}
+        self.calls = 0
+        self.shared = 0
+
+    def __len__(self):
+        return len(self._calls)
+
+    async def do(self, key, fn):
+        """Returns the result of `await fn()`, sharing a call already in flight for `key`."""
+        task = self._calls.get(key)
+        if task is None:
+            self.calls += 1
+            task = asyncio.ensure_future(fn())
+            self._calls[key] = task
+            task.add_done_callback(lambda t: self._finish(key, t))
+        else:
+            self.shared += 1
+        # Shielded so one cancelled caller doesn't abort the call for everyone else.
+        return await asyncio.shield(task)
+
+    def _finish(self, key, task):
+        if self._calls.get(key) is task:
+            del self._calls[key]
+        if not task.cancelled():
+            # Marks the exception as retrieved even if every caller was cancelled.
+            task.exception()
+
+
+class TapDebouncer:
+    """Remembers recent (user, button) taps so repeats within `window` seconds can be skipped."""
+
+    def __init__(self, window=DEBOUNCE_WINDOW):
+        self.window = window
+        # key -> time of the first tap, oldest first.
+        self._taps = OrderedDict()
+        self.skipped = 0
+
+    def is_repeat(self, key):
+        """Records a tap; returns True if the same key was tapped less than `window` seconds ago."""
+        now = time.monotonic()
+        while self._taps and next(iter(self._taps.values())) <= now - self.window:
+            self._taps.popitem(last=False)
+        if key in self._taps:
+            self.skipped += 1
+            return True
+        self._taps[key] = now
+        return False
+
+    def forget(self, key):
+        """Lets the next tap of `key` through, e.g. after the first one failed."""
+        self._taps.pop(key, None)
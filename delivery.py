@@ -0,0 +1,125 @@
+# delivery.py
+
+import re
+from collections import deque
+
+# Telegram's limit for one text message, in UTF-16 code units. Chunks are
+# measured with their tags, which is stricter than Telegram's own count.
+MESSAGE_LIMIT = 4096
+
+# Caption limit for documents.
+CAPTION_LIMIT = 1024
+
+# Texts that need more messages than this are sent as a single document instead.
+MAX_TEXT_CHUNKS = 3
+
+# A tag, an entity, a line break, a run of other whitespace, a word, or a stray < or &.
+TOKEN = re.compile(r"<[^>]*>|&#?\w+;|\n|[^\S\n]+|[^<&\s]+|[<&]")
+TAG_NAME = re.compile(r"<\s*(/?)\s*([a-zA-Z0-9-]+)")
+
+
+def utf16_len(text):
+    return len(text.encode("utf-16-le")) // 2
+
+
+def _after(open_tags, token):
+    """Returns the tags still open after `token`, as [(name, opening tag)]."""
+    match = TAG_NAME.match(token)
+    if match is None:
+        return open_tags
+    closing, name = match.group(1), match.group(2).lower()
+    if not closing:
+        return open_tags + [(name, token)]
+    for i in range(len(open_tags) - 1, -1, -1):
+        if open_tags[i][0] == name:
+            return open_tags[:i] + open_tags[i + 1:]
+    return open_tags
+
+
+def _closing(open_tags):
+    return "".join(f"</{name}>" for name, _ in reversed(open_tags))
+
+
+def _split_units(text, units):
+    """Splits `text` after at most `units` UTF-16 code units (at least one character)."""
+    size = 0
+    for i, char in enumerate(text):
+        size += 2 if ord(char) > 0xFFFF else 1
+        if size > units:
+            return text[:max(i, 1)], text[max(i, 1):]
+    return text, ""
+
+
+def split_html(text, limit=MESSAGE_LIMIT):
+    """Splits Telegram HTML into chunks of at most `limit` UTF-16 units, never inside a tag or an entity.
+
+    A chunk ends at its last line break past the halfway mark if there is one,
+    otherwise between words (a word longer than a whole chunk is cut). Tags open
+    at a split are closed at the end of the chunk and reopened in the next.
+    """
+    tokens = deque(TOKEN.findall(text))
+    chunks, open_tags = [], []
+    while tokens:
+        prefix = "".join(tag for _, tag in open_tags)
+        parts, size, tags = [prefix], utf16_len(prefix), open_tags
+        # (parts kept, tags open) right after the last line break in the second half.
+        cut = None
+        closing_size = utf16_len(_closing(tags))
+        while tokens:
+            token = tokens[0]
+            token_size = utf16_len(token)
+            if token[0] == "<":
+                tags_after = _after(tags, token)
+                after_size = utf16_len(_closing(tags_after))
+            else:
+                tags_after, after_size = tags, closing_size
+            if size + token_size + after_size > limit:
+                break
+            tokens.popleft()
+            parts.append(token)
+            size += token_size
+            tags, closing_size = tags_after, after_size
+            if token == "\n" and size > limit // 2:
+                cut = (len(parts), tags)
+        if tokens:
+            if len(parts) == 1:
+                room = limit - size - utf16_len(_closing(tags))
+                if room <= 0:
+                    raise ValueError("Open tags leave no room for text in a chunk")
+                head, tail = _split_units(tokens.popleft(), room)
+                parts.append(head)
+                tokens.appendleft(tail)
+            elif cut is not None:
+                tokens.extendleft(reversed(parts[cut[0]:]))
+                parts, tags = parts[:cut[0]], cut[1]
+        chunk = "".join(parts) + _closing(tags)
+        # Chunks holding nothing but tags and whitespace would be rejected as empty.
+        if re.sub(r"<[^>]*>", "", chunk).strip():
+            chunks.append(chunk)
+        open_tags = tags
+    return chunks
+
+
+async def send_html(bot, chat_id, text, document, filename, caption, max_chunks=MAX_TEXT_CHUNKS, **kwargs):
+    """Sends HTML text in at most `max_chunks` messages, or as one document if it needs more.
+
+    `document` is the str uploaded in that case (e.g. the plain or original HTML
+    body), encoded once and sent from memory, with `caption` (HTML) as its caption.
+    Either way the delivery costs a small, bounded number of Bot API calls.
+    """
+    # Every chunk holds at most `limit` units, so longer texts can't fit in max_chunks.
+    chunks = split_html(text) if utf16_len(text) <= max_chunks * MESSAGE_LIMIT else None
+    if chunks is not None and len(chunks) <= max_chunks:
+        for chunk in chunks:
+            await bot.send_message(chat_id=chat_id, text=chunk, parse_mode="HTML", **kwargs)
+        return len(chunks)
+    caption_chunks = split_html(caption, CAPTION_LIMIT)
+    await bot.send_document(
+        chat_id=chat_id,
+        document=document.encode("utf-8"),
+        filename=filename,
+        caption=caption_chunks[0] if caption_chunks else None,
+        parse_mode="HTML",
+        **kwargs
+    )
+    return 1
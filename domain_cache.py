@@ -0,0 +1,95 @@
+# domain_cache.py
+
+import asyncio
+import json
+import logging
+import os
+import time
+
+# A cached domain list is refreshed in the background once it is this old...
+REFRESH_AFTER = 60 * 60
+
+# ...and is still served while refreshing (or while the provider is failing) up to this age.
+MAX_STALE = 7 * 24 * 60 * 60
+
+logger = logging.getLogger(__name__)
+
+
+class DomainCache:
+    """Provider-agnostic cache for a mail provider's domain list.
+
+    `get()` answers from memory; once the list is older than `refresh_after` it
+    still answers immediately and refreshes in the background (stale-while-
+    revalidate), and upstream errors fall back to the cached list for up to
+    `max_stale`. The list is mirrored to `path`, so a cold start has domains
+    without waiting on the provider.
+    """
+
+    def __init__(self, fetch, path=None, refresh_after=REFRESH_AFTER, max_stale=MAX_STALE):
+        # async fetch() -> list of domains
+        self.fetch = fetch
+        self.path = path
+        self.refresh_after = refresh_after
+        self.max_stale = max_stale
+        self.domains = None
+        self.fetched_at = 0.0
+        self._refresh_task = None
+        self._load()
+
+    def _load(self):
+        if not self.path or not os.path.exists(self.path):
+            return
+        try:
+            with open(self.path, 'r') as f:
+                data = json.load(f)
+            self.domains = data['domains']
+            self.fetched_at = data['fetched_at']
+        except (OSError, json.JSONDecodeError, KeyError) as e:
+            logger.warning(f"Ignoring unreadable domain cache {self.path}: {e}")
+
+    def _save(self):
+        if not self.path:
+            return
+        tmp_path = f"{self.path}.tmp"
+        with open(tmp_path, 'w') as f:
+            json.dump({'domains': self.domains, 'fetched_at': self.fetched_at}, f)
+        os.replace(tmp_path, self.path)
+
+    @property
+    def age(self):
+        return time.time() - self.fetched_at
+
+    async def get(self):
+        """Returns the domain list, fetching it only if nothing usable is cached."""
+        if self.domains and self.age < self.max_stale:
+            if self.age >= self.refresh_after:
+                self._start_refresh()
+            return self.domains
+        try:
+            # Shielded so one cancelled caller doesn't abort the refresh for everyone else.
+            return await asyncio.shield(self._start_refresh())
+        except Exception:
+            if self.domains:
+                logger.warning(f"Domain refresh failed; serving a list {int(self.age)}s old.")
+                return self.domains
+            raise
+
+    def _start_refresh(self):
+        # One refresh at a time; concurrent callers share it.
+        if self._refresh_task is None or self._refresh_task.done():
+            self._refresh_task = asyncio.ensure_future(self._refresh())
+            self._refresh_task.add_done_callback(self._log_failure)
+        return self._refresh_task
+
+    async def _refresh(self):
+        domains = await self.fetch()
+        if domains:
+            self.domains = list(domains)
+            self.fetched_at = time.time()
+            await asyncio.to_thread(self._save)
+        return self.domains or []
+
+    @staticmethod
+    def _log_failure(task):
+        if not task.cancelled() and task.exception() is not None:
+            logger.warning(f"Couldn't refresh the domain list: {task.exception()}")
@@ -0,0 +1,123 @@
+# extract.py
+
+import html
+import re
+
+# At most this many codes and links are kept per message.
+MAX_CODES = 3
+MAX_LINKS = 3
+
+# Codes and links are looked for in this many characters of the body; they sit near the top.
+MAX_SCAN_CHARS = 64 * 1024
+
+# Previews shorter than this are taken as the whole text rather than cut off.
+PREVIEW_CUT_LENGTH = 100
+
+# Words that announce a one-time code, and their lower-case spellings, which are
+# located with str.find so the patterns below only run where one of them occurs.
+CODE_WORDS = r"(?:code|otp|pin|passcode|verification|token|kod|c[oó]digo|codice|код)"
+CODE_WORD_SPELLINGS = ("code", "otp", "pin", "passcode", "verification", "token", "kod", "codigo", "código", "codice", "код")
+
+# How far before a code word a code may start ("482910 is your Acme code").
+CODE_BEFORE_REACH = 80
+
+# A code: 4-8 letters and digits with at least one digit, or digits in two groups of three.
+CODE = r"((?=[A-Z-]*\d)[A-Z0-9]{4,8}|\d{3}[- ]\d{3})"
+
+# "Your verification code for Acme is: 482910", matched at a code word
+CODE_AFTER_WORD = re.compile(rf"\b{CODE_WORDS}\w*(?:\W+[^\W\d]{{1,12}}){{0,3}}?[^\w<]+{CODE}\b", re.I)
+# "482910 is your Acme code", searched for just before a code word
+CODE_BEFORE_WORD = re.compile(rf"\b{CODE}\s+(?:is|ist|es|est|é)\b(?:\W+[^\W\d]{{1,12}}){{0,3}}?\W+{CODE_WORDS}", re.I)
+# A code alone on its line, as in most HTML templates; only trusted if a code word appears somewhere.
+CODE_LINE = re.compile(r"^[^\S\n]*(\d{4,8}|\d{3}[- ]\d{3})[^\S\n]*$", re.M)
+CODE_WORD = re.compile(rf"\b{CODE_WORDS}", re.I)
+# Four digits that are more likely a year than a code.
+YEAR = re.compile(r"(?:19|20)\d\d")
+
+# Links that confirm, verify or sign in, judged by the URL or the words around it.
+LINK_WORDS = re.compile(r"verif|confirm|activat|validat|magic|sign.?in|log.?in|auth|reset|token|otp", re.I)
+SKIP_LINK_WORDS = re.compile(r"unsubscribe|privacy|terms|preferences", re.I)
+URL = re.compile(r"https?://[^\s<>\"'()\[\]{}]+", re.I)
+ANCHOR = re.compile(r"<a\s[^>]*?href\s*=\s*[\"'](https?://[^\"']+)[\"'][^>]*>(.*?)</a\s*>", re.I | re.S)
+
+# Cheap HTML-to-text: drop invisible blocks, turn block ends into line breaks, strip the other tags.
+INVISIBLE = re.compile(r"<(script|style|head|title)\b.*?</\1\s*>|<!--.*?-->", re.I | re.S)
+BLOCK_END = re.compile(r"<(?:br|hr|/p|/div|/tr|/td|/th|/li|/h\d|/table)\b[^>]*>", re.I)
+TAG = re.compile(r"<[^>]*>")
+
+
+def html_to_text(body):
+    body = INVISIBLE.sub(" ", body[:MAX_SCAN_CHARS * 4])
+    return html.unescape(TAG.sub(" ", BLOCK_END.sub("\n", body)))
+
+
+def find_codes(text, partial=False):
+    """Returns the one-time codes in `text`, most explicit first.
+
+    With `partial` (a preview that may be cut off), a code touching the end of a
+    preview of PREVIEW_CUT_LENGTH or more characters is ignored.
+    """
+    positions = [start for start in _code_word_candidates(text) if CODE_WORD.match(text, start)]
+    if not positions:
+        return []
+    matches = [CODE_AFTER_WORD.match(text, start) for start in positions]
+    matches += [CODE_BEFORE_WORD.search(text, max(start - CODE_BEFORE_REACH, 0), start + 20) for start in positions]
+    matches += CODE_LINE.finditer(text)
+    cut_at = len(text) if partial and len(text) >= PREVIEW_CUT_LENGTH else None
+    codes = (match.group(1) for match in matches if match is not None and match.end(1) != cut_at)
+    return _unique(code for code in codes if not YEAR.fullmatch(code))[:MAX_CODES]
+
+
+def _code_word_candidates(text):
+    """Returns where CODE_WORD_SPELLINGS occur in `text` (inside other words too), in order."""
+    lowered = text.lower()
+    if len(lowered) != len(text):
+        # Lower-casing changed the length, so positions wouldn't line up; let the regex look everywhere.
+        return [match.start() for match in CODE_WORD.finditer(text)]
+    positions = []
+    for spelling in CODE_WORD_SPELLINGS:
+        start = lowered.find(spelling)
+        while start != -1:
+            positions.append(start)
+            start = lowered.find(spelling, start + 1)
+    return sorted(positions)
+
+
+def find_links(text, html_body=None):
+    """Returns the verification and sign-in links, from the HTML anchors if there is an HTML body."""
+    links = []
+    if html_body:
+        for match in ANCHOR.finditer(html_body[:MAX_SCAN_CHARS * 4]):
+            url = html.unescape(match.group(1))
+            label = TAG.sub("", match.group(2))
+            if LINK_WORDS.search(url) or LINK_WORDS.search(label):
+                links.append(url)
+    else:
+        # The words judged are those between the previous link and this one, at most 80 characters.
+        previous_end = 0
+        for match in URL.finditer(text):
+            url = match.group(0).rstrip(".,;:!?")
+            if LINK_WORDS.search(url) or LINK_WORDS.search(text, max(match.start() - 80, previous_end), match.start()):
+                links.append(url)
+            previous_end = match.end()
+    return _unique(url for url in links if not SKIP_LINK_WORDS.search(url))[:MAX_LINKS]
+
+
+def extract(subject, text=None, html_body=None, partial=False):
+    """Finds the codes and verification links in a message: {"codes": [...], "links": [...]}.
+
+    `text` is the plain body, or the preview with `partial` set, in which case
+    links are skipped since they may be cut off. Without a plain body the HTML
+    body is stripped to text.
+    """
+    if not text and html_body:
+        text = html_to_text(html_body)
+    text = (text or "")[:MAX_SCAN_CHARS]
+    codes = _unique(find_codes(subject or "") + find_codes(text, partial))[:MAX_CODES]
+    links = [] if partial else find_links(text, html_body)
+    return {"codes": codes, "links": links}
+
+
+def _unique(items):
+    seen = set()
+    return [item for item in items if not (item in seen or seen.add(item))]
@@ -2,7 +2,14 @@
 
 import logging
 import asyncio
-from pymailtm import MailTm
+import bisect
+import os
+from broadcast import BroadcastEngine
+from coalesce import SingleFlight
+from mailtm_client import MailTmClient
+from metrics import HANDLER_SECONDS, instrument_application, start_metrics_server, stop_metrics_server
+from providers import MailTmProvider, PrivatixProvider, ProviderError, ProviderRouter
+from rapidapi_client import RapidApiClient
 from telegram import Update, Bot
 from telegram.ext import (
     Application,
@@ -11,6 +18,9 @@ from telegram.ext import (
     MessageHandler,
     filters,
 )
+from update_processor import KeyedUpdateProcessor
+from user_export import EXPORT_FORMATS, export_users
+from webhook import bounded_update_queue, run_application
 
 # --- Configuration ---
 # Replace this with your bot token provided by BotFather.
@@ -20,6 +30,18 @@ BOT_TOKEN = "8444165710:AAGdrrL7rxdBudCf1amuFldtcYQ1KSFySIE"
 # This ID will be used to grant access to the admin panel.
 ADMIN_ID = 6994528708  # TODO: Change this to your actual user ID
 
+# Bot API server. Override to use a self-hosted Bot API server or a local test server.
+TELEGRAM_API_URL = os.environ.get("TELEGRAM_API_URL", "https://api.telegram.org/bot")
+
+# Users shown per /get_all_users reply
+USERS_PAGE_SIZE = 20
+
+# Fallback mail provider (privatix on RapidAPI): new addresses are created there
+# while mail.tm is slow or failing. Leave RAPIDAPI_KEY empty to use mail.tm only
+RAPIDAPI_KEY = os.environ.get("RAPIDAPI_KEY", "")
+RAPIDAPI_HOST = os.environ.get("RAPIDAPI_HOST", "privatix-temp-mail-v1.p.rapidapi.com")
+RAPIDAPI_BASE_URL = os.environ.get("RAPIDAPI_BASE_URL", f"https://{RAPIDAPI_HOST}")
+
 # Enable logging for a better understanding of the bot's behavior
 logging.basicConfig(
     format="%(asctime)s - %(name)s - %(levelname)s - %(message)s", level=logging.INFO
@@ -29,9 +51,34 @@ logging.getLogger("httpx").setLevel(logging.WARNING)
 # A simple in-memory dictionary to store user data.
 # In a real-world application, this should be replaced with a persistent database
 # like Firestore to avoid data loss when the bot restarts.
-# The structure will be: {telegram_user_id: MailTm.Account}
+# The structure will be: {telegram_user_id: mailtm_client.Account}
 user_accounts = {}
 
+# The keys of user_accounts in ascending order, kept in step by add_user() and remove_user()
+# so broadcasts and user listings find a page of IDs by bisection instead of a full scan.
+sorted_user_ids = []
+
+# Mail providers in order of preference, each with a shared connection pool. Address creation
+# is hedged across them and fails over when one keeps failing; everything else goes to the
+# provider the address lives on.
+mail_router = ProviderRouter(
+    [MailTmProvider(MailTmClient())] + (
+        [PrivatixProvider(RapidApiClient(RAPIDAPI_KEY, RAPIDAPI_HOST, base_url=RAPIDAPI_BASE_URL))]
+        if RAPIDAPI_KEY else []
+    )
+)
+
+# Inbox fetches in flight per user, so repeated /check_inbox requests share one upstream call.
+inflight = SingleFlight()
+
+# Local Prometheus endpoint, started in post_init (see metrics.METRICS_PORT).
+metrics_server = None
+
+# Background broadcast runner. Accounts aren't persisted here, so neither is its cursor.
+broadcast_engine = BroadcastEngine(
+    None, lambda after, limit: user_ids_after(after, limit), on_blocked=lambda chat_id: prune_blocked_user(chat_id)
+)
+
 # --- Bot Command Handlers ---
 
 async def start_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -72,10 +119,9 @@ async def new_email_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await update.message.reply_text("Generating a new temporary email address...")
 
     try:
-        # Create a new account using the pymailtm library.
-        mt = MailTm()
-        account = mt.get_account()
-        user_accounts[user_id] = account
+        # Create a new account on whichever mail provider answers first.
+        account = await mail_router.create_account()
+        add_user(user_id, account)
         
         await update.message.reply_html(
             "Your new temporary email address is:\n"
@@ -101,8 +147,8 @@ async def check_inbox_command(update: Update, context: ContextTypes.DEFAULT_TYPE
     await update.message.reply_text("Checking your inbox for new messages...")
     
     try:
-        # Retrieve messages from the account using the pymailtm library.
-        messages = account.get_messages()
+        # Retrieve messages (with bodies) from the account's mail provider.
+        messages = await inflight.do(user_id, lambda: mail_router.get_messages(account))
         
         if not messages:
             await update.message.reply_text("Your inbox is empty.")
@@ -119,11 +165,17 @@ async def check_inbox_command(update: Update, context: ContextTypes.DEFAULT_TYPE
             await update.message.reply_html(response_text)
     except Exception as e:
         logging.error(f"Error checking inbox for user {user_id}: {e}")
+        if not isinstance(e, ProviderError) or e.is_outage():
+            # Slow, failing or throttled upstream: the address is kept.
+            await update.message.reply_text(
+                "Couldn't reach the mail service right now. Your email address is kept; please try again in a minute."
+            )
+            return
         await update.message.reply_text(
             "An error occurred while checking your inbox. Your account may have expired."
         )
         # Remove the expired account from the dictionary
-        del user_accounts[user_id]
+        remove_user(user_id)
 
 async def admin_panel_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Shows the admin panel commands if the user is an admin."""
@@ -136,29 +188,62 @@ async def admin_panel_command(update: Update, context: ContextTypes.DEFAULT_TYPE
         "<b>Admin Panel</b>\n\n"
         "Welcome, Admin! Here are your available commands and features:\n"
         "• /broadcast [message] - Send a message to all active users.\n"
+        "• /cancel_broadcast - Stop the running broadcast.\n"
         "• /delete_account [user_id] - Delete a user's temporary account.\n"
-        "• /get_all_users - List all active users and their email addresses.\n"
+        "• /get_all_users [after_id] - List active users and their email addresses, a page at a time.\n"
+        "• /export_users [csv|jsonl] - Download all users as a file.\n"
         "• /stats - See bot usage statistics."
     )
     await update.message.reply_html(admin_commands)
 
 async def get_all_users_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    """Admin command to list all active users and their emails."""
+    """Admin command to list active users and their emails, one page per call."""
     user_id = update.effective_user.id
     if user_id != ADMIN_ID:
         await update.message.reply_text("You are not authorized to use this command.")
         return
 
-    if not user_accounts:
+    try:
+        after = int(context.args[0]) if context.args else None
+    except ValueError:
+        await update.message.reply_text("Usage: /get_all_users [after_id]")
+        return
+
+    user_ids = user_ids_after(after, USERS_PAGE_SIZE + 1)
+    if not user_ids:
         await update.message.reply_text("No users have created temporary accounts yet.")
         return
 
-    response_text = "<b>Active Users:</b>\n\n"
-    for telegram_id, account in user_accounts.items():
-        response_text += f"<b>User ID:</b> <code>{telegram_id}</code>\n"
-        response_text += f"<b>Email:</b> <code>{account.address}</code>\n"
-        response_text += f"----------------------------------------\n"
-    await update.message.reply_html(response_text)
+    has_next = len(user_ids) > USERS_PAGE_SIZE
+    user_ids = user_ids[:USERS_PAGE_SIZE]
+    blocks = [f"<b>Active Users ({len(user_accounts)}):</b>\n\n"]
+    for telegram_id in user_ids:
+        blocks.append(
+            f"<b>User ID:</b> <code>{telegram_id}</code>\n"
+            f"<b>Email:</b> <code>{user_accounts[telegram_id].address}</code>\n"
+            f"----------------------------------------\n"
+        )
+    if has_next:
+        blocks.append(f"\nNext page: /get_all_users {user_ids[-1]}")
+    await update.message.reply_html("".join(blocks))
+
+async def export_users_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Admin command to export every user as one CSV or JSONL document."""
+    user_id = update.effective_user.id
+    if user_id != ADMIN_ID:
+        await update.message.reply_text("You are not authorized to use this command.")
+        return
+
+    fmt = context.args[0].lower() if context.args else "csv"
+    if fmt not in EXPORT_FORMATS:
+        await update.message.reply_text("Usage: /export_users [csv|jsonl]")
+        return
+
+    buffer, count = await export_users(
+        user_ids_after, lambda telegram_id: getattr(user_accounts.get(telegram_id), "address", None), fmt
+    )
+    with buffer:
+        await update.message.reply_document(document=buffer, filename=f"users.{fmt}", caption=f"{count} users")
 
 async def stats_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Admin command to show bot statistics."""
@@ -168,8 +253,13 @@ async def stats_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return
     
     total_users = len(user_accounts)
+    handler_latency = HANDLER_SECONDS.total()
     stats_text = f"<b>Bot Statistics</b>\n\n"
     stats_text += f"Total Active Users: {total_users}\n"
+    stats_text += f"Handled Updates: {handler_latency.count}\n"
+    stats_text += "Response Time p50 / p95 / p99: " + " / ".join(
+        f"{handler_latency.percentile(p) * 1000:.0f}" for p in (0.50, 0.95, 0.99)
+    ) + " ms\n"
     await update.message.reply_html(stats_text)
 
 async def broadcast_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -187,14 +277,43 @@ async def broadcast_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if not user_accounts:
         await update.message.reply_text("No users to broadcast to.")
         return
-        
-    for telegram_id in user_accounts:
-        try:
-            await context.bot.send_message(chat_id=telegram_id, text=f"<b>📢 Broadcast Message:</b>\n{message_to_send}", parse_mode="HTML")
-        except Exception as e:
-            logging.error(f"Failed to send broadcast to user {telegram_id}: {e}")
-    
-    await update.message.reply_text("Broadcast message sent successfully to all active users.")
+
+    # The broadcast runs in the background; its progress message is edited as it goes.
+    started = await broadcast_engine.start(context.bot, message_to_send, update.effective_chat.id, len(user_accounts))
+    if not started:
+        await update.message.reply_text("A broadcast is already running. Use /cancel_broadcast to stop it.")
+
+async def cancel_broadcast_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Admin command to stop the running broadcast."""
+    user_id = update.effective_user.id
+    if user_id != ADMIN_ID:
+        await update.message.reply_text("You are not authorized to use this command.")
+        return
+
+    if broadcast_engine.cancel():
+        await update.message.reply_text("Stopping the broadcast after the current batch.")
+    else:
+        await update.message.reply_text("No broadcast is running.")
+
+def add_user(telegram_id, account):
+    """Stores a user's account."""
+    if telegram_id not in user_accounts:
+        bisect.insort(sorted_user_ids, telegram_id)
+    user_accounts[telegram_id] = account
+
+def remove_user(telegram_id):
+    """Forgets a user's account, if they have one."""
+    if user_accounts.pop(telegram_id, None) is not None:
+        del sorted_user_ids[bisect.bisect_left(sorted_user_ids, telegram_id)]
+
+def user_ids_after(after, limit):
+    """Returns the next `limit` user IDs above `after`, for the broadcast engine and user listings."""
+    start = 0 if after is None else bisect.bisect_right(sorted_user_ids, after)
+    return sorted_user_ids[start:start + limit]
+
+def prune_blocked_user(telegram_id):
+    """Forgets a user who blocked the bot, so later broadcasts skip them."""
+    remove_user(telegram_id)
 
 async def delete_account_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Admin command to delete a specific user's temporary account."""
@@ -212,10 +331,10 @@ async def delete_account_command(update: Update, context: ContextTypes.DEFAULT_T
         target_user_id = int(context.args[0])
         if target_user_id in user_accounts:
             account = user_accounts[target_user_id]
-            # Call the delete method from the pymailtm library
-            is_deleted = account.delete_account()
+            # Delete the account upstream, on its mail provider
+            is_deleted = await mail_router.delete_account(account)
             if is_deleted:
-                del user_accounts[target_user_id]
+                remove_user(target_user_id)
                 await update.message.reply_text(f"Account for user ID <code>{target_user_id}</code> deleted successfully.")
             else:
                 await update.message.reply_text(f"Failed to delete the account for user ID <code>{target_user_id}</code>.")
@@ -238,10 +357,31 @@ async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     )
     await update.message.reply_html(help_text)
 
+async def post_init(application: Application):
+    """Starts the metrics endpoint."""
+    global metrics_server
+    metrics_server = await start_metrics_server()
+
+async def post_shutdown(application: Application):
+    """Stops a running broadcast and closes the pooled mail provider connections and the metrics endpoint."""
+    await broadcast_engine.stop()
+    await mail_router.close()
+    await stop_metrics_server(metrics_server)
+
 # The main function to set up and run the bot
 def main():
     """Start the bot."""
-    application = Application.builder().token(BOT_TOKEN).build()
+    # Different users' updates run concurrently; each user's run one at a time, in order
+    application = (
+        Application.builder()
+        .token(BOT_TOKEN)
+        .base_url(TELEGRAM_API_URL)
+        .update_queue(bounded_update_queue())
+        .concurrent_updates(KeyedUpdateProcessor())
+        .post_init(post_init)
+        .post_shutdown(post_shutdown)
+        .build()
+    )
 
     # Register command handlers
     application.add_handler(CommandHandler("start", start_command))
@@ -253,12 +393,18 @@ def main():
     # Register admin-specific command handlers
     application.add_handler(CommandHandler("admin", admin_panel_command))
     application.add_handler(CommandHandler("get_all_users", get_all_users_command))
+    application.add_handler(CommandHandler("export_users", export_users_command))
     application.add_handler(CommandHandler("stats", stats_command))
     application.add_handler(CommandHandler("broadcast", broadcast_command))
+    application.add_handler(CommandHandler("cancel_broadcast", cancel_broadcast_command))
     application.add_handler(CommandHandler("delete_account", delete_account_command))
+
+    # Time every handler and expose the queue depths on the metrics endpoint
+    instrument_application(application)
     
     # Run the bot until the user presses Ctrl-C
-    application.run_polling(allowed_updates=Update.ALL_TYPES)
+    # Webhook when WEBHOOK_URL is set, long polling otherwise; only the handled update types are requested
+    run_application(application)
 
 if __name__ == "__main__":
     main()
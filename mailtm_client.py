@@ -0,0 +1,326 @@
+# mailtm_client.py
+
+import asyncio
+import base64
+import json
+import logging
+import os
+import random
+import string
+import time
+
+import httpx
+
+from domain_cache import DomainCache
+from metrics import UPSTREAM_ERRORS, UPSTREAM_IN_PROGRESS, UPSTREAM_SECONDS, endpoint_label, timed
+
+# --- Configuration ---
+MAILTM_API_URL = os.environ.get("MAILTM_API_URL", "https://api.mail.tm")
+
+# Seconds allowed for a single mail.tm call (connect + read) before it is abandoned.
+REQUEST_TIMEOUT = 10.0
+
+# Size of the shared keep-alive connection pool.
+MAX_CONNECTIONS = 20
+MAX_KEEPALIVE_CONNECTIONS = 10
+
+# Upper bound on mail.tm calls in flight at once, across all users.
+MAX_CONCURRENT_REQUESTS = 20
+
+# Tokens are refreshed this many seconds before they expire.
+TOKEN_REFRESH_MARGIN = 60
+
+# Lifetime assumed for a token whose JWT carries no `exp` claim.
+DEFAULT_TOKEN_TTL = 3600
+
+logger = logging.getLogger(__name__)
+
+
+class MailTmError(Exception):
+    """Raised when mail.tm can't be reached or answers with an error status."""
+
+    def __init__(self, message, status_code=None):
+        super().__init__(message)
+        self.status_code = status_code
+
+
+class Message:
+    """A single mail.tm message. `text` and `html` are only set once the full message is fetched."""
+
+    def __init__(self, id_, from_, subject, intro, text=None, html=None, seen=False, created_at=None, data=None):
+        self.id_ = id_
+        self.from_ = from_
+        self.subject = subject
+        self.intro = intro
+        self.text = text
+        self.html = html
+        self.seen = seen
+        self.created_at = created_at
+        self.data = data
+
+    def preview(self):
+        """Returns a copy without the bodies or raw JSON, for caching inbox listings."""
+        return Message(self.id_, self.from_, self.subject, self.intro, seen=self.seen, created_at=self.created_at)
+
+    def to_dict(self):
+        """Returns the fields kept when the message is cached outside the process (the raw JSON is dropped)."""
+        return {
+            'id': self.id_, 'from': self.from_, 'subject': self.subject, 'intro': self.intro,
+            'text': self.text, 'html': self.html, 'seen': self.seen, 'created_at': self.created_at,
+        }
+
+    @classmethod
+    def from_dict(cls, data):
+        return cls(
+            id_=data['id'], from_=data['from'], subject=data['subject'], intro=data['intro'],
+            text=data.get('text'), html=data.get('html'), seen=data.get('seen', False),
+            created_at=data.get('created_at'),
+        )
+
+    @classmethod
+    def from_json(cls, data):
+        html = data.get("html")
+        return cls(
+            id_=data["id"],
+            from_=data.get("from") or {},
+            subject=data.get("subject") or "",
+            intro=data.get("intro") or "",
+            text=data.get("text"),
+            html="".join(html) if isinstance(html, list) else html,
+            seen=data.get("seen", False),
+            created_at=data.get("createdAt"),
+            data=data,
+        )
+
+
+def token_expiry(token):
+    """Returns the `exp` claim of a JWT as a Unix timestamp. The signature is not checked."""
+    try:
+        payload = token.split(".")[1]
+        claims = json.loads(base64.urlsafe_b64decode(payload + "=" * (-len(payload) % 4)))
+        return float(claims["exp"])
+    except (IndexError, KeyError, TypeError, ValueError):
+        return time.time() + DEFAULT_TOKEN_TTL
+
+
+class MessageList(list):
+    """One page of messages, plus the total number of messages in the inbox."""
+
+    def __init__(self, messages, total):
+        super().__init__(messages)
+        self.total = total
+
+
+class Account:
+    """A mail.tm account. Unlike pymailtm's Account, creating one does not log in;
+    a token is obtained on first use and reused until shortly before it expires.
+
+    `provider` names the mail provider the address lives on (see providers.py);
+    accounts of other providers use only the fields they need.
+    """
+
+    def __init__(self, id, address, password, token=None, token_expires=None, provider="mailtm"):
+        self.id_ = id
+        self.address = address
+        self.password = password
+        self.token = token
+        self.token_expires = token_expires
+        self.provider = provider
+
+    def token_is_fresh(self):
+        return (
+            self.token is not None
+            and self.token_expires is not None
+            and self.token_expires - TOKEN_REFRESH_MARGIN > time.time()
+        )
+
+    def to_dict(self):
+        """Returns the fields that are persisted in the account store."""
+        data = {'id': self.id_, 'address': self.address, 'password': self.password}
+        if self.token is not None:
+            data['token'] = self.token
+            data['token_expires'] = self.token_expires
+        if self.provider != "mailtm":
+            data['provider'] = self.provider
+        return data
+
+    @classmethod
+    def from_dict(cls, data):
+        return cls(
+            id=data['id'],
+            address=data['address'],
+            password=data['password'],
+            token=data.get('token'),
+            token_expires=data.get('token_expires'),
+            provider=data.get('provider', "mailtm"),
+        )
+
+
+class MailTmClient:
+    """Asyncio mail.tm client sharing one keep-alive connection pool across all users."""
+
+    def __init__(
+        self,
+        base_url=MAILTM_API_URL,
+        timeout=REQUEST_TIMEOUT,
+        max_connections=MAX_CONNECTIONS,
+        max_concurrency=MAX_CONCURRENT_REQUESTS,
+        on_token_refresh=None,
+        domain_cache_file=None,
+    ):
+        self.base_url = base_url
+        # Called with the Account whenever it gets a new token, so callers can persist it.
+        self.on_token_refresh = on_token_refresh
+        self.timeout = timeout
+        self.limits = httpx.Limits(
+            max_connections=max_connections,
+            max_keepalive_connections=min(MAX_KEEPALIVE_CONNECTIONS, max_connections),
+        )
+        self._semaphore = asyncio.Semaphore(max_concurrency)
+        self._client = None
+        # The domain list rarely changes, so account creation reads it from a cache.
+        self.domains = DomainCache(self.get_domains, path=domain_cache_file)
+        # In-flight logins keyed by account ID, so concurrent callers share one /token call.
+        self._refreshes = {}
+
+    def _get_client(self):
+        # The httpx client is created lazily so it binds to the running event loop.
+        if self._client is None:
+            self._client = httpx.AsyncClient(
+                base_url=self.base_url,
+                timeout=self.timeout,
+                limits=self.limits,
+                headers={"Accept": "application/ld+json"},
+            )
+        return self._client
+
+    async def close(self):
+        """Closes the pooled connections."""
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
+
+    async def _request(self, method, path, token=None, **kwargs):
+        headers = {"Authorization": f"Bearer {token}"} if token else None
+        # Timed inside the semaphore, so the latency is mail.tm's and not our own queueing.
+        async with self._semaphore:
+            with timed(UPSTREAM_SECONDS, UPSTREAM_ERRORS, UPSTREAM_IN_PROGRESS,
+                       service="mailtm", endpoint=endpoint_label(method, path)):
+                try:
+                    response = await self._get_client().request(method, path, headers=headers, **kwargs)
+                except httpx.TimeoutException as e:
+                    raise MailTmError(f"{method} {path} timed out after {self.timeout}s") from e
+                except httpx.HTTPError as e:
+                    raise MailTmError(f"{method} {path} failed: {e}") from e
+                if response.status_code >= 400:
+                    raise MailTmError(
+                        f"{method} {path} returned HTTP {response.status_code}",
+                        status_code=response.status_code,
+                    )
+        return response.json() if response.content else None
+
+    # --- Accounts ---
+
+    async def get_domains(self):
+        """Returns the list of active mail.tm domains."""
+        data = await self._request("GET", "/domains")
+        return [domain["domain"] for domain in data["hydra:member"] if domain.get("isActive", True)]
+
+    async def create_account(self, password=None):
+        """Registers a new random address on the first available domain and logs in to it."""
+        domains = await self.domains.get()
+        if not domains:
+            raise MailTmError("No mail.tm domains are available")
+        username = "".join(random.choice(string.ascii_lowercase) for _ in range(10))
+        password = password or "".join(random.choice(string.ascii_letters + string.digits) for _ in range(12))
+        address = f"{username}@{domains[0]}"
+        data = await self._request("POST", "/accounts", json={"address": address, "password": password})
+        account = Account(id=data["id"], address=data["address"], password=password)
+        await self.login(account)
+        logger.info(f"Created mail.tm account {account.address}")
+        return account
+
+    async def login(self, account):
+        """Fetches a fresh JWT for the account.
+
+        Concurrent calls for the same account share a single /token request, and
+        each caller's Account object gets its result, even if it isn't the
+        instance that started the request.
+        """
+        task = self._refreshes.get(account.id_)
+        if task is None:
+            task = asyncio.ensure_future(self._login(account))
+            self._refreshes[account.id_] = task
+            task.add_done_callback(lambda _: self._refreshes.pop(account.id_, None))
+        # Shielded so one cancelled caller doesn't abort the login for everyone else.
+        account.token, account.token_expires = await asyncio.shield(task)
+        return account.token
+
+    async def _login(self, account):
+        data = await self._request(
+            "POST", "/token", json={"address": account.address, "password": account.password}
+        )
+        account.token = data["token"]
+        account.token_expires = token_expiry(account.token)
+        if self.on_token_refresh is not None:
+            self.on_token_refresh(account)
+        return account.token, account.token_expires
+
+    async def ensure_token(self, account):
+        """Returns a token for the account that is valid for at least TOKEN_REFRESH_MARGIN seconds."""
+        if not account.token_is_fresh():
+            await self.login(account)
+        return account.token
+
+    async def _authorized_request(self, account, method, path, **kwargs):
+        token = await self.ensure_token(account)
+        try:
+            return await self._request(method, path, token=token, **kwargs)
+        except MailTmError as e:
+            if e.status_code != 401:
+                raise
+        # The token was revoked or expired early: log in again (unless another
+        # request already did) and retry once.
+        if account.token == token:
+            await self.login(account)
+        return await self._request(method, path, token=account.token, **kwargs)
+
+    async def account_exists(self, account):
+        """Returns False if mail.tm no longer knows the account (deleted or expired), True if it does.
+
+        Other failures raise MailTmError, as they say nothing about the account.
+        """
+        try:
+            await self._authorized_request(account, "GET", "/me")
+        except MailTmError as e:
+            if e.status_code in (401, 404):
+                return False
+            raise
+        return True
+
+    async def delete_account(self, account):
+        """Deletes the account on mail.tm. Returns True on success, False otherwise."""
+        try:
+            await self._authorized_request(account, "DELETE", f"/accounts/{account.id_}")
+        except MailTmError as e:
+            logger.error(f"Failed to delete mail.tm account {account.address}: {e}")
+            return False
+        return True
+
+    # --- Messages ---
+
+    async def list_messages(self, account, page=1):
+        """Returns one page of message previews (no bodies) as a MessageList."""
+        data = await self._authorized_request(account, "GET", "/messages", params={"page": page})
+        messages = [Message.from_json(item) for item in data["hydra:member"]]
+        return MessageList(messages, data.get("hydra:totalItems", len(messages)))
+
+    async def get_message(self, account, message_id):
+        """Returns a single message including its text and html bodies."""
+        data = await self._authorized_request(account, "GET", f"/messages/{message_id}")
+        return Message.from_json(data)
+
+    async def get_messages(self, account, page=1):
+        """Returns one page of messages with full bodies, fetched concurrently."""
+        previews = await self.list_messages(account, page)
+        return list(await asyncio.gather(*(self.get_message(account, msg.id_) for msg in previews)))
@@ -0,0 +1,300 @@
+# metrics.py
+
+import asyncio
+import bisect
+import functools
+import logging
+import os
+import re
+import time
+from contextlib import contextmanager
+
+from update_processor import KeyedUpdateProcessor
+
+# --- Configuration ---
+# Local address the metrics are served on, in Prometheus text format at /metrics.
+# Give every worker process its own port; METRICS_PORT=0 turns the endpoint off.
+METRICS_LISTEN = os.environ.get("METRICS_LISTEN", "127.0.0.1")
+METRICS_PORT = int(os.environ.get("METRICS_PORT", "9108"))
+
+# Latency histogram bucket bounds in seconds: 1 ms to about 70 s, each 25% above
+# the last, so percentiles interpolated inside a bucket are within a few percent.
+LATENCY_BUCKETS = tuple(round(0.001 * 1.25 ** i, 6) for i in range(51))
+
+# Seconds a scrape may take to send its request line and headers.
+SCRAPE_READ_TIMEOUT = 5.0
+
+logger = logging.getLogger(__name__)
+
+
+class Counter:
+    __slots__ = ("value",)
+
+    def __init__(self):
+        self.value = 0
+
+    def inc(self, amount=1):
+        self.value += amount
+
+
+class Gauge:
+    __slots__ = ("value",)
+
+    def __init__(self):
+        self.value = 0
+
+    def inc(self, amount=1):
+        self.value += amount
+
+    def dec(self, amount=1):
+        self.value -= amount
+
+    def set(self, value):
+        self.value = value
+
+
+class Histogram:
+    """Fixed-bucket histogram: recording is one bisect and three additions, whatever the number of samples."""
+
+    __slots__ = ("bounds", "counts", "count", "sum")
+
+    def __init__(self, bounds=LATENCY_BUCKETS):
+        self.bounds = bounds
+        # counts[i] holds samples <= bounds[i] and > bounds[i - 1]; the last slot is +Inf.
+        self.counts = [0] * (len(bounds) + 1)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def merge(self, other):
+        for i, n in enumerate(other.counts):
+            self.counts[i] += n
+        self.count += other.count
+        self.sum += other.sum
+
+    def percentile(self, p):
+        """Estimates the p-th quantile (0-1) by interpolating inside the bucket it falls in."""
+        if not self.count:
+            return 0.0
+        rank = p * self.count
+        seen = 0
+        for i, n in enumerate(self.counts):
+            if n and seen + n >= rank:
+                lower = self.bounds[i - 1] if i else 0.0
+                if i == len(self.bounds):
+                    return lower
+                return lower + (self.bounds[i] - lower) * (rank - seen) / n
+            seen += n
+        return self.bounds[-1]
+
+
+class MetricFamily:
+    """One named metric, with a child Counter/Gauge/Histogram per combination of label values."""
+
+    def __init__(self, name, kind, help_text, factory):
+        self.name = name
+        self.kind = kind
+        self.help = help_text
+        self.factory = factory
+        self.children = {}
+
+    def labels(self, **labels):
+        key = tuple(sorted(labels.items()))
+        child = self.children.get(key)
+        if child is None:
+            child = self.children[key] = self.factory()
+        return child
+
+    def total(self):
+        """Returns all children merged into one histogram (histogram families only)."""
+        merged = Histogram()
+        for child in self.children.values():
+            merged.merge(child)
+        return merged
+
+
+class MetricsRegistry:
+    def __init__(self):
+        self._families = {}
+        # name -> (help, function returning the current value), read at scrape time.
+        self._gauge_functions = {}
+
+    def _family(self, name, kind, help_text, factory):
+        family = self._families.get(name)
+        if family is None:
+            family = self._families[name] = MetricFamily(name, kind, help_text, factory)
+        return family
+
+    def counter(self, name, help_text):
+        return self._family(name, "counter", help_text, Counter)
+
+    def gauge(self, name, help_text):
+        return self._family(name, "gauge", help_text, Gauge)
+
+    def histogram(self, name, help_text):
+        return self._family(name, "histogram", help_text, Histogram)
+
+    def gauge_function(self, name, help_text, function):
+        """Registers a gauge whose value is computed by `function()` whenever metrics are read."""
+        self._gauge_functions[name] = (help_text, function)
+
+    def render(self):
+        """Returns every metric in the Prometheus text exposition format."""
+        lines = []
+        for family in self._families.values():
+            lines.append(f"# HELP {family.name} {family.help}")
+            lines.append(f"# TYPE {family.name} {family.kind}")
+            for key, child in family.children.items():
+                if family.kind != "histogram":
+                    lines.append(f"{family.name}{_labels(key)} {child.value}")
+                    continue
+                cumulative = 0
+                for bound, n in zip(child.bounds, child.counts):
+                    cumulative += n
+                    lines.append(f"{family.name}_bucket{_labels(key + (('le', repr(bound)),))} {cumulative}")
+                lines.append(f"{family.name}_bucket{_labels(key + (('le', '+Inf'),))} {child.count}")
+                lines.append(f"{family.name}_sum{_labels(key)} {child.sum}")
+                lines.append(f"{family.name}_count{_labels(key)} {child.count}")
+        for name, (help_text, function) in self._gauge_functions.items():
+            try:
+                value = function()
+            except Exception as e:
+                logger.warning(f"Could not read gauge {name}: {e}")
+                continue
+            lines.extend([f"# HELP {name} {help_text}", f"# TYPE {name} gauge", f"{name} {value}"])
+        return "\n".join(lines) + "\n"
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _labels(key):
+    if not key:
+        return ""
+    return "{" + ",".join(f'{name}="{_escape(value)}"' for name, value in key) + "}"
+
+
+# Process-wide registry; the instrumented modules all record into it.
+registry = MetricsRegistry()
+
+HANDLER_SECONDS = registry.histogram("bot_handler_seconds", "Time spent in each update handler.")
+HANDLER_ERRORS = registry.counter("bot_handler_errors_total", "Update handlers that raised an exception.")
+HANDLERS_IN_PROGRESS = registry.gauge("bot_handlers_in_progress", "Update handlers running now.")
+UPSTREAM_SECONDS = registry.histogram("bot_upstream_request_seconds", "Duration of upstream API calls, failed ones included.")
+UPSTREAM_ERRORS = registry.counter("bot_upstream_errors_total", "Upstream API calls that failed or returned an HTTP error.")
+UPSTREAM_IN_PROGRESS = registry.gauge("bot_upstream_requests_in_progress", "Upstream API calls in flight.")
+
+
+@contextmanager
+def timed(histogram, errors, in_progress, **labels):
+    """Records the block's duration in `histogram`, counts it in `errors` if it raises, and in `in_progress` while it runs."""
+    gauge = in_progress.labels(**labels)
+    gauge.inc()
+    started = time.perf_counter()
+    try:
+        yield
+    except BaseException as e:
+        # A cancelled wait is the caller giving up, not the call failing.
+        if not isinstance(e, asyncio.CancelledError):
+            errors.labels(**labels).inc()
+        raise
+    finally:
+        histogram.labels(**labels).observe(time.perf_counter() - started)
+        gauge.dec()
+
+
+def endpoint_label(method, path):
+    """Turns a request path into a low-cardinality label: query dropped, segments with digits (IDs, hashes) replaced."""
+    return f"{method} {re.sub(r'/[^/]*[0-9][^/]*', '/{id}', path.split('?', 1)[0])}"
+
+
+def _timed_callback(callback):
+    name = getattr(callback, "__name__", repr(callback))
+
+    @functools.wraps(callback)
+    async def wrapper(update, context):
+        with timed(HANDLER_SECONDS, HANDLER_ERRORS, HANDLERS_IN_PROGRESS, handler=name):
+            return await callback(update, context)
+
+    return wrapper
+
+
+def instrument_application(application):
+    """Times every registered handler and exposes the update queue depths as gauges.
+
+    Handlers in negative groups only do bookkeeping ahead of the real handlers
+    and aren't timed, so each update is counted once. Call it after all
+    handlers are added.
+    """
+    for group, handlers in application.handlers.items():
+        if group < 0:
+            continue
+        for handler in handlers:
+            if getattr(handler, "callback", None) is not None:
+                handler.callback = _timed_callback(handler.callback)
+    registry.gauge_function(
+        "bot_update_queue_size", "Updates received but not yet picked up.", application.update_queue.qsize
+    )
+    processor = application.update_processor
+    if isinstance(processor, KeyedUpdateProcessor):
+        registry.gauge_function(
+            "bot_updates_queued_per_user", "Updates waiting behind an earlier update from the same user.",
+            lambda: processor.stats()["queued"]
+        )
+
+
+def latency_summary(family, errors, limit=5):
+    """Returns [(label values, calls, errors, p50, p95, p99)] for the busiest children of a histogram family."""
+    rows = []
+    for key, histogram in family.children.items():
+        label = " ".join(str(value) for _, value in key)
+        failed = errors.children.get(key)
+        rows.append((
+            label, histogram.count, failed.value if failed else 0,
+            histogram.percentile(0.50), histogram.percentile(0.95), histogram.percentile(0.99)
+        ))
+    rows.sort(key=lambda row: row[1], reverse=True)
+    return rows[:limit]
+
+
+async def _serve_scrape(reader, writer):
+    try:
+        request = await asyncio.wait_for(reader.readuntil(b"\r\n\r\n"), SCRAPE_READ_TIMEOUT)
+        parts = request.split(b" ", 2)
+        if len(parts) > 1 and parts[0] == b"GET" and parts[1].split(b"?", 1)[0] == b"/metrics":
+            status, body = b"200 OK", registry.render().encode()
+        else:
+            status, body = b"404 Not Found", b""
+        writer.write(
+            b"HTTP/1.1 " + status + b"\r\nContent-Type: text/plain; version=0.0.4; charset=utf-8\r\n"
+            b"Content-Length: " + str(len(body)).encode() + b"\r\nConnection: close\r\n\r\n" + body
+        )
+        await writer.drain()
+    except (asyncio.TimeoutError, asyncio.IncompleteReadError, asyncio.LimitOverrunError, ConnectionError):
+        pass
+    finally:
+        writer.close()
+
+
+async def start_metrics_server(listen=METRICS_LISTEN, port=METRICS_PORT):
+    """Starts serving /metrics; returns the asyncio server, or None when disabled or the port is taken."""
+    if not port:
+        return None
+    try:
+        server = await asyncio.start_server(_serve_scrape, listen, port)
+    except OSError as e:
+        logger.warning(f"Metrics endpoint not started on {listen}:{port}: {e}")
+        return None
+    logger.info(f"Serving metrics on http://{listen}:{port}/metrics")
+    return server
+
+
+async def stop_metrics_server(server):
+    if server is not None:
+        server.close()
+        await server.wait_closed()
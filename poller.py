@@ -0,0 +1,232 @@
+# poller.py
+
+import asyncio
+import heapq
+import logging
+import random
+import time
+
+from providers import ProviderError
+
+# Seconds between scheduler ticks on the JobQueue.
+POLL_TICK = 1.0
+
+# Poll interval for accounts that were just created or just received mail.
+FAST_INTERVAL = 5.0
+
+# Idle accounts back off by BACKOFF_FACTOR per empty poll, up to MAX_INTERVAL.
+BACKOFF_FACTOR = 2.0
+MAX_INTERVAL = 600.0
+
+# Upper bound on inbox polls in flight at once, across all accounts. Kept well below the
+# mail.tm client's MAX_CONCURRENT_REQUESTS, so interactive requests keep most of its slots.
+MAX_CONCURRENT_POLLS = 4
+
+# Only accounts whose owner was active within IDLE_AFTER seconds are polled, at most
+# MAX_TRACKED of them (the most recently active). The activity index is read again
+# every ACTIVITY_REFRESH_INTERVAL seconds to pick up returning users and drop idle ones.
+IDLE_AFTER = 24 * 60 * 60
+MAX_TRACKED = 5000
+ACTIVITY_REFRESH_INTERVAL = 60
+
+logger = logging.getLogger(__name__)
+
+
+class PollState:
+    __slots__ = ("interval", "seen_ids", "generation", "streaming", "active_at")
+
+    def __init__(self, interval, seen_ids, active_at):
+        self.interval = interval
+        # None until the first poll, which only records what is already in the inbox.
+        self.seen_ids = seen_ids
+        self.generation = 0
+        # True while a live event stream covers this account; polling is then only a safety net.
+        self.streaming = False
+        # When the owner was last known to be active (Unix time).
+        self.active_at = active_at
+
+
+class InboxPoller:
+    """Polls tracked inboxes from the JobQueue and pushes only new messages to their owners.
+
+    Every account has its own interval: FAST_INTERVAL right after it is created or
+    receives mail, then multiplied by BACKOFF_FACTOR on each empty poll up to
+    MAX_INTERVAL. Due accounts sit in a heap, so a tick costs O(log n) per poll
+    rather than a scan of every account.
+
+    Only new accounts and those of recently active users are tracked (see
+    refresh()), so the poll rate follows the active users, not every stored
+    account. Ticks are skipped while `is_busy()` says interactive traffic needs
+    the upstream capacity.
+    """
+
+    def __init__(self, mail_client, get_account, on_new_messages, on_poll=None, recently_active=None,
+                 is_busy=None, max_concurrency=MAX_CONCURRENT_POLLS, max_tracked=MAX_TRACKED, idle_after=IDLE_AFTER):
+        self.mail_client = mail_client
+        # get_account(user_id) -> Account or None
+        self.get_account = get_account
+        # await on_new_messages(bot, user_id, account, messages), with full messages
+        self.on_new_messages = on_new_messages
+        # on_poll(user_id, previews), after every successful list call
+        self.on_poll = on_poll
+        # recently_active(since, limit) -> [(user_id, last_active)], most recent first
+        self.recently_active = recently_active
+        self.is_busy = is_busy or (lambda: False)
+        self.max_concurrency = max_concurrency
+        self.max_tracked = max_tracked
+        self.idle_after = idle_after
+        self._refreshed_at = None
+        self._states = {}
+        # (due_time, generation, user_id); entries with a stale generation are skipped.
+        self._due = []
+        self._in_flight = set()
+
+    def __len__(self):
+        return len(self._states)
+
+    def track(self, user_id, fresh=True, delay=0.0, active_at=None):
+        """Starts (or restarts) polling an account.
+
+        `fresh` accounts poll fast and notify about everything they receive; others
+        start at MAX_INTERVAL and treat their current inbox as already seen.
+        """
+        state = PollState(FAST_INTERVAL if fresh else MAX_INTERVAL, set() if fresh else None, active_at or time.time())
+        old = self._states.get(user_id)
+        if old is not None:
+            state.generation = old.generation + 1
+        self._states[user_id] = state
+        self._schedule(user_id, state, delay)
+
+    def forget(self, user_id):
+        self._states.pop(user_id, None)
+
+    def mark_seen(self, user_id, message_ids):
+        """Records messages the user already saw in their inbox, so they aren't pushed again."""
+        state = self._states.get(user_id)
+        if state is not None and state.seen_ids is not None:
+            state.seen_ids.update(message_ids)
+
+    def claim(self, user_id, message_id):
+        """Marks a message as seen. Returns False if it was already seen (e.g. pushed by a poll)."""
+        state = self._states.get(user_id)
+        if state is None or state.seen_ids is None:
+            return True
+        if message_id in state.seen_ids:
+            return False
+        state.seen_ids.add(message_id)
+        return True
+
+    def release(self, user_id, message_id):
+        """Unmarks a claimed message whose body couldn't be fetched, so the next poll retries it."""
+        state = self._states.get(user_id)
+        if state is not None and state.seen_ids is not None:
+            state.seen_ids.discard(message_id)
+
+    def set_streaming(self, user_id, streaming):
+        """Slows polling to MAX_INTERVAL while an event stream delivers mail, and resumes fast polling when it drops."""
+        state = self._states.get(user_id)
+        if state is None or state.streaming == streaming:
+            return
+        state.streaming = streaming
+        if streaming:
+            state.interval = MAX_INTERVAL
+        else:
+            self.speed_up(user_id)
+
+    def speed_up(self, user_id):
+        """Switches an account back to the fast interval, e.g. after user activity."""
+        state = self._states.get(user_id)
+        if state is not None and not state.streaming and state.interval > FAST_INTERVAL:
+            state.interval = FAST_INTERVAL
+            state.generation += 1
+            self._schedule(user_id, state, FAST_INTERVAL)
+
+    async def refresh(self, context=None):
+        """Tracks the accounts of recently active users, and forgets those idle for longer than `idle_after`.
+
+        The first refresh takes every account active within `idle_after`, spread
+        over MAX_INTERVAL to avoid a burst; later ones only those active since the
+        previous refresh.
+        """
+        now = time.time()
+        cutoff = now - self.idle_after
+        for user_id in [user_id for user_id, state in self._states.items() if state.active_at < cutoff]:
+            self.forget(user_id)
+        if self.recently_active is not None:
+            first = self._refreshed_at is None
+            # Later refreshes overlap by an interval, for activity still being flushed to the store.
+            since = cutoff if first else self._refreshed_at - ACTIVITY_REFRESH_INTERVAL
+            spread = MAX_INTERVAL if first else ACTIVITY_REFRESH_INTERVAL
+            self._refreshed_at = now
+            for user_id, last_active in self.recently_active(since, self.max_tracked):
+                state = self._states.get(user_id)
+                if state is not None:
+                    state.active_at = max(state.active_at, last_active)
+                elif len(self._states) < self.max_tracked:
+                    self.track(user_id, fresh=False, delay=random.uniform(0, spread), active_at=last_active)
+
+    def start(self, job_queue):
+        job_queue.run_repeating(self.tick, interval=POLL_TICK, first=POLL_TICK, name="inbox_poller")
+        job_queue.run_repeating(self.refresh, interval=ACTIVITY_REFRESH_INTERVAL, first=POLL_TICK,
+                                name="inbox_poller_refresh")
+
+    def _schedule(self, user_id, state, delay):
+        heapq.heappush(self._due, (time.monotonic() + delay, state.generation, user_id))
+
+    async def tick(self, context):
+        # Due accounts stay queued until users no longer need the capacity.
+        if self.is_busy():
+            return
+        now = time.monotonic()
+        while self._due and self._due[0][0] <= now and len(self._in_flight) < self.max_concurrency:
+            _, generation, user_id = heapq.heappop(self._due)
+            state = self._states.get(user_id)
+            if state is None or state.generation != generation or user_id in self._in_flight:
+                continue
+            self._in_flight.add(user_id)
+            context.application.create_task(self._poll(context.bot, user_id, state))
+
+    async def _poll(self, bot, user_id, state):
+        try:
+            account = self.get_account(user_id)
+            if account is None:
+                self.forget(user_id)
+                return
+            try:
+                previews = await self.mail_client.list_messages(account)
+            except ProviderError as e:
+                logger.debug(f"Inbox poll failed for user {user_id}: {e}")
+                new = []
+            else:
+                if self.on_poll is not None:
+                    self.on_poll(user_id, previews)
+                if state.seen_ids is None:
+                    state.seen_ids = {msg.id_ for msg in previews}
+                    new = []
+                else:
+                    new = [msg for msg in previews if msg.id_ not in state.seen_ids]
+                    state.seen_ids.update(msg.id_ for msg in new)
+            if new:
+                state.interval = MAX_INTERVAL if state.streaming else FAST_INTERVAL
+                fetched = await asyncio.gather(
+                    *(self.mail_client.get_message(account, msg.id_) for msg in new), return_exceptions=True
+                )
+                messages = []
+                for preview, msg in zip(new, fetched):
+                    if isinstance(msg, Exception):
+                        logger.debug(f"Fetching message {preview.id_} failed for user {user_id}: {msg}")
+                        self.release(user_id, preview.id_)
+                    else:
+                        messages.append(msg)
+                if messages:
+                    await self.on_new_messages(bot, user_id, account, messages)
+            else:
+                state.interval = min(state.interval * BACKOFF_FACTOR, MAX_INTERVAL)
+        except Exception as e:
+            logger.error(f"Error polling inbox for user {user_id}: {e}")
+        finally:
+            self._in_flight.discard(user_id)
+            if self._states.get(user_id) is state:
+                # Bump the generation so an entry pushed by speed_up() meanwhile is dropped.
+                state.generation += 1
+                self._schedule(user_id, state, state.interval)
@@ -0,0 +1,382 @@
+# providers.py
+
+import asyncio
+import hashlib
+import logging
+import random
+import time
+import uuid
+from collections import deque
+from contextlib import contextmanager
+from datetime import datetime, timezone
+
+from domain_cache import DomainCache
+from mailtm_client import Account, MailTmError, Message, MessageList
+from metrics import registry
+from rapidapi_client import RapidApiError
+
+# Recent account creations kept per provider to estimate its p95 creation time.
+HEDGE_WINDOW = 100
+
+# Until a provider has this many timed creations, HEDGE_MAX_DELAY stands in for its p95.
+HEDGE_MIN_SAMPLES = 20
+
+# Hedges never fire sooner than HEDGE_MIN_DELAY, however fast a provider usually is, nor
+# later than HEDGE_MAX_DELAY, so a provider that stays slow can't push its own hedge out.
+HEDGE_MIN_DELAY = 0.05
+HEDGE_MAX_DELAY = 3.0
+
+# Consecutive failed calls that take a provider out of rotation for new accounts,
+# and the seconds it stays out before it is tried again.
+FAILOVER_ERRORS = 5
+FAILOVER_COOLDOWN = 60
+
+# Length of the intro built from a privatix body, like mail.tm's.
+PRIVATIX_INTRO_LENGTH = 120
+
+logger = logging.getLogger(__name__)
+
+PROVIDER_HEDGES = registry.counter(
+    "bot_provider_hedged_creates_total", "Account creations also sent to the next provider because the first was slow."
+)
+PROVIDER_FAILOVERS = registry.counter(
+    "bot_provider_failovers_total", "Times a provider was taken out of rotation after repeated errors."
+)
+
+
+class ProviderError(Exception):
+    """Raised when a mail provider can't be reached, or answers with an error."""
+
+    def __init__(self, message, provider=None, status_code=None):
+        super().__init__(message)
+        self.provider = provider
+        self.status_code = status_code
+
+    def is_outage(self):
+        """Whether the error says the provider is unwell, rather than something about one account or message."""
+        return self.status_code is None or self.status_code == 429 or self.status_code >= 500
+
+
+@contextmanager
+def _translated(provider, error_type):
+    try:
+        yield
+    except error_type as e:
+        raise ProviderError(f"{provider}: {e}", provider, e.status_code) from e
+
+
+class MailTmProvider:
+    """mail.tm, through a shared MailTmClient."""
+
+    name = "mailtm"
+    # Accounts exist upstream as soon as they are created, so surplus ones are deleted.
+    creates_upstream = True
+    # Calls are free, so inboxes can be polled in the background.
+    metered = False
+
+    def __init__(self, client):
+        self.client = client
+
+    async def create_account(self):
+        with _translated(self.name, MailTmError):
+            return await self.client.create_account()
+
+    async def list_messages(self, account, page=1):
+        with _translated(self.name, MailTmError):
+            return await self.client.list_messages(account, page)
+
+    async def get_message(self, account, message_id):
+        with _translated(self.name, MailTmError):
+            return await self.client.get_message(account, message_id)
+
+    async def get_messages(self, account, page=1):
+        with _translated(self.name, MailTmError):
+            return await self.client.get_messages(account, page)
+
+    async def delete_account(self, account):
+        return await self.client.delete_account(account)
+
+    async def account_exists(self, account):
+        with _translated(self.name, MailTmError):
+            return await self.client.account_exists(account)
+
+    async def close(self):
+        await self.client.close()
+
+
+def privatix_message(mail):
+    """Converts a privatix mail (which always carries its bodies) into a Message."""
+    text = mail.get('mail_text_only') or mail.get('mail_text') or ""
+    created = (mail.get('createdAt') or {}).get('milliseconds')
+    created_at = mail.get('mail_timestamp') if created is None else created / 1000
+    return Message(
+        id_=mail['mail_id'],
+        from_={'address': mail.get('mail_from') or ""},
+        subject=mail.get('mail_subject') or "",
+        intro=" ".join(text.split())[:PRIVATIX_INTRO_LENGTH],
+        text=text,
+        html=mail.get('mail_html'),
+        created_at=datetime.fromtimestamp(float(created_at), timezone.utc).isoformat() if created_at else None,
+    )
+
+
+class PrivatixProvider:
+    """The privatix temp-mail API on RapidAPI, through a shared RapidApiClient.
+
+    Addresses are made up locally on one of the API's domains and identified
+    by their MD5 hash; the API only learns of one when mail arrives for it.
+    """
+
+    name = "privatix"
+    creates_upstream = False
+    # Every call spends RapidAPI quota, so inboxes are only checked when their owner asks.
+    metered = True
+
+    def __init__(self, client, domains_file=None):
+        self.client = client
+        # The domain list changes rarely, so it is cached (and mirrored to disk)
+        # instead of being requested, against the RapidAPI quota, on every creation.
+        self.domains = DomainCache(client.get_domains, path=domains_file)
+
+    async def create_account(self):
+        with _translated(self.name, RapidApiError):
+            domains = await self.domains.get()
+        if not domains:
+            raise ProviderError("privatix: no domains are available", self.name)
+        address = f"{uuid.uuid4().hex[:10]}{random.choice(domains)}"
+        email_hash = hashlib.md5(address.encode('utf-8')).hexdigest()
+        return Account(id=email_hash, address=address, password="", provider=self.name)
+
+    async def list_messages(self, account, page=1):
+        """Returns the whole inbox (the API doesn't page), bodies included."""
+        with _translated(self.name, RapidApiError):
+            data = await self.client.get_messages(account.id_)
+        # An empty inbox comes back as {"error": "There are no emails yet"}.
+        if data is None or (isinstance(data, dict) and 'error' in data):
+            return MessageList([], 0)
+        if not isinstance(data, list):
+            raise ProviderError(f"privatix: unexpected inbox response {str(data)[:200]}", self.name)
+        messages = [privatix_message(mail) for mail in data if mail.get('mail_id')]
+        return MessageList(messages, len(messages))
+
+    async def get_message(self, account, message_id):
+        with _translated(self.name, RapidApiError):
+            data = await self.client.get_message(message_id)
+        if not data or not isinstance(data, dict) or 'error' in data:
+            raise ProviderError(f"privatix: message {message_id} not found", self.name, 404)
+        return privatix_message(dict(data, mail_id=data.get('mail_id') or message_id))
+
+    async def get_messages(self, account, page=1):
+        return await self.list_messages(account, page)
+
+    async def delete_account(self, account):
+        try:
+            await self.client.delete(account.id_)
+        except RapidApiError as e:
+            logger.error(f"Failed to delete privatix address {account.address}: {e}")
+            return False
+        return True
+
+    async def account_exists(self, account):
+        # Addresses don't expire on privatix.
+        return True
+
+    async def close(self):
+        await self.client.close()
+
+
+class ProviderHealth:
+    """Recent creation times and the current run of failures of one provider."""
+
+    def __init__(self, window=HEDGE_WINDOW):
+        self.latencies = deque(maxlen=window)
+        self.failures = 0
+        self.down_until = 0.0
+        self.created = 0
+        self.failed = 0
+
+    def p95(self):
+        latencies = sorted(self.latencies)
+        return latencies[int(0.95 * (len(latencies) - 1))] if latencies else None
+
+
+class ProviderRouter:
+    """One interface over several mail providers, in order of preference.
+
+    Calls for an existing account go to the provider it was created on. New
+    accounts come from the first provider that is in rotation; if it hasn't
+    answered within its p95 creation time, the next one is asked as well and
+    the first account created wins (a surplus one is deleted). A metered
+    provider, whose addresses aren't polled or streamed, is never raced that
+    way; it is only asked once the providers before it failed. A provider is
+    taken out of rotation for `cooldown` seconds after `failover_errors`
+    consecutive failed calls, and its creations fail over to the next at once.
+    """
+
+    def __init__(self, providers, hedge_min_samples=HEDGE_MIN_SAMPLES, hedge_max_delay=HEDGE_MAX_DELAY,
+                 failover_errors=FAILOVER_ERRORS, cooldown=FAILOVER_COOLDOWN):
+        self.providers = {provider.name: provider for provider in providers}
+        self.hedge_min_samples = hedge_min_samples
+        self.hedge_max_delay = hedge_max_delay
+        self.failover_errors = failover_errors
+        self.cooldown = cooldown
+        self._health = {provider.name: ProviderHealth() for provider in providers}
+        # Cleanups of surplus accounts, referenced until they finish.
+        self._cleanups = set()
+        self.hedged = 0
+        self.failovers = 0
+
+    def _provider(self, name):
+        provider = self.providers.get(name)
+        if provider is None:
+            raise ProviderError(f"Mail provider {name!r} is not configured", name)
+        return provider
+
+    def _succeeded(self, name):
+        self._health[name].failures = 0
+
+    def _failed(self, name):
+        health = self._health[name]
+        health.failures += 1
+        if health.failures >= self.failover_errors and health.down_until <= time.monotonic():
+            health.down_until = time.monotonic() + self.cooldown
+            self.failovers += 1
+            PROVIDER_FAILOVERS.labels(provider=name).inc()
+            logger.warning(f"Mail provider {name} failed {health.failures} times in a row; "
+                           f"out of rotation for {self.cooldown}s.")
+
+    async def _call(self, name, method, *args):
+        provider = self._provider(name)
+        try:
+            result = await getattr(provider, method)(*args)
+        except ProviderError as e:
+            if e.is_outage():
+                self._failed(name)
+            raise
+        self._succeeded(name)
+        return result
+
+    # --- Existing accounts ---
+
+    async def list_messages(self, account, page=1):
+        return await self._call(account.provider, "list_messages", account, page)
+
+    async def get_message(self, account, message_id):
+        return await self._call(account.provider, "get_message", account, message_id)
+
+    async def get_messages(self, account, page=1):
+        return await self._call(account.provider, "get_messages", account, page)
+
+    async def delete_account(self, account):
+        return await self._call(account.provider, "delete_account", account)
+
+    async def account_exists(self, account):
+        return await self._call(account.provider, "account_exists", account)
+
+    def is_metered(self, account):
+        """Whether calls for the account spend a paid quota (see the providers' `metered`)."""
+        return self._provider(account.provider).metered
+
+    # --- New accounts ---
+
+    def creation_order(self):
+        """Providers in rotation, in order of preference, then those out of rotation as a last resort."""
+        now = time.monotonic()
+        names = list(self.providers)
+        return [name for name in names if self._health[name].down_until <= now] + \
+            [name for name in names if self._health[name].down_until > now]
+
+    def hedgeable(self, name):
+        """Whether a slow creation may be raced against `name`: only providers with real, unmetered inboxes."""
+        provider = self._provider(name)
+        return provider.creates_upstream and not provider.metered
+
+    def hedge_delay(self, name):
+        health = self._health[name]
+        if len(health.latencies) < self.hedge_min_samples:
+            return self.hedge_max_delay
+        return min(max(health.p95(), HEDGE_MIN_DELAY), self.hedge_max_delay)
+
+    async def _create(self, name):
+        started = time.monotonic()
+        health = self._health[name]
+        try:
+            account = await self._call(name, "create_account")
+        except ProviderError:
+            health.failed += 1
+            raise
+        health.latencies.append(time.monotonic() - started)
+        health.created += 1
+        return account
+
+    async def create_account(self, hedged=True):
+        """Creates an account on the fastest healthy provider; see the class docstring.
+
+        With `hedged=False`, for background work nobody is waiting on, only the
+        preferred provider is asked, without a hedge or failover.
+        """
+        if not hedged:
+            return await self._create(next(iter(self.providers)))
+        waiting = self.creation_order()
+        running = {}
+        errors = []
+
+        def launch():
+            name = waiting.pop(0)
+            running[asyncio.ensure_future(self._create(name))] = name
+            return time.monotonic() + self.hedge_delay(name)
+
+        hedge_at = launch()
+        try:
+            while running:
+                # A metered provider would win every race, so it only takes over once the others failed.
+                hedging = waiting and self.hedgeable(waiting[0])
+                timeout = max(hedge_at - time.monotonic(), 0) if hedging else None
+                done, _ = await asyncio.wait(running, timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+                if not done:
+                    self.hedged += 1
+                    PROVIDER_HEDGES.labels(provider=list(running.values())[-1]).inc()
+                    hedge_at = launch()
+                    continue
+                for task in done:
+                    name = running.pop(task)
+                    try:
+                        return task.result()
+                    except Exception as e:
+                        errors.append(str(e))
+                if waiting:
+                    # Failed outright: fail over now instead of waiting out the hedge delay.
+                    hedge_at = launch()
+        finally:
+            for task, name in running.items():
+                task.add_done_callback(lambda task, name=name: self._discard(name, task))
+        raise ProviderError("No mail provider could create an account: " + "; ".join(errors))
+
+    def _discard(self, name, task):
+        """Deletes an account a hedged creation made but didn't use."""
+        if task.cancelled() or task.exception() is not None:
+            return
+        account = task.result()
+        if not self._provider(name).creates_upstream:
+            return
+        logger.info(f"Deleting surplus {name} account {account.address} left by a hedged creation.")
+        cleanup = asyncio.ensure_future(self._call(name, "delete_account", account))
+        self._cleanups.add(cleanup)
+        cleanup.add_done_callback(self._cleanups.discard)
+
+    def stats(self):
+        """Per provider: accounts created, failed creations, p95 creation seconds and whether it is in rotation."""
+        now = time.monotonic()
+        return {
+            name: {
+                'created': health.created,
+                'failed': health.failed,
+                'p95': health.p95(),
+                'in_rotation': health.down_until <= now,
+            }
+            for name, health in self._health.items()
+        }
+
+    async def close(self):
+        for provider in self.providers.values():
+            await provider.close()
@@ -0,0 +1,173 @@
+# rapidapi_client.py
+
+import asyncio
+import logging
+import random
+import time
+
+import httpx
+
+from metrics import UPSTREAM_ERRORS, UPSTREAM_IN_PROGRESS, UPSTREAM_SECONDS, endpoint_label, timed
+
+# Seconds allowed for one request attempt, and for a whole call including retries.
+REQUEST_TIMEOUT = 10.0
+REQUEST_DEADLINE = 20.0
+
+# Size of the shared keep-alive connection pool.
+MAX_CONNECTIONS = 10
+
+# Attempts for idempotent calls, with full-jitter exponential backoff between them.
+MAX_ATTEMPTS = 3
+RETRY_BASE_DELAY = 0.5
+
+# Request rate and burst used until the API reports its quota. After that, requests
+# refill at the rate that spreads the remaining quota until it resets, and up to
+# BURST_SHARE of the remaining quota (but at least BURST requests) can be spent at once.
+DEFAULT_RATE = 5.0
+BURST = 5
+BURST_SHARE = 0.05
+
+logger = logging.getLogger(__name__)
+
+
+class RapidApiError(Exception):
+    """Raised when the RapidAPI endpoint can't be reached or answers with an error."""
+
+    def __init__(self, message, status_code=None):
+        super().__init__(message)
+        self.status_code = status_code
+
+
+class QuotaThrottle:
+    """Token bucket whose rate follows the plan quota reported in X-RateLimit-* headers.
+
+    The remaining requests are spread evenly over the time left until the quota
+    resets, so a burst of users can't spend the whole monthly allowance at once.
+    The bucket holds a share of the remaining quota, so on plans that reset daily
+    or monthly (where the even rate is far below one request a second) users are
+    only held back once they spend faster than the quota allows for a while.
+    """
+
+    def __init__(self, rate=DEFAULT_RATE, burst=BURST, burst_share=BURST_SHARE):
+        self.rate = rate
+        self.min_burst = burst
+        self.burst = burst
+        self.burst_share = burst_share
+        self._tokens = float(burst)
+        self._updated = time.monotonic()
+        self.remaining = None
+        self.reset_at = None
+        self._lock = asyncio.Lock()
+
+    def update(self, headers):
+        """Adjusts the rate from a response's X-RateLimit-Requests-Remaining/-Reset headers."""
+        remaining = headers.get("x-ratelimit-requests-remaining")
+        reset = headers.get("x-ratelimit-requests-reset")
+        if remaining is None:
+            return
+        try:
+            self.remaining = int(remaining)
+            seconds_left = max(float(reset), 1.0) if reset is not None else None
+        except ValueError:
+            return
+        if seconds_left is not None:
+            now = time.monotonic()
+            self._refill(now)
+            new_period = self.reset_at is None or now >= self.reset_at
+            self.reset_at = now + seconds_left
+            self.rate = max(self.remaining / seconds_left, 1e-3)
+            self.burst = max(self.min_burst, self.remaining * self.burst_share)
+            # A new quota period starts with a full bucket; within one, the bucket shrinks with the quota left.
+            self._tokens = self.burst if new_period else min(self._tokens, self.burst)
+
+    def _refill(self, now):
+        self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    async def acquire(self, deadline):
+        if self.remaining == 0 and self.reset_at and time.monotonic() < self.reset_at:
+            raise RapidApiError("RapidAPI request quota exhausted", status_code=429)
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                self._refill(now)
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                wait = (1 - self._tokens) / self.rate
+                if now + wait > deadline:
+                    raise RapidApiError("RapidAPI request quota throttled past the deadline", status_code=429)
+                await asyncio.sleep(wait)
+
+
+class RapidApiClient:
+    """Asyncio client for the privatix temp-mail API on RapidAPI."""
+
+    def __init__(self, api_key, api_host, base_url=None, timeout=REQUEST_TIMEOUT,
+                 deadline=REQUEST_DEADLINE, max_connections=MAX_CONNECTIONS):
+        self.base_url = base_url or f"https://{api_host}"
+        self.headers = {'x-rapidapi-key': api_key, 'x-rapidapi-host': api_host}
+        self.timeout = timeout
+        self.deadline = deadline
+        self.limits = httpx.Limits(max_connections=max_connections, max_keepalive_connections=max_connections)
+        self.throttle = QuotaThrottle()
+        self._client = None
+
+    def _get_client(self):
+        # The httpx client is created lazily so it binds to the running event loop.
+        if self._client is None:
+            self._client = httpx.AsyncClient(
+                base_url=self.base_url, headers=self.headers, timeout=self.timeout, limits=self.limits
+            )
+        return self._client
+
+    async def close(self):
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
+
+    async def _get(self, path, idempotent=True):
+        deadline = time.monotonic() + self.deadline
+        attempts = MAX_ATTEMPTS if idempotent else 1
+        labels = {"service": "rapidapi", "endpoint": endpoint_label("GET", path)}
+        for attempt in range(1, attempts + 1):
+            await self.throttle.acquire(deadline)
+            try:
+                # Every attempt is timed on its own; retries show up as extra calls.
+                with timed(UPSTREAM_SECONDS, UPSTREAM_ERRORS, UPSTREAM_IN_PROGRESS, **labels):
+                    response = await asyncio.wait_for(
+                        self._get_client().get(path), timeout=max(deadline - time.monotonic(), 0.001)
+                    )
+                self.throttle.update(response.headers)
+                if response.status_code >= 400:
+                    UPSTREAM_ERRORS.labels(**labels).inc()
+                if response.status_code == 429 or response.status_code >= 500:
+                    error = RapidApiError(f"GET {path} returned HTTP {response.status_code}", response.status_code)
+                elif response.status_code >= 400:
+                    raise RapidApiError(f"GET {path} returned HTTP {response.status_code}", response.status_code)
+                else:
+                    return response.json() if response.content else None
+            except (httpx.HTTPError, asyncio.TimeoutError) as e:
+                error = RapidApiError(f"GET {path} failed: {e!r}")
+            except ValueError as e:
+                raise RapidApiError(f"GET {path} returned invalid JSON: {e}") from e
+            delay = random.uniform(0, RETRY_BASE_DELAY * 2 ** (attempt - 1))
+            if attempt == attempts or time.monotonic() + delay >= deadline:
+                raise error
+            logger.info(f"Retrying GET {path} in {delay:.2f}s: {error}")
+            await asyncio.sleep(delay)
+
+    async def get_domains(self):
+        """Returns the list of available domains, e.g. ['@example.com', ...]."""
+        return await self._get("/request/domains/") or []
+
+    async def get_messages(self, email_hash):
+        """Returns the raw inbox response: a list of mails, an {'error': ...} object, or None."""
+        return await self._get(f"/request/mail/id/{email_hash}/")
+
+    async def get_message(self, mail_id):
+        return await self._get(f"/request/id/{mail_id}/")
+
+    async def delete(self, mail_id):
+        """Deletes by ID. Not retried: a retry after a lost response is not guaranteed to be harmless."""
+        return await self._get(f"/request/delete/id/{mail_id}/", idempotent=False)
@@ -0,0 +1,481 @@
+# state_backend.py
+
+import asyncio
+import contextlib
+import json
+import logging
+import sqlite3
+import threading
+import time
+import uuid
+
+# Seconds a lock is held before it is considered abandoned (e.g. its worker crashed).
+LOCK_TTL = 30.0
+
+# How long lock() waits for a lock, and how often it retries meanwhile.
+LOCK_TIMEOUT = 10.0
+LOCK_POLL_INTERVAL = 0.05
+
+# Milliseconds a SQLite call waits for another process's write before giving up.
+BUSY_TIMEOUT_MS = 5000
+
+# Wait before retrying a batch of queued writes that failed; it doubles on every failure in a row.
+FLUSH_RETRY_MIN_DELAY = 0.5
+FLUSH_RETRY_MAX_DELAY = 30.0
+
+logger = logging.getLogger(__name__)
+
+
+class StateBackend:
+    """Namespaced key/value state with expiry, plus locks, shared by the bot's workers.
+
+    Values are stored as text (see StateNamespace for the JSON layer). Every entry
+    has a `priority`: when a namespace is trimmed to a byte budget, priority 0
+    entries are evicted before priority 1 entries, soonest-expiring first.
+    Locks are leases: a holder that dies without releasing loses it after `ttl`;
+    lock() renews the lease while its block runs.
+    """
+
+    def get(self, namespace, key):
+        """Returns the stored text, or None if missing or expired."""
+        raise NotImplementedError
+
+    def set(self, namespace, key, text, ttl=None, priority=1):
+        raise NotImplementedError
+
+    def pop(self, namespace, key):
+        """Removes an entry and returns its text, or None."""
+        raise NotImplementedError
+
+    def drain(self, namespace):
+        """Removes and returns every live entry of a namespace as {key: text}, atomically."""
+        raise NotImplementedError
+
+    def count(self, namespace):
+        raise NotImplementedError
+
+    def size(self, namespace):
+        """Returns the total length of the stored text in a namespace."""
+        raise NotImplementedError
+
+    def purge_expired(self, namespace):
+        """Deletes expired entries; returns how many were deleted."""
+        raise NotImplementedError
+
+    def trim(self, namespace, max_bytes):
+        """Evicts entries until the namespace fits in `max_bytes`; returns how many were evicted."""
+        raise NotImplementedError
+
+    def acquire(self, name, owner, ttl=LOCK_TTL):
+        """Takes (or renews) the lease `name` for `owner` if it is free or expired. Returns True on success."""
+        raise NotImplementedError
+
+    def renew(self, name, owner, ttl=LOCK_TTL):
+        """Extends a lease `owner` still holds. Returns False if it was lost (or released)."""
+        raise NotImplementedError
+
+    def release(self, name, owner):
+        raise NotImplementedError
+
+    async def run(self, fn, *args):
+        """Runs a call that may block on this backend (e.g. drain, or a namespace's purge_expired)."""
+        return fn(*args)
+
+    @contextlib.asynccontextmanager
+    async def lock(self, name, ttl=LOCK_TTL, timeout=LOCK_TIMEOUT):
+        """Holds the lease `name` for the duration of an `async with` block, renewing it every `ttl` / 3."""
+        owner = uuid.uuid4().hex
+        deadline = time.monotonic() + timeout
+        while not await self.run(self.acquire, name, owner, ttl):
+            if time.monotonic() >= deadline:
+                raise TimeoutError(f"Timed out waiting for lock {name!r}")
+            await asyncio.sleep(LOCK_POLL_INTERVAL)
+        renewal = asyncio.ensure_future(self._keep_lease(name, owner, ttl))
+        try:
+            yield
+        finally:
+            renewal.cancel()
+            await self.run(self.release, name, owner)
+
+    async def _keep_lease(self, name, owner, ttl):
+        while True:
+            await asyncio.sleep(ttl / 3)
+            if not await self.run(self.renew, name, owner, ttl):
+                logger.warning(f"Lost lock {name!r} while holding it.")
+                return
+
+    def close(self):
+        pass
+
+
+class MemoryStateBackend(StateBackend):
+    """In-process backend: state and locks are only shared within one worker."""
+
+    def __init__(self):
+        # namespace -> {key: (text, expires, priority)}
+        self._data = {}
+        # name -> (owner, expires)
+        self._locks = {}
+
+    def _live(self, namespace, key):
+        entry = self._data.get(namespace, {}).get(key)
+        if entry is not None and entry[1] is not None and entry[1] <= time.time():
+            del self._data[namespace][key]
+            return None
+        return entry
+
+    def get(self, namespace, key):
+        entry = self._live(namespace, key)
+        return entry[0] if entry is not None else None
+
+    def set(self, namespace, key, text, ttl=None, priority=1):
+        expires = time.time() + ttl if ttl is not None else None
+        self._data.setdefault(namespace, {})[key] = (text, expires, priority)
+
+    def pop(self, namespace, key):
+        entry = self._live(namespace, key)
+        if entry is None:
+            return None
+        del self._data[namespace][key]
+        return entry[0]
+
+    def drain(self, namespace):
+        self.purge_expired(namespace)
+        entries = self._data.pop(namespace, {})
+        return {key: entry[0] for key, entry in entries.items()}
+
+    def count(self, namespace):
+        return len(self._data.get(namespace, {}))
+
+    def size(self, namespace):
+        return sum(len(entry[0]) for entry in self._data.get(namespace, {}).values())
+
+    def purge_expired(self, namespace):
+        entries = self._data.get(namespace, {})
+        now = time.time()
+        expired = [key for key, entry in entries.items() if entry[1] is not None and entry[1] <= now]
+        for key in expired:
+            del entries[key]
+        return len(expired)
+
+    def trim(self, namespace, max_bytes):
+        entries = self._data.get(namespace, {})
+        excess = self.size(namespace) - max_bytes
+        evicted = 0
+        for key, entry in sorted(entries.items(), key=lambda item: (item[1][2], item[1][1] or float("inf"))):
+            if excess <= 0:
+                break
+            del entries[key]
+            excess -= len(entry[0])
+            evicted += 1
+        return evicted
+
+    def acquire(self, name, owner, ttl=LOCK_TTL):
+        holder = self._locks.get(name)
+        if holder is not None and holder[0] != owner and holder[1] > time.time():
+            return False
+        self._locks[name] = (owner, time.time() + ttl)
+        return True
+
+    def renew(self, name, owner, ttl=LOCK_TTL):
+        holder = self._locks.get(name)
+        if holder is None or holder[0] != owner:
+            return False
+        self._locks[name] = (owner, time.time() + ttl)
+        return True
+
+    def release(self, name, owner):
+        holder = self._locks.get(name)
+        if holder is not None and holder[0] == owner:
+            del self._locks[name]
+
+
+class SqliteStateBackend(StateBackend):
+    """Backend in a SQLite database in WAL mode, shared by every worker process on the host.
+
+    Nothing that writes runs on the event loop, where waiting on another worker's
+    write lock would stall every user. Reads run inline on their own connection,
+    which WAL never makes wait for a writer. Sets and pops are queued and written
+    in batches from a thread; queued values are read from memory until then, so
+    other workers see them a moment later. Everything else that writes (locks,
+    drain, purging) goes through run(), which runs it in a thread. Cached state
+    doesn't need to survive power loss, so commits use `synchronous=NORMAL`.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._conn.execute(f"PRAGMA busy_timeout={BUSY_TIMEOUT_MS}")
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS state (namespace TEXT NOT NULL, key TEXT NOT NULL, value TEXT NOT NULL, "
+            "expires REAL, priority INTEGER NOT NULL, PRIMARY KEY (namespace, key))"
+        )
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS locks (name TEXT PRIMARY KEY, owner TEXT NOT NULL, expires REAL NOT NULL)"
+        )
+        # Serializes access to the writing connection between threads.
+        self._db_lock = threading.Lock()
+        self._reader = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._reader.execute(f"PRAGMA busy_timeout={BUSY_TIMEOUT_MS}")
+        self._read_lock = threading.Lock()
+        # Queued writes: {(namespace, key): (text, expires, priority)}, where None means "delete".
+        self._pending = {}
+        # The batch being written, still read from here until it is committed.
+        self._writing = {}
+        self._flush_task = None
+
+    def get(self, namespace, key):
+        entry = self._queued(namespace, key)
+        if entry is not False:
+            return entry[0] if entry is not None and (entry[1] is None or entry[1] > time.time()) else None
+        with self._read_lock:
+            row = self._reader.execute(
+                "SELECT value FROM state WHERE namespace = ? AND key = ? AND (expires IS NULL OR expires > ?)",
+                (namespace, key, time.time()),
+            ).fetchone()
+        return row[0] if row else None
+
+    def _queued(self, namespace, key):
+        """Returns the queued write for an entry (None for a delete), or False if there is none."""
+        for queue in (self._pending, self._writing):
+            if (namespace, key) in queue:
+                return queue[namespace, key]
+        return False
+
+    def set(self, namespace, key, text, ttl=None, priority=1):
+        expires = time.time() + ttl if ttl is not None else None
+        self._pending[namespace, key] = (text, expires, priority)
+        self._schedule_flush()
+
+    def pop(self, namespace, key):
+        text = self.get(namespace, key)
+        if text is not None:
+            self._pending[namespace, key] = None
+            self._schedule_flush()
+        return text
+
+    def drain(self, namespace):
+        """See StateBackend.drain. Entries still queued in this process are drained once written."""
+        with self._db_lock:
+            rows = self._conn.execute(
+                "DELETE FROM state WHERE namespace = ? RETURNING key, value, expires", (namespace,)
+            ).fetchall()
+        now = time.time()
+        return {key: value for key, value, expires in rows if expires is None or expires > now}
+
+    def count(self, namespace):
+        with self._read_lock:
+            (count,) = self._reader.execute("SELECT COUNT(*) FROM state WHERE namespace = ?", (namespace,)).fetchone()
+        return count
+
+    def size(self, namespace):
+        with self._read_lock:
+            (size,) = self._reader.execute(
+                "SELECT COALESCE(SUM(LENGTH(value)), 0) FROM state WHERE namespace = ?", (namespace,)
+            ).fetchone()
+        return size
+
+    def purge_expired(self, namespace):
+        with self._db_lock:
+            cursor = self._conn.execute(
+                "DELETE FROM state WHERE namespace = ? AND expires <= ?", (namespace, time.time())
+            )
+        return cursor.rowcount
+
+    def trim(self, namespace, max_bytes):
+        with self._db_lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                # Keeps the entries that fit, in the reverse of eviction order.
+                cursor = self._conn.execute(
+                    "DELETE FROM state WHERE namespace = ?1 AND key IN ("
+                    " SELECT key FROM (SELECT key, SUM(LENGTH(value)) OVER ("
+                    "  ORDER BY priority DESC, COALESCE(expires, 1e308) DESC, key) AS kept"
+                    "  FROM state WHERE namespace = ?1) WHERE kept > ?2)",
+                    (namespace, max_bytes),
+                )
+                self._conn.execute("COMMIT")
+            except sqlite3.Error:
+                self._conn.execute("ROLLBACK")
+                raise
+        return cursor.rowcount
+
+    def acquire(self, name, owner, ttl=LOCK_TTL):
+        now = time.time()
+        with self._db_lock:
+            cursor = self._conn.execute(
+                "INSERT INTO locks (name, owner, expires) VALUES (?, ?, ?) "
+                "ON CONFLICT(name) DO UPDATE SET owner = excluded.owner, expires = excluded.expires "
+                "WHERE locks.owner = excluded.owner OR locks.expires <= ?",
+                (name, owner, now + ttl, now),
+            )
+        return cursor.rowcount == 1
+
+    def renew(self, name, owner, ttl=LOCK_TTL):
+        with self._db_lock:
+            cursor = self._conn.execute(
+                "UPDATE locks SET expires = ? WHERE name = ? AND owner = ?", (time.time() + ttl, name, owner)
+            )
+        return cursor.rowcount == 1
+
+    def release(self, name, owner):
+        with self._db_lock:
+            self._conn.execute("DELETE FROM locks WHERE name = ? AND owner = ?", (name, owner))
+
+    async def run(self, fn, *args):
+        return await asyncio.to_thread(fn, *args)
+
+    def _schedule_flush(self):
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            # Called outside the event loop (e.g. at startup): write synchronously.
+            batch, self._pending = self._pending, {}
+            self._write_batch(batch)
+            return
+        if self._flush_task is None or self._flush_task.done():
+            self._flush_task = loop.create_task(self._flush())
+
+    async def _flush(self):
+        # Writes queued while a batch is written go out in the next one.
+        delay = 0.0
+        while self._pending:
+            if delay:
+                await asyncio.sleep(delay)
+            batch, self._pending = self._pending, {}
+            self._writing = batch
+            try:
+                await asyncio.to_thread(self._write_batch, batch)
+                delay = 0.0
+            except sqlite3.Error as e:
+                logger.error(f"Failed to write {len(batch)} state changes: {e}")
+                # Put the batch back, without clobbering anything queued meanwhile, and retry it after a backoff.
+                self._pending = {**batch, **self._pending}
+                delay = min(max(delay * 2, FLUSH_RETRY_MIN_DELAY), FLUSH_RETRY_MAX_DELAY)
+            finally:
+                self._writing = {}
+
+    def _write_batch(self, batch):
+        upserts = [(namespace, key, *entry) for (namespace, key), entry in batch.items() if entry is not None]
+        deletes = [(namespace, key) for (namespace, key), entry in batch.items() if entry is None]
+        with self._db_lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                self._conn.executemany(
+                    "INSERT INTO state (namespace, key, value, expires, priority) VALUES (?, ?, ?, ?, ?) "
+                    "ON CONFLICT(namespace, key) DO UPDATE SET value = excluded.value, "
+                    "expires = excluded.expires, priority = excluded.priority",
+                    upserts,
+                )
+                self._conn.executemany("DELETE FROM state WHERE namespace = ? AND key = ?", deletes)
+                self._conn.execute("COMMIT")
+            except sqlite3.Error:
+                self._conn.execute("ROLLBACK")
+                raise
+
+    def close(self):
+        """Writes the queued changes and closes the connections. Call it once the event loop is done with them."""
+        batch, self._pending = {**self._writing, **self._pending}, {}
+        self._write_batch(batch)
+        with self._db_lock:
+            self._conn.close()
+        with self._read_lock:
+            self._reader.close()
+
+
+def open_state_backend(kind, path=None):
+    """Returns the backend named by `kind`: "memory" or "sqlite" (stored at `path`)."""
+    if kind == "memory":
+        return MemoryStateBackend()
+    if kind == "sqlite":
+        return SqliteStateBackend(path)
+    raise ValueError(f"Unknown state backend {kind!r}; expected 'memory' or 'sqlite'")
+
+
+class StateNamespace:
+    """One namespace of a StateBackend, with JSON values and a ByteBudgetCache-compatible API.
+
+    `encode` is used as json.dumps' `default` for objects JSON can't represent,
+    and `decode` as json.loads' `object_hook`, so e.g. cached Messages round-trip.
+    With `max_bytes`, purge_expired() also trims the namespace to that budget.
+    """
+
+    def __init__(self, backend, namespace, ttl=None, max_bytes=None, encode=None, decode=None):
+        self.backend = backend
+        self.namespace = namespace
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.encode = encode
+        self.decode = decode
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    @staticmethod
+    def _key(key):
+        return key if isinstance(key, str) else json.dumps(key)
+
+    def _dumps(self, value):
+        return json.dumps(value, default=self.encode, separators=(',', ':'))
+
+    def _loads(self, text):
+        return json.loads(text, object_hook=self.decode)
+
+    def __len__(self):
+        return self.backend.count(self.namespace)
+
+    def __contains__(self, key):
+        return self.backend.get(self.namespace, self._key(key)) is not None
+
+    def __getitem__(self, key):
+        text = self.backend.get(self.namespace, self._key(key))
+        if text is None:
+            raise KeyError(key)
+        return self._loads(text)
+
+    def __setitem__(self, key, value):
+        self.set(key, value)
+
+    def __delitem__(self, key):
+        if self.backend.pop(self.namespace, self._key(key)) is None:
+            raise KeyError(key)
+
+    def get(self, key, default=None):
+        text = self.backend.get(self.namespace, self._key(key))
+        if text is None:
+            self.misses += 1
+            return default
+        self.hits += 1
+        return self._loads(text)
+
+    def set(self, key, value, size=None, ttl=None, evict_first=False):
+        """Stores a value. `size` is accepted for ByteBudgetCache compatibility; the JSON length is used instead."""
+        self.backend.set(
+            self.namespace, self._key(key), self._dumps(value),
+            ttl=ttl if ttl is not None else self.ttl, priority=0 if evict_first else 1,
+        )
+
+    def pop(self, key, default=None):
+        text = self.backend.pop(self.namespace, self._key(key))
+        return self._loads(text) if text is not None else default
+
+    def purge_expired(self):
+        self.expirations += self.backend.purge_expired(self.namespace)
+        if self.max_bytes is not None:
+            self.evictions += self.backend.trim(self.namespace, self.max_bytes)
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            "entries": len(self),
+            "bytes": self.backend.size(self.namespace),
+            "max_bytes": self.max_bytes or 0,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+            "evictions": self.evictions,
+            "expirations": self.expirations,
+        }
@@ -0,0 +1,219 @@
+# stream.py
+
+import asyncio
+import json
+import logging
+import os
+import time
+from collections import OrderedDict
+
+import httpx
+
+from mailtm_client import MailTmError
+
+try:
+    import h2  # noqa: F401  (enables HTTP/2 in httpx)
+    HTTP2_AVAILABLE = True
+except ImportError:
+    HTTP2_AVAILABLE = False
+
+# --- Configuration ---
+MERCURE_URL = os.environ.get("MAILTM_MERCURE_URL", "https://mercure.mail.tm/.well-known/mercure")
+
+# Upper bound on live subscriptions. The least recently active account is dropped
+# (and left to the poller) when a new one would exceed it.
+MAX_STREAMS = 500
+
+# Subscriptions for accounts with no user activity for this long are closed.
+STREAM_IDLE_TTL = 3600
+
+# Connections shared by all subscriptions. With HTTP/2 each one multiplexes many
+# streams; without it every subscription needs its own connection.
+STREAM_CONNECTIONS = 4
+
+# Seconds without any bytes (events or keep-alive comments) before reconnecting.
+STREAM_READ_TIMEOUT = 300.0
+
+# Reconnect backoff, and the number of consecutive failures after which the
+# account falls back to fast polling until the stream recovers.
+RECONNECT_MIN_DELAY = 1.0
+RECONNECT_MAX_DELAY = 60.0
+FALLBACK_AFTER_FAILURES = 3
+
+logger = logging.getLogger(__name__)
+
+
+class SseEvent:
+    __slots__ = ("id", "event", "data")
+
+    def __init__(self, id=None, event="message", data=""):
+        self.id = id
+        self.event = event
+        self.data = data
+
+
+async def iter_sse_events(lines):
+    """Parses an async iterator of text lines into SseEvents, per the EventSource spec."""
+    event_id, event_type, data = None, "message", []
+    async for line in lines:
+        if not line:
+            if data:
+                yield SseEvent(event_id, event_type, "\n".join(data))
+            event_type, data = "message", []
+            continue
+        if line.startswith(":"):
+            continue
+        field, _, value = line.partition(":")
+        if value.startswith(" "):
+            value = value[1:]
+        if field == "data":
+            data.append(value)
+        elif field == "id":
+            event_id = value
+        elif field == "event":
+            event_type = value
+
+
+class Subscription:
+    __slots__ = ("user_id", "task", "last_event_id", "last_active", "failures")
+
+    def __init__(self, user_id):
+        self.user_id = user_id
+        self.task = None
+        self.last_event_id = None
+        self.last_active = time.monotonic()
+        self.failures = 0
+
+
+class StreamMultiplexer:
+    """Holds mail.tm Mercure (server-sent events) subscriptions for active accounts.
+
+    New-message events go straight to `on_new_messages`, the same callback the
+    InboxPoller uses; the poller's seen-set keeps the two from pushing a message
+    twice. While a subscription is healthy the poller only runs as a slow safety
+    net for that account, and after FALLBACK_AFTER_FAILURES failed reconnects it
+    goes back to fast polling. Reconnects resume from the last event ID.
+    """
+
+    def __init__(self, mail_client, poller, get_account, on_new_messages, url=MERCURE_URL,
+                 max_streams=MAX_STREAMS, max_connections=STREAM_CONNECTIONS):
+        self.mail_client = mail_client
+        self.poller = poller
+        self.get_account = get_account
+        self.on_new_messages = on_new_messages
+        self.url = url
+        self.max_streams = max_streams
+        self.max_connections = max_connections if HTTP2_AVAILABLE else max_streams
+        self.bot = None
+        self._subscriptions = OrderedDict()
+        self._client = None
+
+    def __len__(self):
+        return len(self._subscriptions)
+
+    def _get_client(self):
+        if self._client is None:
+            self._client = httpx.AsyncClient(
+                http2=HTTP2_AVAILABLE,
+                timeout=httpx.Timeout(10.0, read=STREAM_READ_TIMEOUT),
+                limits=httpx.Limits(max_connections=self.max_connections, max_keepalive_connections=self.max_connections),
+            )
+        return self._client
+
+    def start(self, bot, job_queue):
+        self.bot = bot
+        job_queue.run_repeating(self._expire_idle, interval=60, first=60, name="stream_idle_sweep")
+
+    def subscribe(self, user_id):
+        """Opens (or keeps alive) a subscription for the user's account."""
+        if self.bot is None:
+            return
+        subscription = self._subscriptions.get(user_id)
+        if subscription is not None:
+            subscription.last_active = time.monotonic()
+            self._subscriptions.move_to_end(user_id)
+            return
+        while len(self._subscriptions) >= self.max_streams:
+            oldest = next(iter(self._subscriptions))
+            self.unsubscribe(oldest)
+        subscription = Subscription(user_id)
+        subscription.task = asyncio.create_task(self._run(subscription))
+        self._subscriptions[user_id] = subscription
+
+    def unsubscribe(self, user_id):
+        subscription = self._subscriptions.pop(user_id, None)
+        if subscription is not None:
+            subscription.task.cancel()
+            self.poller.set_streaming(user_id, False)
+
+    async def _expire_idle(self, context):
+        cutoff = time.monotonic() - STREAM_IDLE_TTL
+        for user_id in [uid for uid, sub in self._subscriptions.items() if sub.last_active < cutoff]:
+            self.unsubscribe(user_id)
+
+    async def close(self):
+        for user_id in list(self._subscriptions):
+            self.unsubscribe(user_id)
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
+
+    async def _run(self, subscription):
+        user_id = subscription.user_id
+        delay = RECONNECT_MIN_DELAY
+        while self._subscriptions.get(user_id) is subscription:
+            account = self.get_account(user_id)
+            if account is None:
+                self._subscriptions.pop(user_id, None)
+                return
+            try:
+                await self._listen(subscription, account)
+                delay = RECONNECT_MIN_DELAY
+            except asyncio.CancelledError:
+                raise
+            except (httpx.HTTPError, MailTmError, ValueError) as e:
+                subscription.failures += 1
+                logger.debug(f"Event stream for user {user_id} failed ({subscription.failures}x): {e}")
+                if subscription.failures >= FALLBACK_AFTER_FAILURES:
+                    self.poller.set_streaming(user_id, False)
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, RECONNECT_MAX_DELAY)
+
+    async def _listen(self, subscription, account):
+        token = await self.mail_client.ensure_token(account)
+        headers = {"Authorization": f"Bearer {token}", "Accept": "text/event-stream"}
+        if subscription.last_event_id:
+            headers["Last-Event-ID"] = subscription.last_event_id
+        params = {"topic": f"/accounts/{account.id_}"}
+        async with self._get_client().stream("GET", self.url, params=params, headers=headers) as response:
+            if response.status_code == 401:
+                # Expired or revoked token: force a fresh login before reconnecting.
+                account.token_expires = 0
+            response.raise_for_status()
+            subscription.failures = 0
+            self.poller.set_streaming(subscription.user_id, True)
+            async for event in iter_sse_events(response.aiter_lines()):
+                if event.id:
+                    subscription.last_event_id = event.id
+                await self._dispatch(subscription.user_id, account, event)
+
+    async def _dispatch(self, user_id, account, event):
+        try:
+            data = json.loads(event.data)
+        except json.JSONDecodeError:
+            return
+        if data.get("@type") != "Message" or not data.get("id"):
+            return
+        if not self.poller.claim(user_id, data["id"]):
+            return
+        try:
+            message = await self.mail_client.get_message(account, data["id"])
+        except Exception as e:
+            # Left for the next poll to pick up.
+            self.poller.release(user_id, data["id"])
+            logger.error(f"Error fetching streamed message for user {user_id}: {e}")
+            return
+        try:
+            await self.on_new_messages(self.bot, user_id, account, [message])
+        except Exception as e:
+            logger.error(f"Error delivering streamed message for user {user_id}: {e}")
@@ -0,0 +1,115 @@
+# sweeper.py
+
+import asyncio
+import logging
+import time
+
+# Seconds between sweeps on the JobQueue.
+SWEEP_INTERVAL = 60
+
+# Accounts looked at per sweep, and how many of them are checked upstream at once.
+SWEEP_BATCH_SIZE = 30
+SWEEP_CONCURRENCY = 3
+
+# Accounts nobody used (and that weren't checked) for this long are checked upstream again.
+RECHECK_AFTER = 24 * 60 * 60
+
+# Accounts whose user was inactive for this long are deleted, upstream and locally.
+IDLE_TTL = 30 * 24 * 60 * 60
+
+# After this many accounts were purged, the store is compacted (if enough of it is free).
+COMPACT_AFTER_PURGES = 500
+
+logger = logging.getLogger(__name__)
+
+
+class AccountSweeper:
+    """Finds dead and abandoned accounts in the background, least recently active first.
+
+    Each sweep takes the `batch_size` accounts with the oldest activity (or last
+    check) from the store's activity index. Accounts idle for longer than
+    `idle_ttl` are purged; the others are checked upstream, `concurrency` at a
+    time, and purged if the mail service no longer knows them. A sweep is
+    skipped, and a running one stops early, while `is_busy()` says interactive
+    traffic needs the upstream capacity.
+    """
+
+    def __init__(self, store, get_account, account_exists, purge, is_busy=None, interval=SWEEP_INTERVAL,
+                 batch_size=SWEEP_BATCH_SIZE, concurrency=SWEEP_CONCURRENCY, recheck_after=RECHECK_AFTER,
+                 idle_ttl=IDLE_TTL):
+        self.store = store
+        # get_account(user_id) -> account or None
+        self.get_account = get_account
+        # await account_exists(account) -> bool; raises if that can't be told right now
+        self.account_exists = account_exists
+        # await purge(user_id, account, idle), which deletes the account locally (and upstream if it's idle)
+        self.purge = purge
+        self.is_busy = is_busy or (lambda: False)
+        self.interval = interval
+        self.batch_size = batch_size
+        self.concurrency = concurrency
+        self.recheck_after = recheck_after
+        self.idle_ttl = idle_ttl
+        self._running = False
+        self._purged_since_compact = 0
+        self.checked = 0
+        self.expired = 0
+        self.idle = 0
+        self.errors = 0
+        self.deferred_sweeps = 0
+
+    def start(self, job_queue):
+        job_queue.run_repeating(self.sweep, interval=self.interval, first=self.interval, name="account_sweeper")
+
+    async def sweep(self, context=None):
+        """Checks one batch of the least recently active accounts. Returns the number purged."""
+        if self._running:
+            return 0
+        if self.is_busy():
+            self.deferred_sweeps += 1
+            return 0
+        self._running = True
+        try:
+            await self.store.flush()
+            now = time.time()
+            due = self.store.least_recently_active(now - self.recheck_after, self.batch_size)
+            semaphore = asyncio.Semaphore(self.concurrency)
+            results = await asyncio.gather(*(
+                self._check(semaphore, user_id, last_active, now) for user_id, last_active in due
+            ))
+            purged = sum(results)
+            if purged:
+                logger.info(f"Sweeper purged {purged} of {len(due)} least recently active accounts.")
+                self._purged_since_compact += purged
+            if self._purged_since_compact >= COMPACT_AFTER_PURGES:
+                self._purged_since_compact = 0
+                await self.store.compact()
+            return purged
+        finally:
+            self._running = False
+
+    async def _check(self, semaphore, user_id, last_active, now):
+        async with semaphore:
+            # Left for the next sweep when users need the capacity meanwhile.
+            if self.is_busy():
+                return 0
+            account = self.get_account(user_id)
+            if account is None:
+                return 0
+            if last_active < now - self.idle_ttl:
+                await self.purge(user_id, account, True)
+                self.idle += 1
+                return 1
+            try:
+                exists = await self.account_exists(account)
+            except Exception as e:
+                self.errors += 1
+                logger.warning(f"Could not check the account of user {user_id}: {e}")
+                return 0
+            self.checked += 1
+            if exists:
+                self.store.mark_checked(user_id, now)
+                return 0
+            await self.purge(user_id, account, False)
+            self.expired += 1
+            return 1
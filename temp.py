@@ -1,13 +1,22 @@
 import logging
-import json
-import requests
 import hashlib
-import random
-import uuid
+import html
 import asyncio
 import os
+from urllib.parse import urlsplit
 from telegram import Update, Bot
 from telegram.ext import Application, CommandHandler, ContextTypes
+from cache import ByteBudgetCache
+from coalesce import SingleFlight
+from delivery import send_html
+from extract import extract
+from mailtm_client import Account, MailTmClient
+from metrics import instrument_application, start_metrics_server, stop_metrics_server
+from providers import MailTmProvider, PrivatixProvider, ProviderError, ProviderRouter
+from rapidapi_client import RapidApiClient
+from state_backend import StateNamespace, open_state_backend
+from update_processor import KeyedUpdateProcessor
+from webhook import bounded_update_queue, run_application
 
 # Enable logging for detailed output
 logging.basicConfig(
@@ -21,17 +30,78 @@ logger = logging.getLogger(__name__)
 # --- CONFIGURATION ---
 # Use environment variables with fallback values for local development
 BOT_TOKEN = os.environ.get("BOT_TOKEN", "8031723513:AAGM8euqDu9dUVihc3eTmCFCctnMIOi-RkE")
+# Override to use a self-hosted Bot API server or a local test server
+TELEGRAM_API_URL = os.environ.get("TELEGRAM_API_URL", "https://api.telegram.org/bot")
 RAPIDAPI_KEY = os.environ.get("RAPIDAPI_KEY", "87071f5058msh58c5d676b796932p18d2f2jsnc18747d0890c")
 RAPIDAPI_HOST = os.environ.get("RAPIDAPI_HOST", "privatix-temp-mail-v1.p.rapidapi.com")
+# Override to point the bot at a different (e.g. local test) server
+RAPIDAPI_BASE_URL = os.environ.get("RAPIDAPI_BASE_URL", f"https://{RAPIDAPI_HOST}")
 
-# Dictionary to store the temporary email for each user.
-# The key is the user's chat ID, and the value is their email address.
-user_emails = {}
+# Cached domain list, so a cold start doesn't wait on the API
+DOMAINS_FILE = os.environ.get("DOMAINS_FILE", "privatix_domains.json")
+
+# Fallback mail provider: new addresses are created on mail.tm while privatix is
+# slow or failing. Set FALLBACK_MAILTM=0 to use privatix only
+FALLBACK_MAILTM = os.environ.get("FALLBACK_MAILTM", "1") == "1"
+MAILTM_DOMAINS_FILE = os.environ.get("MAILTM_DOMAINS_FILE", "mailtm_domains.json")
+
+# Memory budget and lifetime for the message IDs remembered from each /check
+MESSAGE_IDS_CACHE_MAX_BYTES = 16 * 1024 * 1024
+MESSAGE_IDS_TTL = 60 * 60
+
+# Memory budget for the codes and verification links found in messages, kept as long as message IDs
+MESSAGE_CODES_CACHE_MAX_BYTES = 16 * 1024 * 1024
+
+# Verification links shown per message in the /check listing; the rest are in the body shown by /read
+MAX_INBOX_LINKS = 1
+
+# Where per-user state lives: "memory" keeps it in this process, "sqlite" shares it
+# through STATE_FILE with other worker processes serving the same token
+STATE_BACKEND = os.environ.get("STATE_BACKEND", "memory")
+STATE_FILE = os.environ.get("STATE_FILE", "temp_state.sqlite3")
+
+# Per-user state, in this process or shared with the other workers (see STATE_BACKEND).
+state_backend = open_state_backend(STATE_BACKEND, STATE_FILE)
+
+# Mapping that stores the temporary email for each user.
+# The key is the user's chat ID, and the value is their account (see get_account).
+user_emails = StateNamespace(state_backend, "emails")
 
 # Dictionary to store message IDs for a user's current session.
 # This helps the bot remember which emails were fetched so the user can read them.
 # The key is the user's chat ID, and the value is a dictionary mapping a message ID to its subject.
-user_message_ids = {}
+# Entries are bounded in total size and expire, so idle users don't hold memory forever.
+if STATE_BACKEND == "memory":
+    user_message_ids = ByteBudgetCache(MESSAGE_IDS_CACHE_MAX_BYTES, ttl=MESSAGE_IDS_TTL)
+else:
+    user_message_ids = StateNamespace(
+        state_backend, "message_ids", ttl=MESSAGE_IDS_TTL, max_bytes=MESSAGE_IDS_CACHE_MAX_BYTES
+    )
+
+# Codes and verification links found in each message, keyed by message ID (see extract_codes).
+if STATE_BACKEND == "memory":
+    message_codes = ByteBudgetCache(MESSAGE_CODES_CACHE_MAX_BYTES, ttl=MESSAGE_IDS_TTL)
+else:
+    message_codes = StateNamespace(
+        state_backend, "message_codes", ttl=MESSAGE_IDS_TTL, max_bytes=MESSAGE_CODES_CACHE_MAX_BYTES
+    )
+
+# Shared async API client: pooled connections, deadlines and quota-aware throttling
+rapidapi = RapidApiClient(RAPIDAPI_KEY, RAPIDAPI_HOST, base_url=RAPIDAPI_BASE_URL)
+
+# Mail providers in order of preference. Address creation is hedged across them and fails
+# over when one keeps failing; everything else goes to the provider the address lives on.
+mail_router = ProviderRouter(
+    [PrivatixProvider(rapidapi, DOMAINS_FILE)] +
+    ([MailTmProvider(MailTmClient(domain_cache_file=MAILTM_DOMAINS_FILE))] if FALLBACK_MAILTM else [])
+)
+
+# API reads in flight, keyed ("mail", account ID) or ("read", message_id), so repeated
+# /check and /read requests share one call (and one unit of quota).
+inflight = SingleFlight()
+
+# Local Prometheus endpoint, started in post_init (see metrics.METRICS_PORT).
+metrics_server = None
 
 # --- HELPER FUNCTIONS ---
 
@@ -39,6 +109,42 @@ def get_email_hash(email: str) -> str:
     """Generates the MD5 hash of an email address."""
     return hashlib.md5(email.encode('utf-8')).hexdigest()
 
+def get_account(chat_id):
+    """Returns the user's Account, or None. Addresses saved as plain strings are privatix ones."""
+    data = user_emails.get(chat_id)
+    if data is None:
+        return None
+    if isinstance(data, str):
+        return Account(id=get_email_hash(data), address=data, password="", provider=PrivatixProvider.name)
+    return Account.from_dict(data)
+
+def save_token(chat_id, account, token):
+    """Saves the account again if a call logged in to it, so the next command doesn't log in again."""
+    if account.token != token:
+        user_emails[chat_id] = account.to_dict()
+
+def extract_codes(message) -> dict:
+    """Finds a message's codes and verification links once, the first time it is fetched.
+
+    A result taken from a preview alone is replaced once the body is fetched.
+    """
+    found = message_codes.get(message.id_)
+    has_body = message.text is not None or message.html is not None
+    if found is None or (has_body and found['partial']):
+        found = extract(message.subject, message.text if has_body else message.intro, message.html, partial=not has_body)
+        found['partial'] = not has_body
+        message_codes.set(message.id_, found)
+    return found
+
+def format_codes(found: dict, max_links=MAX_INBOX_LINKS) -> str:
+    """Formats extracted codes and links as HTML lines for the inbox listing."""
+    lines = ""
+    if found['codes']:
+        lines += "<b>Code:</b> " + ", ".join(f"<code>{html.escape(code)}</code>" for code in found['codes']) + "\n"
+    for link in found['links'][:max_links]:
+        lines += f"<b>Link:</b> <a href=\"{html.escape(link)}\">{html.escape(urlsplit(link).netloc)}</a>\n"
+    return lines
+
 # --- TELEGRAM BOT COMMAND HANDLERS ---
 
 async def start_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
@@ -56,35 +162,19 @@ async def new_email_command(update: Update, context: ContextTypes.DEFAULT_TYPE)
     """Generates a new temporary email address for the user."""
     chat_id = update.effective_chat.id
     
-    headers = {
-        'x-rapidapi-key': RAPIDAPI_KEY,
-        'x-rapidapi-host': RAPIDAPI_HOST
-    }
-    
-    # Get the list of available domains
+    # On privatix unless it is slow or failing, in which case the fallback provider answers
     try:
-        response = requests.get(f"https://{RAPIDAPI_HOST}/request/domains/", headers=headers)
-        response.raise_for_status()
-        domains = response.json()
-    except requests.exceptions.RequestException as e:
-        logger.error(f"Error fetching domains: {e}")
-        await update.message.reply_text("Sorry, I couldn't get a list of domains right now. Please try again later.")
+        account = await mail_router.create_account()
+    except ProviderError as e:
+        logger.error(f"Error creating an email address: {e}")
+        await update.message.reply_text("Sorry, I couldn't create an email address right now. Please try again later.")
         return
 
-    if not domains:
-        await update.message.reply_text("Sorry, no domains are available. Please try again later.")
-        return
-
-    # Generate a random username and choose a random domain
-    username = str(uuid.uuid4().hex[:10])
-    domain = random.choice(domains)
-    new_email = f"{username}{domain}"
-
     # Store the new email for the user
-    user_emails[chat_id] = new_email
+    user_emails[chat_id] = account.to_dict()
     
     await update.message.reply_text(
-        f"✅ Your new temporary email address is:\n`{new_email}`\n\n"
+        f"✅ Your new temporary email address is:\n`{account.address}`\n\n"
         "You can now receive emails. Use /check to see new messages."
     )
 
@@ -92,74 +182,49 @@ async def check_inbox_command(update: Update, context: ContextTypes.DEFAULT_TYPE
     """Checks the inbox for the user's current temporary email."""
     chat_id = update.effective_chat.id
     
-    if chat_id not in user_emails:
+    account = get_account(chat_id)
+    if account is None:
         await update.message.reply_text("You need to generate an email first. Use /new.")
         return
-        
-    email_address = user_emails[chat_id]
-    email_hash = get_email_hash(email_address)
 
-    headers = {
-        'x-rapidapi-key': RAPIDAPI_KEY,
-        'x-rapidapi-host': RAPIDAPI_HOST
-    }
-
-    emails = []
+    token = account.token
     try:
-        response = requests.get(f"https://{RAPIDAPI_HOST}/request/mail/id/{email_hash}/", headers=headers)
-        response.raise_for_status()
-        
-        # Check if the response content is a list before parsing as JSON.
-        # Handle cases where the API returns an error message instead of a list.
-        if response.content:
-            data = response.json()
-            if isinstance(data, list):
-                emails = data
-            elif isinstance(data, dict) and 'error' in data:
-                # The API returns an error object like {"error":"There are no emails yet"}
-                logger.info(f"API returned an error, assuming no new emails: {data['error']}")
-                emails = [] # Treat this as an empty inbox
-            else:
-                logger.error(f"Unexpected response format from API: {response.text}")
-                await update.message.reply_text("Sorry, there was an unexpected issue checking your inbox. Please try again later.")
-                return
-    except requests.exceptions.RequestException as e:
-        logger.error(f"Error checking inbox for {email_address}: {e}")
+        messages = await inflight.do(("mail", account.id_), lambda: mail_router.list_messages(account))
+    except ProviderError as e:
+        logger.error(f"Error checking inbox for {account.address}: {e}")
         await update.message.reply_text("Sorry, I couldn't check your inbox right now. Please try again later.")
         return
-    except json.JSONDecodeError as e:
-        logger.error(f"Error decoding JSON response: {e}")
-        await update.message.reply_text("Sorry, there was an error processing the response from the API. Please try again later.")
-        return
+    save_token(chat_id, account, token)
 
-    if not emails:
+    if not messages:
         await update.message.reply_text("📥 Your inbox is empty.")
     else:
-        inbox_message = "📬 **Your Inbox**:\n\n"
-        user_message_ids[chat_id] = {} # Clear previous message IDs
-        for email in emails:
-            # CORRECTED: Use the 'mail_id' field for the message ID.
-            # This is the correct ID to use for the '/read' endpoint.
-            message_id = email.get('mail_id')
-            subject = email.get('mail_subject', 'No Subject')
-            from_address = email.get('mail_from', 'Unknown Sender')
-            
-            # Check if message_id is valid before storing
-            if not message_id:
-                logger.warning(f"Message in response is missing a valid mail_id: {email}")
-                continue
-
-            user_message_ids[chat_id][message_id] = subject
+        inbox_message = "📬 <b>Your Inbox</b>:\n\n"
+        inbox_file = ""
+        message_ids = {} # Replaces the previous message IDs
+        for message in messages:
+            subject = message.subject or 'No Subject'
+            from_address = message.from_.get('address') or 'Unknown Sender'
+            message_ids[message.id_] = subject
             
             # Show a summary of each email
             inbox_message += (
-                f"**ID:** `{message_id}`\n"
-                f"**From:** `{from_address}`\n"
-                f"**Subject:** `{subject}`\n"
+                f"<b>ID:</b> <code>{html.escape(str(message.id_))}</code>\n"
+                f"<b>From:</b> <code>{html.escape(from_address)}</code>\n"
+                f"<b>Subject:</b> <code>{html.escape(subject)}</code>\n"
+                f"{format_codes(extract_codes(message))}"
                 f"--------------------\n"
             )
+            inbox_file += f"ID: {message.id_}\nFrom: {from_address}\nSubject: {subject}\n\n"
         
-        await update.message.reply_text(inbox_message, parse_mode='Markdown')
+        user_message_ids.set(chat_id, message_ids)
+        # HTML like /read, so senders, subjects and links can be escaped, and a long inbox is split or attached.
+        await send_html(
+            context.bot, chat_id, inbox_message,
+            document=inbox_file,
+            filename="inbox.txt",
+            caption=f"📬 <b>Your Inbox</b>: {len(messages)} messages, attached as a file because the list is too long to show here."
+        )
         await update.message.reply_text("Use `/read <message_id>` to view the full content of an email.")
 
 async def read_email_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
@@ -171,74 +236,84 @@ async def read_email_command(update: Update, context: ContextTypes.DEFAULT_TYPE)
         return
     
     message_id = context.args[0]
+    account = get_account(chat_id)
     
-    if chat_id not in user_message_ids or message_id not in user_message_ids[chat_id]:
+    if account is None or message_id not in user_message_ids.get(chat_id, {}):
         await update.message.reply_text("That message ID is not valid or has expired. Please use /check to get a new list of messages.")
         return
 
-    headers = {
-        'x-rapidapi-key': RAPIDAPI_KEY,
-        'x-rapidapi-host': RAPIDAPI_HOST
-    }
-
+    token = account.token
     try:
-        # The API endpoint for reading a specific message by its ID
-        response = requests.get(f"https://{RAPIDAPI_HOST}/request/id/{message_id}/", headers=headers)
-        response.raise_for_status()
-        email_content = response.json()
-    except requests.exceptions.RequestException as e:
+        message = await inflight.do(("read", message_id), lambda: mail_router.get_message(account, message_id))
+    except ProviderError as e:
         logger.error(f"Error reading message {message_id}: {e}")
         await update.message.reply_text("Sorry, I couldn't retrieve that message. It may have been deleted.")
         return
+    save_token(chat_id, account, token)
     
     # Extract relevant fields
-    subject = email_content.get('mail_subject', 'No Subject')
-    from_address = email_content.get('mail_from', 'Unknown Sender')
-    date = email_content.get('createdAt', {}).get('milliseconds')
-    content = email_content.get('mail_text_only', 'No content.')
-
-    full_message = (
-        f"**From:** `{from_address}`\n"
-        f"**Subject:** `{subject}`\n"
-        f"**Date:** `{date}`\n\n"
-        f"--- Message Content ---\n"
-        f"```\n{content}\n```"
-    )
+    subject = message.subject or 'No Subject'
+    from_address = message.from_.get('address') or 'Unknown Sender'
+    date = message.created_at
+    content = message.text or 'No content.'
 
-    await update.message.reply_text(full_message, parse_mode='Markdown')
+    # HTML rather than Markdown: the body can be escaped, and split across messages without breaking the block.
+    header = (
+        f"<b>From:</b> <code>{html.escape(from_address)}</code>\n"
+        f"<b>Subject:</b> <code>{html.escape(subject)}</code>\n"
+        f"<b>Date:</b> <code>{date}</code>\n"
+    )
+    codes = extract_codes(message)['codes']
+    if codes:
+        header += "<b>Code:</b> " + ", ".join(f"<code>{html.escape(code)}</code>" for code in codes) + "\n"
+    header += "\n"
+    await send_html(
+        context.bot, chat_id,
+        header + f"--- Message Content ---\n<pre>{html.escape(content)}</pre>",
+        document=message.html or content,
+        filename=f"message-{message_id}.{'html' if message.html else 'txt'}",
+        caption=header + "The message is too long to show here, so it is attached as a file."
+    )
 
 async def delete_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Deletes the user's current temporary email address."""
     chat_id = update.effective_chat.id
 
-    if chat_id not in user_emails:
+    account = get_account(chat_id)
+    if account is None:
         await update.message.reply_text("You don't have an active email to delete.")
         return
-    
-    email_address = user_emails[chat_id]
-    email_hash = get_email_hash(email_address)
-
-    headers = {
-        'x-rapidapi-key': RAPIDAPI_KEY,
-        'x-rapidapi-host': RAPIDAPI_HOST
-    }
 
     try:
-        # The API endpoint for deleting an email by its ID is:
-        # `https://privatix-temp-mail-v1.p.rapidapi.com/request/delete/id/{mail_id}/`
-        response = requests.get(f"https://{RAPIDAPI_HOST}/request/delete/id/{email_hash}/", headers=headers)
-        response.raise_for_status()
-        await update.message.reply_text(f"🗑️ The temporary email address `{email_address}` has been deleted.")
-        
-    except requests.exceptions.RequestException as e:
-        logger.error(f"Error deleting email {email_address}: {e}")
+        deleted = await mail_router.delete_account(account)
+    except ProviderError as e:
+        logger.error(f"Error deleting email {account.address}: {e}")
+        deleted = False
+    # Clear the email from our local storage regardless of API success
+    if chat_id in user_emails:
+        del user_emails[chat_id]
+    for message_id in user_message_ids.pop(chat_id) or {}:
+        message_codes.pop(message_id)
+    if deleted:
+        await update.message.reply_text(f"🗑️ The temporary email address `{account.address}` has been deleted.")
+    else:
         await update.message.reply_text("There was an error trying to delete your email. It may have already expired.")
-    finally:
-        # Clear the email from our local storage regardless of API success
-        if chat_id in user_emails:
-            del user_emails[chat_id]
-        if chat_id in user_message_ids:
-            del user_message_ids[chat_id]
+
+async def purge_message_ids(context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Periodically frees remembered message IDs (and their codes) that expired without being looked up again."""
+    await state_backend.run(user_message_ids.purge_expired)
+    await state_backend.run(message_codes.purge_expired)
+
+async def post_init(application: Application) -> None:
+    """Starts the metrics endpoint."""
+    global metrics_server
+    metrics_server = await start_metrics_server()
+
+async def post_shutdown(application: Application) -> None:
+    """Closes the mail providers' pooled connections, the state backend and the metrics endpoint."""
+    await mail_router.close()
+    state_backend.close()
+    await stop_metrics_server(metrics_server)
 
 def main() -> None:
     """Start the bot."""
@@ -250,7 +325,17 @@ def main() -> None:
         logger.warning("Using default RAPIDAPI_KEY. For production, set the RAPIDAPI_KEY environment variable.")
     
     # Create the Application and pass it your bot's token.
-    application = Application.builder().token(BOT_TOKEN).build()
+    # Different users' updates run concurrently; each user's run one at a time, in order
+    application = (
+        Application.builder()
+        .token(BOT_TOKEN)
+        .base_url(TELEGRAM_API_URL)
+        .update_queue(bounded_update_queue())
+        .concurrent_updates(KeyedUpdateProcessor())
+        .post_init(post_init)
+        .post_shutdown(post_shutdown)
+        .build()
+    )
 
     # Register command handlers
     application.add_handler(CommandHandler("start", start_command))
@@ -258,9 +343,14 @@ def main() -> None:
     application.add_handler(CommandHandler("check", check_inbox_command))
     application.add_handler(CommandHandler("read", read_email_command))
     application.add_handler(CommandHandler("delete", delete_command))
+    application.job_queue.run_repeating(purge_message_ids, interval=60, first=60)
+
+    # Time every handler and expose the queue depths on the metrics endpoint
+    instrument_application(application)
     
     # Run the bot until the user presses Ctrl-C
-    application.run_polling(allowed_updates=Update.ALL_TYPES)
+    # Webhook when WEBHOOK_URL is set, long polling otherwise; only the handled update types are requested
+    run_application(application)
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,159 @@
+# tests/test_stream.py
+#
+# Drives StreamMultiplexer and iter_sse_events against a local asyncio stand-in
+# for the mail.tm Mercure hub: event dispatch, reconnects that resume from the
+# last event ID, and the fall back to fast polling after repeated failures.
+# Usage: python -m pytest tests
+
+import asyncio
+import json
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import stream
+from mailtm_client import Account, Message
+from stream import StreamMultiplexer, iter_sse_events
+
+
+class SseServer:
+    """Answers each connection with the next scripted response: (status, SSE text, hold open)."""
+
+    def __init__(self, responses):
+        self.responses = list(responses)
+        self.requests = []
+        self._stopped = asyncio.Event()
+
+    async def start(self):
+        self._server = await asyncio.start_server(self._handle, "127.0.0.1", 0)
+        return f"http://127.0.0.1:{self._server.sockets[0].getsockname()[1]}/.well-known/mercure"
+
+    async def close(self):
+        self._stopped.set()
+        self._server.close()
+        await self._server.wait_closed()
+
+    async def _handle(self, reader, writer):
+        head = (await reader.readuntil(b"\r\n\r\n")).decode()
+        request_line, *header_lines = head.split("\r\n")
+        headers = dict(line.split(": ", 1) for line in header_lines if line)
+        self.requests.append((request_line, {name.lower(): value for name, value in headers.items()}))
+        # Once the script runs out, connections stay open without events, so the client stops reconnecting.
+        status, text, hold = self.responses.pop(0) if self.responses else (200, "", True)
+        writer.write(
+            f"HTTP/1.1 {status} Scripted\r\nContent-Type: text/event-stream\r\nConnection: close\r\n\r\n{text}".encode()
+        )
+        await writer.drain()
+        if hold:
+            await self._stopped.wait()
+        writer.close()
+
+
+def message_event(event_id, message_id):
+    return f"id: {event_id}\nevent: update\ndata: {json.dumps({'@type': 'Message', 'id': message_id})}\n\n"
+
+
+class FakePoller:
+    def __init__(self):
+        self.seen = set()
+        self.streaming = []
+
+    def claim(self, user_id, message_id):
+        if message_id in self.seen:
+            return False
+        self.seen.add(message_id)
+        return True
+
+    def release(self, user_id, message_id):
+        self.seen.discard(message_id)
+
+    def set_streaming(self, user_id, streaming):
+        self.streaming.append(streaming)
+
+
+class FakeMailClient:
+    async def ensure_token(self, account):
+        return "token-1"
+
+    async def get_message(self, account, message_id):
+        return Message(message_id, {'address': "sender@example.com"}, "Subject", "Intro")
+
+
+class FakeJobQueue:
+    def run_repeating(self, *args, **kwargs):
+        pass
+
+
+async def wait_until(predicate, timeout=5.0):
+    deadline = asyncio.get_running_loop().time() + timeout
+    while not predicate():
+        assert asyncio.get_running_loop().time() < deadline, "timed out"
+        await asyncio.sleep(0.01)
+
+
+async def run_multiplexer(responses, check):
+    server = SseServer(responses)
+    url = await server.start()
+    poller, delivered = FakePoller(), []
+
+    async def on_new_messages(bot, user_id, account, messages):
+        delivered.extend((user_id, message.id_) for message in messages)
+
+    account = Account("account-1", "user@example.com", "password")
+    multiplexer = StreamMultiplexer(FakeMailClient(), poller, lambda user_id: account, on_new_messages, url=url)
+    multiplexer.start(object(), FakeJobQueue())
+    multiplexer.subscribe(1)
+    try:
+        await check(server, poller, delivered)
+    finally:
+        await multiplexer.close()
+        await server.close()
+
+
+def test_iter_sse_events_parses_fields():
+    async def lines():
+        for line in [": keep-alive", "id: 7", "event: update", "data: one", "data:two", "", "data: three", ""]:
+            yield line
+
+    async def collect():
+        return [(event.id, event.event, event.data) async for event in iter_sse_events(lines())]
+
+    assert asyncio.run(collect()) == [("7", "update", "one\ntwo"), ("7", "message", "three")]
+
+
+def test_dispatches_and_resumes_from_last_event_id(monkeypatch):
+    monkeypatch.setattr(stream, "RECONNECT_MIN_DELAY", 0.01)
+    responses = [
+        (200, message_event("e1", "m1") + "data: {\"@type\": \"Account\", \"id\": \"a\"}\n\n", False),
+        (200, message_event("e2", "m2") + message_event("e3", "m1"), True),
+    ]
+
+    async def check(server, poller, delivered):
+        await wait_until(lambda: len(delivered) == 2)
+        assert delivered == [(1, "m1"), (1, "m2")]
+        assert len(server.requests) == 2
+        first, second = (headers for _, headers in server.requests)
+        assert "/accounts/account-1" in server.requests[0][0].replace("%2F", "/")
+        assert first["authorization"] == "Bearer token-1"
+        assert "last-event-id" not in first
+        assert second["last-event-id"] == "e1"
+        # Reconnecting after a clean end of stream doesn't fall back to fast polling.
+        assert set(poller.streaming) == {True}
+
+    asyncio.run(run_multiplexer(responses, check))
+
+
+def test_falls_back_to_polling_after_repeated_failures(monkeypatch):
+    monkeypatch.setattr(stream, "RECONNECT_MIN_DELAY", 0.01)
+    failures = stream.FALLBACK_AFTER_FAILURES
+    responses = [(500, "", False)] * failures + [(200, message_event("e1", "m1"), True)]
+
+    async def check(server, poller, delivered):
+        await wait_until(lambda: len(server.requests) >= failures)
+        await wait_until(lambda: poller.streaming == [False])
+        # Streaming resumes (and fast polling stops) once the hub answers again.
+        await wait_until(lambda: delivered == [(1, "m1")])
+        assert poller.streaming == [False, True]
+
+    asyncio.run(run_multiplexer(responses, check))
@@ -0,0 +1,111 @@
+# update_processor.py
+
+import logging
+import time
+from collections import deque
+
+from telegram import Update
+from telegram.ext import BaseUpdateProcessor
+
+# Updates processed at once, across all users.
+MAX_CONCURRENT_UPDATES = 32
+
+# Number of recent queue wait times kept for the wait-time percentiles.
+WAIT_SAMPLES = 1000
+
+logger = logging.getLogger(__name__)
+
+
+def update_key(update):
+    """Returns the key updates are serialized on: the sender, else the chat, else None (not serialized)."""
+    if isinstance(update, Update):
+        if update.effective_user is not None:
+            return update.effective_user.id
+        if update.effective_chat is not None:
+            return update.effective_chat.id
+    return None
+
+
+class KeyedUpdateProcessor(BaseUpdateProcessor):
+    """Processes updates for different users concurrently, and each user's updates one at a time, in order.
+
+    The first update for a key runs in the processor slot it was given and then
+    drains every update that arrived for the same key meanwhile. Later updates
+    for a busy key are handed to that queue and give their slot back, so one
+    impatient user occupies at most one of the `max_concurrent_updates` slots.
+    """
+
+    def __init__(self, max_concurrent_updates=MAX_CONCURRENT_UPDATES, key=update_key):
+        super().__init__(max_concurrent_updates)
+        self.key = key
+        # key -> deque of (coroutine, queued_at) waiting behind the key's running update.
+        self._queues = {}
+        self._waits = deque(maxlen=WAIT_SAMPLES)
+        self.processed = 0
+        self.max_depth = 0
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        # Application.stop() waits for running updates, so anything left here was never started.
+        for queue in self._queues.values():
+            for coroutine, _ in queue:
+                coroutine.close()
+        self._queues.clear()
+
+    async def do_process_update(self, update, coroutine):
+        key = self.key(update)
+        if key is None:
+            await self._run(coroutine, 0.0)
+            return
+        queue = self._queues.get(key)
+        if queue is not None:
+            queue.append((coroutine, time.monotonic()))
+            self.max_depth = max(self.max_depth, len(queue))
+            return
+        queue = self._queues[key] = deque()
+        try:
+            await self._run(coroutine, 0.0)
+            while queue:
+                coroutine, queued_at = queue.popleft()
+                await self._run(coroutine, time.monotonic() - queued_at)
+        finally:
+            del self._queues[key]
+
+    async def _run(self, coroutine, waited):
+        self._waits.append(waited)
+        try:
+            await coroutine
+        except Exception as e:
+            # Application.process_update already routes handler errors to the error handlers.
+            logger.error(f"Unhandled error while processing an update: {e}")
+        self.processed += 1
+
+    @property
+    def active_keys(self):
+        """Number of keys with an update being processed; cheap enough to check on every background tick."""
+        return len(self._queues)
+
+    def queue_depth(self, key):
+        """Returns how many updates for `key` are waiting behind the one being processed."""
+        queue = self._queues.get(key)
+        return len(queue) if queue is not None else 0
+
+    def stats(self):
+        waits = sorted(self._waits)
+
+        def percentile(p):
+            return waits[min(int(len(waits) * p), len(waits) - 1)] if waits else 0.0
+
+        deepest = sorted(self._queues.items(), key=lambda item: len(item[1]), reverse=True)[:5]
+        return {
+            "active_keys": self.active_keys,
+            "queued": sum(len(queue) for queue in self._queues.values()),
+            "deepest": [(key, len(queue)) for key, queue in deepest if queue],
+            "max_depth": self.max_depth,
+            "processed": self.processed,
+            "wait_p50": percentile(0.50),
+            "wait_p95": percentile(0.95),
+            "wait_max": waits[-1] if waits else 0.0,
+        }
@@ -0,0 +1,222 @@
+# webhook.py
+
+import asyncio
+import hashlib
+import hmac
+import json
+import logging
+import os
+from urllib.parse import urlparse
+
+from telegram import Update
+from telegram.constants import UpdateType
+from telegram.ext import (
+    CallbackQueryHandler,
+    ChatJoinRequestHandler,
+    ChatMemberHandler,
+    ChosenInlineResultHandler,
+    CommandHandler,
+    ConversationHandler,
+    InlineQueryHandler,
+    MessageHandler,
+    PollAnswerHandler,
+    PollHandler,
+    PreCheckoutQueryHandler,
+    ShippingQueryHandler,
+)
+
+try:
+    import uvicorn
+except ImportError:
+    uvicorn = None
+
+# --- Configuration ---
+# Public HTTPS URL Telegram posts updates to. Leave unset to use long polling instead.
+WEBHOOK_URL = os.environ.get("WEBHOOK_URL")
+
+# Address and port the built-in receiver listens on (behind a TLS-terminating proxy).
+WEBHOOK_LISTEN = os.environ.get("WEBHOOK_LISTEN", "0.0.0.0")
+WEBHOOK_PORT = int(os.environ.get("WEBHOOK_PORT", "8443"))
+
+# Secret Telegram sends with every update. Defaults to one derived from the bot token,
+# so all workers of one bot agree on it without extra configuration.
+WEBHOOK_SECRET = os.environ.get("WEBHOOK_SECRET")
+
+# Parallel connections Telegram may open to the receiver (1-100).
+WEBHOOK_MAX_CONNECTIONS = 40
+
+# Updates received but not yet processed. When the queue stays full for
+# ENQUEUE_TIMEOUT seconds the receiver answers 503 and Telegram retries later.
+UPDATE_QUEUE_SIZE = 1000
+ENQUEUE_TIMEOUT = 1.0
+
+# Larger request bodies are rejected; real updates are a few KB.
+MAX_BODY_BYTES = 1024 * 1024
+
+logger = logging.getLogger(__name__)
+
+# Update types each handler class can receive. Message-based handlers only map to
+# new messages: none of the bots react to edits or channel posts.
+HANDLER_UPDATE_TYPES = {
+    CommandHandler: [UpdateType.MESSAGE],
+    MessageHandler: [UpdateType.MESSAGE],
+    CallbackQueryHandler: [UpdateType.CALLBACK_QUERY],
+    InlineQueryHandler: [UpdateType.INLINE_QUERY],
+    ChosenInlineResultHandler: [UpdateType.CHOSEN_INLINE_RESULT],
+    ShippingQueryHandler: [UpdateType.SHIPPING_QUERY],
+    PreCheckoutQueryHandler: [UpdateType.PRE_CHECKOUT_QUERY],
+    PollHandler: [UpdateType.POLL],
+    PollAnswerHandler: [UpdateType.POLL_ANSWER],
+    ChatJoinRequestHandler: [UpdateType.CHAT_JOIN_REQUEST],
+}
+
+
+def bounded_update_queue(maxsize=UPDATE_QUEUE_SIZE):
+    """Update queue for Application.builder().update_queue(), so a flood of updates can't grow memory without limit."""
+    return asyncio.Queue(maxsize=maxsize)
+
+
+def _handler_update_types(handler):
+    if isinstance(handler, ConversationHandler):
+        nested = handler.entry_points + handler.fallbacks + [h for hs in handler.states.values() for h in hs]
+        return [t for h in nested for t in _handler_update_types(h)]
+    if isinstance(handler, ChatMemberHandler):
+        return {
+            ChatMemberHandler.MY_CHAT_MEMBER: [UpdateType.MY_CHAT_MEMBER],
+            ChatMemberHandler.CHAT_MEMBER: [UpdateType.CHAT_MEMBER],
+        }.get(handler.chat_member_types, [UpdateType.MY_CHAT_MEMBER, UpdateType.CHAT_MEMBER])
+    for handler_class, update_types in HANDLER_UPDATE_TYPES.items():
+        if isinstance(handler, handler_class):
+            return update_types
+    # Unknown handler (e.g. a TypeHandler): it may want anything.
+    return list(Update.ALL_TYPES)
+
+
+def allowed_updates_for(application):
+    """Returns the update types the registered handlers can handle, for `allowed_updates`."""
+    update_types = {
+        update_type
+        for handlers in application.handlers.values()
+        for handler in handlers
+        for update_type in _handler_update_types(handler)
+    }
+    return [update_type.value for update_type in Update.ALL_TYPES if update_type in update_types]
+
+
+def webhook_secret(token):
+    return WEBHOOK_SECRET or hashlib.sha256(f"webhook:{token}".encode()).hexdigest()
+
+
+class WebhookReceiver:
+    """Minimal ASGI app that accepts Telegram webhook posts and feeds the application's update queue.
+
+    Requests are answered as soon as the update is queued, so handler latency
+    never holds Telegram's connections open. When the (bounded) queue stays
+    full, the receiver answers 503 and Telegram redelivers the update later.
+    """
+
+    def __init__(self, bot, update_queue, path="/", secret_token=None,
+                 enqueue_timeout=ENQUEUE_TIMEOUT, max_body_bytes=MAX_BODY_BYTES):
+        self.bot = bot
+        self.update_queue = update_queue
+        self.path = path
+        self.secret_token = secret_token
+        self.enqueue_timeout = enqueue_timeout
+        self.max_body_bytes = max_body_bytes
+        self.received = 0
+        self.rejected = 0
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return
+        status = await self._handle(scope, receive)
+        await send({"type": "http.response.start", "status": status, "headers": [(b"content-length", b"0")]})
+        await send({"type": "http.response.body", "body": b""})
+
+    async def _handle(self, scope, receive):
+        if scope["path"] != self.path:
+            return 404
+        if scope["method"] != "POST":
+            return 405
+        if self.secret_token is not None:
+            headers = dict(scope["headers"])
+            sent = headers.get(b"x-telegram-bot-api-secret-token", b"").decode("latin-1")
+            if not hmac.compare_digest(sent, self.secret_token):
+                return 403
+        body = await self._read_body(receive)
+        if body is None:
+            return 413
+        try:
+            update = Update.de_json(json.loads(body), self.bot)
+        except (ValueError, TypeError, KeyError) as e:
+            logger.warning(f"Ignoring malformed webhook update: {e}")
+            return 400
+        try:
+            await asyncio.wait_for(self.update_queue.put(update), self.enqueue_timeout)
+        except asyncio.TimeoutError:
+            self.rejected += 1
+            return 503
+        self.received += 1
+        return 200
+
+    async def _read_body(self, receive):
+        chunks, size = [], 0
+        while True:
+            message = await receive()
+            chunk = message.get("body", b"")
+            size += len(chunk)
+            if size > self.max_body_bytes:
+                return None
+            chunks.append(chunk)
+            if not message.get("more_body"):
+                return b"".join(chunks)
+
+
+async def serve_webhook(application, allowed_updates, set_webhook=True):
+    """Runs the application behind the built-in receiver until the server is stopped (SIGINT/SIGTERM).
+
+    Follows the same lifecycle as Application.run_polling, including the
+    post_init/post_stop/post_shutdown hooks.
+    """
+    if uvicorn is None:
+        raise RuntimeError("Webhook mode needs uvicorn; install it with `pip install uvicorn`.")
+    secret = webhook_secret(application.bot.token)
+    receiver = WebhookReceiver(
+        application.bot, application.update_queue, path=urlparse(WEBHOOK_URL).path or "/", secret_token=secret
+    )
+    server = uvicorn.Server(uvicorn.Config(
+        receiver, host=WEBHOOK_LISTEN, port=WEBHOOK_PORT, lifespan="off", log_level="warning", access_log=False
+    ))
+    await application.initialize()
+    try:
+        if application.post_init:
+            await application.post_init(application)
+        if set_webhook:
+            await application.bot.set_webhook(
+                WEBHOOK_URL, allowed_updates=allowed_updates, secret_token=secret,
+                max_connections=WEBHOOK_MAX_CONNECTIONS
+            )
+            logger.info(f"Webhook set to {WEBHOOK_URL} for update types {allowed_updates}.")
+        await application.start()
+        await server.serve()
+    finally:
+        if application.running:
+            await application.stop()
+        if application.post_stop:
+            await application.post_stop(application)
+        await application.shutdown()
+        if application.post_shutdown:
+            await application.post_shutdown(application)
+
+
+def run_application(application, set_webhook=True):
+    """Runs the bot until interrupted: through the webhook receiver if WEBHOOK_URL is set, long polling otherwise.
+
+    Either way Telegram is only asked for the update types the registered
+    handlers use. `set_webhook=False` is for extra workers behind the same URL.
+    """
+    allowed_updates = allowed_updates_for(application)
+    if WEBHOOK_URL:
+        asyncio.run(serve_webhook(application, allowed_updates, set_webhook))
+    else:
+        application.run_polling(allowed_updates=allowed_updates)